@@ -0,0 +1,61 @@
+"""
+Measures the time taken to import dbuspy modules in a fresh interpreter.
+
+Each module is imported in a new process, so the numbers include everything
+the import pulls in. The interpreter startup time is measured separately and
+subtracted. Also reports whether gevent was loaded by the import.
+
+Usage::
+
+    python benchmarks/bench_import.py [-n RUNS] [module ...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = [
+    'dbuspy',
+    'dbuspy.marshal',
+    'dbuspy.message',
+    'dbuspy.error',
+    'dbuspy.client',
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return time.time() - start, out.decode().strip()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=20)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    opts = parser.parse_args()
+
+    baseline = median([run('pass')[0] for _ in range(opts.runs)])
+    print('interpreter startup: %.1f ms' % (baseline * 1000,))
+
+    code = 'import sys, %s; print("gevent" in sys.modules)'
+    for module in opts.modules:
+        times = []
+        for _ in range(opts.runs):
+            t, gevent_loaded = run(code % (module,))
+            times.append(t)
+        print('%-20s %7.1f ms  gevent loaded: %s' % (
+            module, (median(times) - baseline) * 1000, gevent_loaded))
+
+
+if __name__ == '__main__':
+    main()
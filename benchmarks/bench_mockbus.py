@@ -0,0 +1,75 @@
+"""
+Measures method call latency and throughput over an in-process bus.
+
+Starts a L{dbuspy.mockbus.MockBus} with a L{dbuspy.mockbus.FakeSystemd}
+and calls C{ListUnits} from a second client, one call at a time for the
+latency and with up to C{--depth} calls in flight for the throughput. No
+system bus is needed.
+
+Usage::
+
+    python benchmarks/bench_mockbus.py [-n CALLS] [-u UNITS] [-d DEPTH]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import dbuspy  # noqa
+from dbuspy.mockbus import MockBus, FakeSystemd, SYSTEMD_BUS_NAME  # noqa
+
+_PATH = '/org/freedesktop/systemd1'
+_INTERFACE = 'org.freedesktop.systemd1.Manager'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--calls', type=int, default=5000)
+    parser.add_argument('-u', '--units', type=int, default=20)
+    parser.add_argument('-d', '--depth', type=int, default=64)
+    opts = parser.parse_args()
+
+    bus = MockBus().start()
+    systemd = FakeSystemd(bus)
+    for i in range(opts.units):
+        systemd.add_unit('bench-%d.service' % (i,))
+    systemd.start()
+    client = dbuspy.get_client(bus.address, timeout=10).connect()
+
+    latencies = []
+    for _ in range(opts.calls):
+        started = time.time()
+        client.call_remote(_PATH, 'ListUnits', interface=_INTERFACE,
+                           destination=SYSTEMD_BUS_NAME)
+        latencies.append(time.time() - started)
+    latencies.sort()
+    print('latency: p50 %.0f us, p99 %.0f us, max %.0f us' % (
+        latencies[len(latencies) // 2] * 1e6,
+        latencies[int(len(latencies) * 0.99)] * 1e6,
+        latencies[-1] * 1e6))
+
+    started = time.time()
+    in_flight = []
+    for _ in range(opts.calls):
+        in_flight.append(client.call_remote_async(
+            _PATH, 'ListUnits', interface=_INTERFACE,
+            destination=SYSTEMD_BUS_NAME))
+        if len(in_flight) >= opts.depth:
+            serial, result = in_flight.pop(0)
+            client.await_reply(serial, result=result)
+    for serial, result in in_flight:
+        client.await_reply(serial, result=result)
+    seconds = time.time() - started
+    print('throughput: %.0f calls/s with %d in flight' % (
+        opts.calls / seconds, opts.depth))
+
+    client.teardown()
+    systemd.stop()
+    bus.stop()
+
+
+if __name__ == '__main__':
+    main()
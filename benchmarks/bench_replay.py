@@ -0,0 +1,43 @@
+"""
+Measures how fast recorded DBus traffic is parsed and dispatched.
+
+Replays the messages received in a pcapng capture, as written by
+C{start_capture}, through C{process_raw_dbus_message} of a connection
+without transport, as fast as possible.
+
+Usage::
+
+    python benchmarks/bench_replay.py [-n RUNS] capture.pcapng
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from dbuspy.capture import ReplayConnection, replay  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('capture')
+    opts = parser.parse_args()
+
+    best = None
+    for _ in range(opts.runs):
+        conn = ReplayConnection()
+        messages, nbytes, seconds = replay(conn, opts.capture)
+        if best is None or seconds < best[2]:
+            best = (messages, nbytes, seconds, conn.counts)
+
+    messages, nbytes, seconds, counts = best
+    print('%d messages, %d bytes: %s' % (messages, nbytes, counts))
+    if seconds > 0:
+        print('%.3f s, %.0f messages/s, %.1f MB/s' % (
+            seconds, messages / seconds, nbytes / seconds / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,57 @@
-import os
-from .client import Client
-import socket
+"""
+dbuspy: DBus client and server library.
 
+Importing the package only loads the address helpers. The codec modules
+(C{marshal}, C{message}, C{error}) import without gevent, and the clients and
+their transports are imported on first use.
+"""
+import sys
 
-__all__ = ['session_bus']
+from .address import (DEFULAT_SYSTEM_BUS_ADDRESS, resolve_bus_address,
+                      parse_bus_address, unix_socket_path)
+
+
+__all__ = [
+    'Client',
+    'get_client',
+    'get_peer_client',
+    'get_threaded_client',
+    'session_bus',
+    'system_bus',
+]
 
 def session_bus():
+    """
+    Returns an unconnected L{Client} for the session bus, see L{get_client}
+    """
     return get_client('session')
 
 def system_bus():
+    """
+    Returns an unconnected L{Client} for the system bus, see L{get_client}
+    """
     return get_client('system')
 
 
+def _open_transport(bus_adress, socket=None):
+    if socket is None:
+        import gevent.socket as socket
 
+    addr = resolve_bus_address(bus_adress)
 
+    kind, d = parse_bus_address(addr)
+    transport = None
 
-DEFULAT_SYSTEM_BUS_ADDRESS = "unix:path=/var/run/dbus/system_bus_socket"
+    if kind == 'unix':
+        transport = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        transport.connect(unix_socket_path(d))
+    else:
+        raise NotImplementedError(addr)
 
-def get_client(bus_adress):
+    return transport
+
+
+def get_client(bus_adress, timeout=None):
     """
     'session', 'system', or a valid bus address as defined
     by the DBus specification. If 'session' (the default) or 'system' is
@@ -26,49 +60,48 @@ def get_client(bus_adress):
     address, respectively. If DBUS_SYSTEM_BUS_ADDRESS is not set, the
     well-known address unix:path=/var/run/dbus/system_bus_socket will be
     used.
-    """
 
-    if bus_adress == 'session':
-        addr = os.environ.get('DBUS_SESSION_BUS_ADDRESS', None)
-        if addr is None:
-            raise Exception('DBus Session environment variable not set')
+    C{timeout} is the client's default method call timeout in seconds.
 
-    elif bus_adress == 'system':
-        addr = os.environ.get(
-            'DBUS_SYSTEM_BUS_ADDRESS',
-            DEFULAT_SYSTEM_BUS_ADDRESS
-        )
-
-    else:
-        addr = bus_adress
-
-    # TODO: bus adress may be ';' seperated  values
-    # single address format
-    #  <kind>:<key1>=<value1>,<key2>=<value2>
-    # eg: unix:path=/var/run/dbus/system_bus_socket
-
-    d = {}
-    kind = None
-    transport = None
-
-    for c in addr.split(','):
-        if c.startswith('unix:'):
-                kind = 'unix'
-                c = c[5:]
-        else:
-            raise NotImplementedError(c)
-        
-        if '=' in c:
-            k, v = c.split('=')
-            d[k] = v
-
-    
-    if kind == 'unix':
-        transport = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        transport.connect(d['path'])
+    The returned L{Client} is not connected yet: call its C{connect()},
+    eg. C{get_client('system').connect()}, which authenticates and sends
+    C{Hello}. This leaves room to set up metrics or a capture first.
+    """
+    from .client import Client
+    return Client(_open_transport(bus_adress), timeout)
 
-    return Client(transport)
 
+def get_threaded_client(bus_adress, timeout=None, fast=False):
+    """
+    Like L{get_client} but returns a L{threaded.ThreadedClient}, which may
+    be shared by OS threads. Unlike L{get_client}, the client is returned
+    connected, since C{connect} chooses the handshake: see
+    L{threaded.ThreadedClient.connect} for C{fast}.
+    """
+    import socket
+    from .threaded import ThreadedClient
+    return ThreadedClient(
+        _open_transport(bus_adress, socket), timeout).connect(fast)
 
 
-    
+def get_peer_client(address, timeout=None):
+    """
+    Returns a L{server.PeerClient} talking directly to the
+    L{server.Server} listening at C{address}, without a bus daemon. Unlike
+    L{get_client}, the client is returned connected: a peer connection has
+    no C{Hello} or other setup to do before use.
+    """
+    from .server import PeerClient
+    return PeerClient(_open_transport(address), timeout).connect()
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # PEP 562: gevent is only imported once the client class is used
+        if name == 'Client':
+            from .client import Client
+            return Client
+        raise AttributeError(
+            'module %r has no attribute %r' % (__name__, name))
+else:
+    from .client import Client
@@ -0,0 +1,71 @@
+"""
+Parsing of DBus server addresses
+"""
+import os
+
+
+DEFULAT_SYSTEM_BUS_ADDRESS = "unix:path=/var/run/dbus/system_bus_socket"
+
+
+def resolve_bus_address(bus_adress):
+    """
+    Returns the address string for 'session', 'system', or a valid bus
+    address as defined by the DBus specification. If 'session' or 'system'
+    is supplied, the contents of the DBUS_SESSION_BUS_ADDRESS or
+    DBUS_SYSTEM_BUS_ADDRESS environment variables will be used for the bus
+    address, respectively. If DBUS_SYSTEM_BUS_ADDRESS is not set, the
+    well-known address unix:path=/var/run/dbus/system_bus_socket will be
+    used.
+    """
+    if bus_adress == 'session':
+        addr = os.environ.get('DBUS_SESSION_BUS_ADDRESS', None)
+        if addr is None:
+            raise Exception('DBus Session environment variable not set')
+        return addr
+
+    elif bus_adress == 'system':
+        return os.environ.get(
+            'DBUS_SYSTEM_BUS_ADDRESS',
+            DEFULAT_SYSTEM_BUS_ADDRESS
+        )
+
+    return bus_adress
+
+
+def parse_bus_address(addr):
+    """
+    Splits a DBus address into its transport kind and key/value pairs.
+
+    Addresses have the format C{<kind>:<key1>=<value1>,<key2>=<value2>}, eg:
+    unix:path=/var/run/dbus/system_bus_socket. When several ';' separated
+    addresses are given only the first one is used.
+
+    @returns: (kind, dict_of_parameters)
+    """
+    addr = addr.split(';')[0]
+
+    if ':' not in addr:
+        raise ValueError('Invalid DBus address: %r' % (addr,))
+
+    kind, params = addr.split(':', 1)
+
+    d = {}
+    for c in params.split(','):
+        if '=' in c:
+            k, v = c.split('=', 1)
+            d[k] = v
+
+    return kind, d
+
+
+def unix_socket_path(params):
+    """
+    Returns the socket path for the parameters of a 'unix' address. Abstract
+    namespace sockets are returned with their leading nul byte.
+    """
+    if 'path' in params:
+        return params['path']
+    elif 'abstract' in params:
+        return '\0' + params['abstract']
+    raise NotImplementedError(
+        'Unsupported unix address parameters: %r' % (params,))
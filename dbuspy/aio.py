@@ -0,0 +1,346 @@
+"""
+asyncio based DBus client.
+
+This is the asyncio counterpart of L{dbuspy.client.Client}. It shares the
+marshalling, message and framing code with the gevent implementation but
+does not import gevent::
+
+    client = await dbuspy.aio.system_bus()
+    names = await client.call_remote(
+        '/org/freedesktop/DBus', 'ListNames',
+        interface='org.freedesktop.DBus',
+        destination='org.freedesktop.DBus',
+    )
+"""
+import asyncio
+import inspect
+import logging
+
+from .address import resolve_bus_address, parse_bus_address, unix_socket_path
+from .authentication import (ClientAuthenticator, AUTH_DELIMITER,
+                             MAX_AUTH_LENGTH)
+from .connection import BaseConnection
+from .error import ConnectionClosed, DBusAuthenticationFailed, TimeOut
+from .message import MethodCallMessage
+from .metrics import IO_WAIT, SIGNAL_QUEUE_DEPTH, clock
+from .objects import DBusObjectHandler
+from . import signals
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the transport at a time. Also bounds how far a full BLOCK
+# signal queue can overflow, since the messages of a read are dispatched
+# before reading is paused.
+READ_SIZE = 4096
+
+
+class AsyncClientAuthenticator (ClientAuthenticator):
+    """
+    Runs the L{ClientAuthenticator} state machine on lines received by an
+    L{AsyncClientBase} instead of reading the socket itself.
+    """
+
+    async def authenticate(self, client):
+        self.start(client)
+        self.auth_try_next_method()
+
+        while not self._authenticated:
+            line = await client._auth_lines.get()
+            if line is None:
+                raise DBusAuthenticationFailed("ConnectionClosed")
+            if len(line) > MAX_AUTH_LENGTH:
+                raise DBusAuthenticationFailed(
+                    "AuthMessageLengthExceeded by %d" % len(line))
+            self.handle_auth_message(line)
+
+        self.guid = self.get_guid()
+
+    def await_reply(self):
+        # Replies are consumed by authenticate()
+        pass
+
+
+class AsyncSignalQueue (signals.SignalQueue):
+    """
+    L{signals.SignalQueue} for asyncio clients. The C{BLOCK} policy pauses
+    reading from the transport while the queue is full; the signals of the
+    current read of at most L{READ_SIZE} bytes are still queued.
+    """
+
+    def __init__(self, *args, **kwargs):
+        signals.SignalQueue.__init__(self, *args, **kwargs)
+        self._ready = asyncio.Event()
+
+    def put(self, msig):
+        queued = signals.SignalQueue.put(self, msig)
+        if queued:
+            self._ready.set()
+        return queued
+
+    async def get_wait(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get()
+
+
+class AsyncClientBase (BaseConnection, asyncio.BufferedProtocol):
+    """
+    asyncio protocol implementing the client side of a DBus connection.
+    Method calls are matched to their replies by serial number.
+
+    @ivar default_timeout: Seconds to wait for a method reply when the caller
+                           does not give a timeout. None waits forever.
+    """
+
+    def __init__(self, loop, timeout=None):
+        """
+        @param loop: The running event loop
+        """
+        BaseConnection.__init__(self)
+        self.default_timeout = timeout
+        self.loop = loop
+        self.transport = None
+        self._auth_lines = asyncio.Queue()
+        self._authenticating = True
+        self._read_buffer = memoryview(bytearray(READ_SIZE))
+        self._obj_handler = DBusObjectHandler(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self._read_buffer
+
+    def buffer_updated(self, nbytes):
+        self.data_received(self._read_buffer[:nbytes].tobytes())
+
+    def connection_lost(self, exc):
+        self._auth_lines.put_nowait(None)
+        self._fail_pending(ConnectionClosed())
+
+    def data_received(self, data):
+        if not self._authenticating:
+            self.on_data_received(data)
+            return
+
+        lines = (self._buffer + data).split(AUTH_DELIMITER)
+        self._buffer = lines.pop(-1)
+        for line in lines:
+            self._auth_lines.put_nowait(line)
+
+    async def connect(self):
+        # DBus specification requires that clients send a null byte upon
+        # connection to the bus
+        self.write(b'\0')
+        await AsyncClientAuthenticator().authenticate(self)
+        self._authenticating = False
+        if self._buffer:
+            self.on_data_received(b'')
+        await self.on_connection_authenticated()
+        return self
+
+    def on_method_call_received(self, mcall):
+        """
+        Answers the C{org.freedesktop.DBus.Peer} methods and rejects any
+        other call: objects cannot be exported on asyncio clients
+        """
+        self._obj_handler.answer_peer_call(self, mcall,
+                                           'on an asyncio client')
+
+    def write(self, data):
+        if self.metrics.enabled:
+            self.metrics.bytes_sent(len(data))
+        self.transport.write(data)
+
+    def teardown(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def call_remote(self, object_path, method,
+                          interface=None,
+                          destination=None,
+                          signature=None,
+                          args=None,
+                          expectReply=True,
+                          autoStart=True,
+                          timeout=None):
+        started = clock() if self.metrics.enabled else None
+        mcall_msg = MethodCallMessage(
+            object_path,
+            method,
+            interface=interface,
+            destination=destination,
+            signature=signature,
+            body=args,
+            expectReply=expectReply,
+            autoStart=autoStart,
+            oobFDs=self._toBeSentFDs,
+            serial=self.next_serial(),
+        )
+        if not expectReply:
+            self.send_message(mcall_msg)
+            return None
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        fut = self.loop.create_future()
+        self._pending[mcall_msg.serial] = fut
+        if started is not None:
+            self._call_sent(mcall_msg, started)
+            started = clock()
+        try:
+            self.send_message(mcall_msg)
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeOut('No reply to method call %d within %s seconds' % (
+                mcall_msg.serial, timeout))
+        finally:
+            self._pending.pop(mcall_msg.serial, None)
+            if started is not None:
+                self.metrics.time_spent(IO_WAIT, clock() - started)
+                self._call_finished(mcall_msg.serial, True)
+
+    async def on_connection_authenticated(self):
+        pass
+
+
+class AsyncClient (AsyncClientBase):
+    """
+    asyncio DBus client connected to a message bus
+    """
+    busname = None
+    _signal_subscriptions = ()
+
+    def __repr__(self):
+        return "<AsyncDBusClient(%s)>" % self.busname
+
+    async def on_connection_authenticated(self):
+        self.busname = await self.call_remote(
+            '/Hello',
+            'Hello',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+        )
+
+    async def add_signal_receiver(self, callback, interface=None,
+                                  member=None, path=None,
+                                  path_namespace=None, sender=None,
+                                  arg0=None,
+                                  maxsize=signals.DEFAULT_QUEUE_SIZE,
+                                  overflow=signals.DROP_OLDEST,
+                                  coalesce_key=None):
+        """
+        Subscribes to signals matching the given match rule keys. See
+        L{dbuspy.client.Client.add_signal_receiver}. C{callback} may be a
+        plain function or a coroutine function.
+
+        @rtype: L{signals.SignalSubscription}
+        """
+        queue = AsyncSignalQueue(maxsize, overflow, coalesce_key)
+        sub = signals.SignalSubscription(
+            callback, queue,
+            interface=interface,
+            member=member,
+            path=path,
+            path_namespace=path_namespace,
+            sender=sender,
+            arg0=arg0,
+        )
+        await self.call_remote(
+            '/org/freedesktop/DBus',
+            'AddMatch',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s',
+            args=[sub.rule],
+        )
+        sub.task = self.loop.create_task(self._deliver_signals(sub))
+        self._signal_subscriptions = self._signal_subscriptions + (sub,)
+        return sub
+
+    async def remove_signal_receiver(self, sub):
+        if sub not in self._signal_subscriptions:
+            return
+        self._signal_subscriptions = tuple(
+            s for s in self._signal_subscriptions if s is not sub)
+        sub.task.cancel()
+        sub.queue.clear()
+        self._maybe_resume_reading()
+        await self.call_remote(
+            '/org/freedesktop/DBus',
+            'RemoveMatch',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s',
+            args=[sub.rule],
+        )
+
+    def signal_queue_stats(self):
+        return [(sub.rule, sub.queue.stats())
+                for sub in self._signal_subscriptions]
+
+    def on_signal_received(self, msig):
+        matched = False
+        for sub in self._signal_subscriptions:
+            if sub.matches(msig):
+                matched = True
+                sub.queue.put(msig)
+                if sub.queue.policy == signals.BLOCK and sub.queue.full():
+                    self.transport.pause_reading()
+        if self.metrics.enabled:
+            self.metrics.gauge(SIGNAL_QUEUE_DEPTH, sum(
+                len(sub.queue) for sub in self._signal_subscriptions))
+        if not matched:
+            AsyncClientBase.on_signal_received(self, msig)
+
+    def _maybe_resume_reading(self):
+        for sub in self._signal_subscriptions:
+            if sub.queue.policy == signals.BLOCK and sub.queue.full():
+                return
+        self.transport.resume_reading()
+
+    async def _deliver_signals(self, sub):
+        while True:
+            msig = await sub.queue.get_wait()
+            if sub.queue.policy == signals.BLOCK:
+                self._maybe_resume_reading()
+            try:
+                r = sub.callback(msig)
+                if inspect.isawaitable(r):
+                    await r
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Error in signal callback for %r', sub)
+
+
+async def get_client(bus_adress, loop=None, timeout=None):
+    """
+    Connects and authenticates an L{AsyncClient}. C{bus_adress} is
+    'session', 'system' or a DBus address, as for L{dbuspy.get_client}.
+    C{timeout} is the client's default method call timeout. C{loop}
+    defaults to the running loop.
+    """
+    loop = loop or asyncio.get_running_loop()
+    kind, d = parse_bus_address(resolve_bus_address(bus_adress))
+
+    if kind != 'unix':
+        raise NotImplementedError(bus_adress)
+
+    transport, client = await loop.create_unix_connection(
+        lambda: AsyncClient(loop, timeout), unix_socket_path(d))
+    try:
+        return await client.connect()
+    except BaseException:
+        transport.close()
+        raise
+
+
+def session_bus(loop=None):
+    return get_client('session', loop)
+
+
+def system_bus(loop=None):
+    return get_client('system', loop)
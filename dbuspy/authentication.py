@@ -8,9 +8,10 @@ import getpass
 import hashlib
 import os
 import os.path
+import socket
+import struct
 import time
 import logging
-import six
 
 from .error import DBusAuthenticationFailed
 
@@ -32,6 +33,13 @@ class ClientAuthenticator (object):
     preference = [b'EXTERNAL', b'DBUS_COOKIE_SHA1', b'ANONYMOUS']
 
     def authenticate(self, client):
+        self.start(client)
+        self.auth_try_next_method()
+
+    def start(self, client):
+        """
+        Resets the authentication state for a new connection
+        """
         self._authenticated = False
         self.client = client
         self.unix_fd_support = self._uses_unix_socket_transport(self.client)
@@ -41,8 +49,6 @@ class ClientAuthenticator (object):
         self.authOrder = self.preference[:]
         self.authOrder.reverse()
 
-        self.auth_try_next_method()
-
     def _uses_unix_socket_transport(self, protocol):
         return True
         return (
@@ -66,7 +72,7 @@ class ClientAuthenticator (object):
                 #     # that told it to close.
                 #     return
                 if len(line) > MAX_AUTH_LENGTH:
-                    self.client.loseConnection()
+                    self.client.teardown()
                     raise DBusAuthenticationFailed(
                         "AuthMessageLengthExceeded by %d" % len(line))
                 else:
@@ -80,7 +86,7 @@ class ClientAuthenticator (object):
                             #     self.on_data_received(b'')
                             return
                     except DBusAuthenticationFailed as e:
-                        self.client.loseConnection()
+                        self.client.teardown()
                         raise e
 
 
@@ -249,3 +255,257 @@ class ClientAuthenticator (object):
                         return k_cookie_hex
                 except BaseException:
                     pass
+
+
+def get_peer_credentials(sock):
+    """
+    Returns the (pid, uid, gid) of the process at the other end of a unix
+    socket, or None if the platform does not provide C{SO_PEERCRED}
+    """
+    so_peercred = getattr(socket, 'SO_PEERCRED', None)
+    if so_peercred is None:
+        return None
+    try:
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, so_peercred, struct.calcsize('3i'))
+    except (socket.error, OSError):
+        return None
+    return struct.unpack('3i', creds)
+
+
+class ServerAuthenticator (object):
+    """
+    Implements the server-side portion of the DBus authentication protocol
+    for peer-to-peer connections. Only the EXTERNAL mechanism is supported:
+    the client's uid is taken from the socket credentials and checked
+    against C{allowed_uids}.
+
+    @ivar guid: Hex encoded GUID of the server, sent in the OK message
+    @ivar allowed_uids: Collection of uids allowed to connect. Defaults to
+                        the uid of the server process
+    """
+
+    MAX_FAILURES = 10
+
+    def __init__(self, guid, allowed_uids=None):
+        self.guid = guid
+        if allowed_uids is None:
+            allowed_uids = (os.getuid(),)
+        self.allowed_uids = frozenset(allowed_uids)
+
+    def authenticate(self, conn):
+        """
+        Runs the authentication conversation on a freshly accepted
+        connection. Returns once the client sent BEGIN; bytes received
+        after it are fed to C{conn.on_data_received}.
+
+        @raises DBusAuthenticationFailed: if the client disconnects or fails
+                                          too many times
+        """
+        self.conn = conn
+        self.uid = None
+        self.failures = 0
+        self._state = 'auth'
+        self._creds = get_peer_credentials(conn._transport)
+
+        buf = b''
+        while not buf:
+            data = conn.read()
+            if not data:
+                raise DBusAuthenticationFailed('ConnectionClosed')
+            buf += data
+        if buf[:1] != b'\0':
+            raise DBusAuthenticationFailed('Missing initial null byte')
+        buf = buf[1:]
+
+        while True:
+            lines = buf.split(AUTH_DELIMITER)
+            buf = lines.pop(-1)
+            for i, line in enumerate(lines):
+                self.handle_auth_message(line)
+                if self._state == 'begun':
+                    rest = AUTH_DELIMITER.join(lines[i + 1:] + [buf])
+                    conn._unix_creds = self._creds
+                    conn.guid = self.uid
+                    conn.on_connection_authenticated()
+                    if rest:
+                        conn.on_data_received(rest)
+                    return
+
+            if len(buf) > MAX_AUTH_LENGTH:
+                raise DBusAuthenticationFailed(
+                    "AuthMessageLengthExceeded by %d" % len(buf))
+            data = conn.read()
+            if not data:
+                raise DBusAuthenticationFailed('ConnectionClosed')
+            buf += data
+
+    def send_message(self, msg):
+        self.conn.write(msg + AUTH_DELIMITER)
+
+    def handle_auth_message(self, line):
+        if b' ' not in line:
+            cmd = line
+            args = b''
+        else:
+            cmd, args = line.split(b' ', 1)
+        m = getattr(self, '_server_' + cmd.decode('ascii', 'replace'), None)
+        if m:
+            m(args.strip())
+        else:
+            self.send_message(b'ERROR "Unknown command"')
+
+    def reject(self):
+        self.failures += 1
+        if self.failures >= self.MAX_FAILURES:
+            raise DBusAuthenticationFailed('Too many failed attempts')
+        self._state = 'auth'
+        self.send_message(b'REJECTED EXTERNAL')
+
+    def check_external(self, identity):
+        """
+        Accepts the client if its socket credentials belong to an allowed
+        user and match the identity it claimed, if any
+        """
+        if self._creds is None:
+            self.reject()
+            return
+        uid = self._creds[1]
+        if identity:
+            try:
+                claimed = int(binascii.unhexlify(identity))
+            except (TypeError, ValueError, binascii.Error):
+                self.reject()
+                return
+            if claimed != uid:
+                self.reject()
+                return
+        if uid not in self.allowed_uids:
+            self.reject()
+            return
+        self.uid = uid
+        self._state = 'wait_begin'
+        self.send_message(b'OK ' + self.guid)
+
+    # -------------------------------------------------
+
+    def _server_AUTH(self, args):
+        if self._state != 'auth':
+            self.send_message(b'ERROR "Unexpected AUTH"')
+            return
+        if b' ' in args:
+            mech, identity = args.split(b' ', 1)
+        else:
+            mech, identity = args, None
+        if mech != b'EXTERNAL':
+            self.reject()
+        elif identity is None:
+            self._state = 'wait_data'
+            self.send_message(b'DATA')
+        else:
+            self.check_external(identity)
+
+    def _server_DATA(self, args):
+        if self._state != 'wait_data':
+            self.send_message(b'ERROR "Unexpected DATA"')
+            return
+        self.check_external(args)
+
+    def _server_CANCEL(self, args):
+        self.reject()
+
+    def _server_ERROR(self, args):
+        self.reject()
+
+    def _server_NEGOTIATE_UNIX_FD(self, args):
+        if self._state != 'wait_begin':
+            self.send_message(b'ERROR "Not authenticated"')
+        else:
+            self.send_message(b'AGREE_UNIX_FD')
+
+    def _server_BEGIN(self, args):
+        if self._state != 'wait_begin':
+            self.send_message(b'ERROR "Not authenticated"')
+        else:
+            self._state = 'begun'
+
+
+class PipelinedClientAuthenticator (ClientAuthenticator):
+    """
+    Client-side authentication in a single round trip, for unix socket
+    connections. The null byte, C{AUTH EXTERNAL} with the uid of this
+    process, C{NEGOTIATE_UNIX_FD} and C{BEGIN} are sent in one write,
+    followed by any messages the client wants sent right away (typically
+    C{Hello}). The server replies are validated as they arrive.
+
+    There is no fallback to other mechanisms: if the server rejects
+    EXTERNAL the connection is closed and must be reopened and authenticated
+    with L{ClientAuthenticator}.
+    """
+
+    def authenticate(self, client, early_messages=b''):
+        """
+        @param early_messages: Raw DBus messages to send right after BEGIN
+        """
+        self.start(client)
+        self.authMech = b'EXTERNAL'
+
+        uid = binascii.hexlify(str(os.getuid()).encode('ascii'))
+        lines = [b'\0AUTH EXTERNAL ' + uid]
+        self._expected = [b'OK']
+        if self.unix_fd_support:
+            lines.append(b'NEGOTIATE_UNIX_FD')
+            self._expected.append(b'AGREE_UNIX_FD')
+        lines.append(b'BEGIN')
+
+        try:
+            client.write(
+                AUTH_DELIMITER.join(lines) + AUTH_DELIMITER + early_messages)
+
+            buf = b''
+            while self._expected:
+                data = client.read()
+                if not data:
+                    raise DBusAuthenticationFailed("ConnectionClosed")
+                buf += data
+                while self._expected and AUTH_DELIMITER in buf:
+                    line, buf = buf.split(AUTH_DELIMITER, 1)
+                    self.check_reply(line)
+                if self._expected and len(buf) > MAX_AUTH_LENGTH:
+                    raise DBusAuthenticationFailed(
+                        "AuthMessageLengthExceeded by %d" % len(buf))
+        except DBusAuthenticationFailed:
+            client.teardown()
+            raise
+
+        self._authenticated = True
+        # Replies to the early messages may have arrived with the last
+        # authentication line
+        client._buffer = b''
+        if buf:
+            client.on_data_received(buf)
+        client.on_connection_authenticated()
+
+    def check_reply(self, line):
+        expected = self._expected.pop(0)
+        if b' ' not in line:
+            cmd = line
+            args = b''
+        else:
+            cmd, args = line.split(b' ', 1)
+
+        if cmd == expected == b'OK':
+            try:
+                self.guid = binascii.unhexlify(args.strip())
+            except BaseException:
+                raise DBusAuthenticationFailed('Invalid guid in OK message')
+        elif cmd == expected == b'AGREE_UNIX_FD':
+            pass
+        elif cmd == b'ERROR' and expected == b'AGREE_UNIX_FD':
+            # The server does not pass file descriptors; BEGIN still stands
+            self.unix_fd_support = False
+        else:
+            raise DBusAuthenticationFailed(
+                'Unexpected reply to pipelined authentication: ' +
+                line.decode("ascii", "replace")
+            )
@@ -0,0 +1,225 @@
+"""
+Capture and replay of raw DBus traffic.
+
+A connection started with C{start_capture} writes every message it sends
+or receives to a pcapng file with the DBus link type, readable by Wireshark
+and tcpdump::
+
+    client.start_capture('/tmp/bus.pcapng')
+    ...
+    client.stop_capture()
+
+L{replay} feeds the received messages of a capture back through
+C{process_raw_dbus_message}, eg. to benchmark parsing and dispatch offline.
+"""
+import struct
+import threading
+import time
+
+# Directions, as in the epb_flags option of Enhanced Packet Blocks
+from .connection import BaseConnection, INBOUND, OUTBOUND
+
+LINKTYPE_DBUS = 231
+
+_SHB = 0x0A0D0D0A
+_IDB = 0x00000001
+_EPB = 0x00000006
+_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+_OPT_END = 0
+_OPT_IF_TSRESOL = 9
+_OPT_EPB_FLAGS = 2
+
+# Timestamps are written in microseconds
+_TS_UNITS = 1000000
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return b''.join([struct.pack('<II', block_type, length), body,
+                     struct.pack('<I', length)])
+
+
+class PcapngWriter (object):
+    """
+    Writes DBus messages to a pcapng stream with a single interface of link
+    type L{LINKTYPE_DBUS}. Safe to use from several threads.
+    """
+
+    def __init__(self, f):
+        """
+        @param f: Binary file object, or the path of a file to create
+        """
+        self._owned = not hasattr(f, 'write')
+        self._file = open(f, 'wb') if self._owned else f
+        self._lock = threading.Lock()
+        self.packets = 0
+
+        # Section header: byte order magic, version 1.0, unknown length
+        self._file.write(_block(_SHB, struct.pack(
+            '<IHHq', _BYTE_ORDER_MAGIC, 1, 0, -1)))
+        # Interface description: no snap length limit, microsecond stamps
+        self._file.write(_block(_IDB, struct.pack(
+            '<HHI', LINKTYPE_DBUS, 0, 0) + struct.pack(
+            '<HHB3x', _OPT_IF_TSRESOL, 1, 6) + struct.pack(
+            '<HH', _OPT_END, 0)))
+
+    def write_message(self, direction, raw, timestamp=None):
+        """
+        @param direction: L{INBOUND} or L{OUTBOUND}
+        @param raw: The complete marshalled message
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        ts = int(timestamp * _TS_UNITS)
+        block = _block(_EPB, b''.join([
+            struct.pack('<IIIII', 0, ts >> 32, ts & 0xFFFFFFFF,
+                        len(raw), len(raw)),
+            _pad(raw),
+            struct.pack('<HHI', _OPT_EPB_FLAGS, 4, direction),
+            struct.pack('<HH', _OPT_END, 0),
+        ]))
+        with self._lock:
+            self._file.write(block)
+            self.packets += 1
+
+    def close(self):
+        with self._lock:
+            if self._owned:
+                self._file.close()
+            else:
+                self._file.flush()
+
+
+def read_capture(f):
+    """
+    Iterates over the DBus messages of a pcapng capture
+
+    @param f: Binary file object or path
+    @returns: Iterator of (timestamp, direction, raw message) tuples. The
+              direction is None for packets without the flags option.
+    @raises ValueError: if C{f} is not a pcapng capture
+    """
+    if not hasattr(f, 'read'):
+        with open(f, 'rb') as fobj:
+            for packet in read_capture(fobj):
+                yield packet
+        return
+
+    endian = None
+    resolutions = []
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        block_type = struct.unpack('<I', header[:4])[0]
+        if endian is None and block_type != _SHB:
+            raise ValueError('Not a pcapng capture')
+        if block_type == _SHB:
+            magic = f.read(4)
+            endian = '<' if struct.unpack('<I', magic)[0] == \
+                _BYTE_ORDER_MAGIC else '>'
+            length = struct.unpack(endian + 'I', header[4:])[0]
+            f.read(length - 12)
+            resolutions = []
+            continue
+
+        block_type, length = struct.unpack(endian + 'II', header)
+        body = f.read(length - 8)[:-4]
+
+        if block_type == _IDB:
+            linktype = struct.unpack(endian + 'H', body[:2])[0]
+            units = 10 ** 6
+            for code, value in _options(body[8:], endian):
+                if code == _OPT_IF_TSRESOL:
+                    r = bytearray(value)[0]
+                    units = 2 ** (r & 0x7F) if r & 0x80 else 10 ** r
+            resolutions.append((linktype, units))
+
+        elif block_type == _EPB:
+            iface, ts_high, ts_low, caplen = struct.unpack(
+                endian + 'IIII', body[:16])
+            linktype, units = resolutions[iface]
+            if linktype != LINKTYPE_DBUS:
+                continue
+            raw = body[20:20 + caplen]
+            direction = None
+            for code, value in _options(body[20 + caplen + (-caplen % 4):],
+                                        endian):
+                if code == _OPT_EPB_FLAGS:
+                    direction = struct.unpack(endian + 'I', value)[0] & 0x3
+            yield (((ts_high << 32) | ts_low) / float(units), direction,
+                   raw)
+
+
+def _options(data, endian):
+    offset = 0
+    while offset + 4 <= len(data):
+        code, length = struct.unpack(endian + 'HH', data[offset:offset + 4])
+        if code == _OPT_END:
+            return
+        yield code, data[offset + 4:offset + 4 + length]
+        offset += 4 + length + (-length % 4)
+
+
+def replay(conn, f, speed=None, sleep=time.sleep):
+    """
+    Feeds the messages a connection received, as recorded in a capture, to
+    C{conn.process_raw_dbus_message}
+
+    @param conn: The connection to dispatch to, eg. a L{ReplayConnection}
+    @param speed: None to replay as fast as possible, 1.0 for the recorded
+                  pace, 2.0 for twice as fast...
+    @param sleep: Function used to wait, eg. C{gevent.sleep}
+    @returns: (number of messages, number of bytes, seconds taken)
+    """
+    messages = 0
+    nbytes = 0
+    started = time.time()
+    first = None
+    for timestamp, direction, raw in read_capture(f):
+        if direction == OUTBOUND:
+            continue
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.time() - started)
+            if delay > 0:
+                sleep(delay)
+        conn.process_raw_dbus_message(raw)
+        messages += 1
+        nbytes += len(raw)
+    return messages, nbytes, time.time() - started
+
+
+class ReplayConnection (BaseConnection):
+    """
+    Connection without a transport that counts the messages dispatched to
+    it by type. Replies are not matched to calls.
+
+    @ivar counts: C{dict} of message type name to count
+    """
+
+    def __init__(self):
+        BaseConnection.__init__(self)
+        self.counts = {'method_call': 0, 'method_return': 0,
+                       'error': 0, 'signal': 0}
+
+    def write(self, data):
+        pass
+
+    def on_method_call_received(self, mcall):
+        self.counts['method_call'] += 1
+
+    def on_method_return_received(self, mret):
+        self.counts['method_return'] += 1
+
+    def on_error_received(self, merr):
+        self.counts['error'] += 1
+
+    def on_signal_received(self, msig):
+        self.counts['signal'] += 1
@@ -1,62 +1,166 @@
 
-import gevent.timeout as gtimeout
+import collections
+import logging
+
+import gevent
+from gevent.event import AsyncResult, Event
 
 from .message import MethodCallMessage
+from .metrics import SIGNAL_QUEUE_DEPTH, clock
 from .protocol import ClientBase
-from .objects import  DBusObjectHandler
+from .connection import hello_message
+from .objects import DBusObjectHandler
+from .error import FailedToAcquireName, TimeOut
+from . import signals
+
+logger = logging.getLogger(__name__)
+
+
+class GreenSignalQueue(signals.SignalQueue):
+    """
+    L{signals.SignalQueue} for gevent clients. Consumers wait in
+    L{get_wait}. L{put} never waits: with the C{BLOCK} policy the client
+    reader calls L{wait_space} before reading more data instead, so that
+    the messages already received are dispatched first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        signals.SignalQueue.__init__(self, *args, **kwargs)
+        self._ready = Event()
+        self._space = Event()
+        self._space.set()
+
+    def put(self, msig):
+        queued = signals.SignalQueue.put(self, msig)
+        if queued:
+            self._ready.set()
+        return queued
+
+    def get_wait(self):
+        while not self._items:
+            self._ready.clear()
+            self._ready.wait()
+        msig = self.get()
+        if not self.full():
+            self._space.set()
+        return msig
+
+    def wait_space(self):
+        """
+        Waits until the queue holds less than C{maxsize} signals
+        """
+        while self.full():
+            self._space.clear()
+            self._space.wait()
+
+    def clear(self):
+        signals.SignalQueue.clear(self)
+        self._space.set()
+
+
+# Flags of org.freedesktop.DBus.RequestName
+NAME_FLAG_ALLOW_REPLACEMENT = 0x1
+NAME_FLAG_REPLACE_EXISTING = 0x2
+NAME_FLAG_DO_NOT_QUEUE = 0x4
+
 
 class Client(ClientBase):
-    # def __init__(self):
+    """
+    gevent DBus client connected to a message bus
+
+    Incoming method calls for exported objects are handled by up to
+    C{max_concurrent_calls} greenlets, in the order they arrive. Further
+    calls wait in a backlog of at most C{max_queued_calls}; beyond that
+    they are answered with C{org.freedesktop.DBus.Error.LimitsExceeded}.
+    Set C{max_concurrent_calls} to 1 to handle calls strictly one after the
+    other.
+    """
     busname = None
-    obj_handler = None
+    max_concurrent_calls = 64
+    max_queued_calls = 1024
+    name_cache = None
+    address_unique_names = False
+    _hello = None  # (serial, AsyncResult) of a pipelined Hello
+    _signal_subscriptions = ()
+
+    def __init__(self, transport, timeout=None):
+        ClientBase.__init__(self, transport, timeout)
+        self.obj_handler = DBusObjectHandler(self)
+        self._call_workers = 0
+        self._call_backlog = collections.deque()
 
     def __del__(self):
-        self.teardown()
+        try:
+            self._transport.close()
+        except Exception:
+            pass
     
     def __repr__(self):
-        "<DBusClient(%s)>" % self.busname
+        return "<DBusClient(%s)>" % self.busname
     
     def on_connection_authenticated(self):
-        # print "on_connection_authenticated!!!!"
-        busname = self.call_remote(
-            '/Hello',
-            'Hello',
-            interface='org.freedesktop.DBus',
-            destination='org.freedesktop.DBus',
-        )
+        self.start_reading()
+        if self._hello is not None:
+            serial, result = self._hello
+            self._hello = None
+            try:
+                busname = result.get(timeout=self.default_timeout)
+            except gevent.Timeout:
+                self._pending.pop(serial, None)
+                raise TimeOut('No reply to Hello')
+        else:
+            busname = self.call_remote(
+                '/Hello',
+                'Hello',
+                interface='org.freedesktop.DBus',
+                destination='org.freedesktop.DBus',
+            )
         self.busname=busname
-        self.obj_handler = DBusObjectHandler(self)
 
-    def _convert_reply(self, msg):
-        if msg is None:
-                return None
-
-        # if returnSignature != _NO_CHECK_RETURN:
-        #     if not returnSignature:
-        #         if msg.signature:
-        #             raise error.RemoteError(
-        #                 'Unexpected return value signature')
-        #     else:
-        #         if not msg.signature or msg.signature != returnSignature:
-        #             msg = 'Expected "%s". Received "%s"' % (
-        #                 str(returnSignature), str(msg.signature))
-        #             raise error.RemoteError(
-        #                 'Unexpected return value signature: %s' %
-        #                 (msg,))
-
-        if msg.body is None or len(msg.body) == 0:
-            return None
-
-        # if not (
-        #     isinstance(msg.body[0], six.string_types) and
-        #     msg.body[0].startswith('<!D')
-        # ):
-        #     print('RET SIG', msg.signature, 'BODY:', msg.body)
-        if len(msg.body) == 1 and not msg.signature[0] == '(':
-            return msg.body[0]
-        else:
-            return msg.body
-            
+    def _pipelined_messages(self):
+        mcall_msg = hello_message(self.next_serial())
+        result = AsyncResult()
+        self._pending[mcall_msg.serial] = result
+        self._hello = (mcall_msg.serial, result)
+        return mcall_msg.raw_message
+
+    def call_remote_async(self, object_path, method,
+                          interface=None,
+                          destination=None,
+                          signature=None,
+                          args=None,
+                          autoStart=True):
+        """
+        Sends a method call without waiting for the reply.
+
+        @returns: (serial, L{AsyncResult}) The result receives the converted
+                  reply. Pass the serial to L{await_reply} to wait with a
+                  timeout, or to L{forget_call} when giving up.
+        """
+        started = clock() if self.metrics.enabled else None
+        mcall_msg = MethodCallMessage(
+                object_path,
+                method,
+                interface=interface,
+                destination=self._resolve_destination(destination),
+                signature=signature,
+                body=args,
+                autoStart=autoStart,
+                oobFDs=self._toBeSentFDs,
+                serial=self.next_serial(),
+            )
+        result = AsyncResult()
+        self._pending[mcall_msg.serial] = result
+        if started is not None:
+            self._call_sent(mcall_msg, started)
+        try:
+            self.send_message(mcall_msg)
+        except Exception:
+            self._pending.pop(mcall_msg.serial, None)
+            self._call_starts.pop(mcall_msg.serial, None)
+            raise
+        return mcall_msg.serial, result
+
     def call_remote(self, object_path, method,
                    interface=None,
                    destination=None,
@@ -65,37 +169,268 @@ class Client(ClientBase):
                    expectReply=True,
                    autoStart=True,
                    timeout=None,
-                #    returnSignature=_NO_CHECK_RETURN
                    ):
-    # def getRemoteObject(self, bus_name, object_path):
-        
-        mcall_msg = MethodCallMessage(
+        """
+        Calls a remote method and returns the converted reply.
+
+        @param timeout: Seconds to wait for the reply. Defaults to the
+                        client's C{default_timeout}.
+        @raises error.TimeOut: if the reply does not arrive in time
+        """
+        if expectReply:
+            serial, result = self.call_remote_async(
                 object_path,
                 method,
                 interface=interface,
                 destination=destination,
                 signature=signature,
+                args=args,
+                autoStart=autoStart,
+            )
+            if timeout is None:
+                timeout = self.default_timeout
+            return self.await_reply(serial, timeout, result)
+
+        mcall_msg = MethodCallMessage(
+                object_path,
+                method,
+                interface=interface,
+                destination=self._resolve_destination(destination),
+                signature=signature,
                 body=args,
-                expectReply=expectReply,
+                expectReply=False,
                 autoStart=autoStart,
                 oobFDs=self._toBeSentFDs,
+                serial=self.next_serial(),
             )
-        if expectReply:
-            with gtimeout.Timeout(timeout):
-                self.write(mcall_msg.raw_message)
-                return self._convert_reply(self.await_result())
-        else:
-            self.write(mcall_msg.raw_message)
-            return None
+        self.send_message(mcall_msg)
+        return None
 
 
     def get_object(self, busname, object_path, interface=None):
         return self.obj_handler.get_remote_object_proxy(busname, object_path, interface)
 
-    # def on_method_call_received(self, mcall):
-    #     """
-    #     Called when a method call message is received
-    #     """
-    #     self.objHandler.handleMethodCallMessage(mcall)
+    def enable_name_cache(self, preload=False, address_unique_names=False):
+        """
+        Keeps track of the owners of well-known bus names, see
+        L{names.NameOwnerCache}. Signal subscriptions with a well-known
+        C{sender} are then filtered by the owner's unique name.
+
+        @param preload: Resolve the owners of all names on the bus now
+        @param address_unique_names: Send method calls for well-known names
+                                     to the unique name of their owner.
+                                     Calls to names without an owner still
+                                     use the well-known name, so that
+                                     activation works.
+        """
+        from .names import NameOwnerCache
+        if self.name_cache is None:
+            self.name_cache = NameOwnerCache(self).start()
+        if preload:
+            self.name_cache.preload()
+        self.address_unique_names = address_unique_names
+        return self.name_cache
+
+    def _resolve_destination(self, destination):
+        if (not self.address_unique_names or self.name_cache is None or
+                not destination or destination[:1] == ':'):
+            return destination
+        return self.name_cache.get_owner(destination) or destination
+
+    def enable_introspection_cache(self, cache=None, version_properties=None):
+        """
+        Keeps the introspection data of objects owned by well-known names on
+        disk, so that other processes do not need to introspect them again.
+        Cached data is discarded when the owner of the name changes.
+
+        @param cache: A L{introspection.DiskCache}, or the directory for
+                      one. Defaults to C{~/.cache/dbuspy/introspection}
+        @param version_properties: C{dict} mapping bus names to the (path,
+                                   interface, property) of a property whose
+                                   value is added to the cache key, eg. the
+                                   C{Version} of systemd's Manager
+        """
+        from .introspection import DiskCache
+        if not isinstance(cache, DiskCache):
+            cache = DiskCache(cache)
+        self.obj_handler.disk_cache = cache
+        if version_properties:
+            self.obj_handler.version_properties.update(version_properties)
+        return cache
+
+    def add_signal_receiver(self, callback, interface=None, member=None,
+                            path=None, path_namespace=None, sender=None,
+                            arg0=None,
+                            maxsize=signals.DEFAULT_QUEUE_SIZE,
+                            overflow=signals.DROP_OLDEST,
+                            coalesce_key=None):
+        """
+        Subscribes to signals matching the given match rule keys. Matching
+        signals are buffered in a bounded per-subscription queue and passed
+        to C{callback} from a dedicated greenlet, so a slow callback never
+        holds up the connection reader unless C{overflow} is C{BLOCK}.
+
+        While a C{BLOCK} queue is full the client stops reading from the
+        connection, after dispatching the messages it already received. No
+        method reply is read in the meantime, so C{BLOCK} callbacks must not
+        make synchronous calls on the same client: the reply could only be
+        read once the callback returned.
 
-   
\ No newline at end of file
+        @param overflow: Queue overflow policy, one of
+                         L{signals.OVERFLOW_POLICIES}
+        @param coalesce_key: Key function for the C{COALESCE} policy
+
+        @rtype: L{signals.SignalSubscription}
+        """
+        queue = GreenSignalQueue(maxsize, overflow, coalesce_key)
+        sub = signals.SignalSubscription(
+            callback, queue,
+            interface=interface,
+            member=member,
+            path=path,
+            path_namespace=path_namespace,
+            sender=sender,
+            arg0=arg0,
+        )
+        self._add_match(sub.rule)
+        if (self.name_cache is not None and sender is not None and
+                sender[:1] != ':'):
+            # Resolve the owner now so that signals can be filtered by it
+            self.name_cache.get_owner(sender)
+        sub.greenlet = gevent.spawn(self._deliver_signals, sub)
+        self._signal_subscriptions = self._signal_subscriptions + (sub,)
+        return sub
+
+    def remove_signal_receiver(self, sub):
+        """
+        Cancels a subscription returned by L{add_signal_receiver}. Signals
+        still queued for it are discarded.
+        """
+        if sub not in self._signal_subscriptions:
+            return
+        self._signal_subscriptions = tuple(
+            s for s in self._signal_subscriptions if s is not sub)
+        sub.greenlet.kill(block=False)
+        sub.queue.clear()
+        self._remove_match(sub.rule)
+
+    def _add_match(self, rule):
+        self.call_remote(
+            '/org/freedesktop/DBus',
+            'AddMatch',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s',
+            args=[rule],
+        )
+
+    def _remove_match(self, rule):
+        self.call_remote(
+            '/org/freedesktop/DBus',
+            'RemoveMatch',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s',
+            args=[rule],
+        )
+
+    def signal_queue_stats(self):
+        """
+        Returns a list of (match rule, queue statistics) tuples, one per
+        signal subscription
+        """
+        return [(sub.rule, sub.queue.stats())
+                for sub in self._signal_subscriptions]
+
+    def read(self):
+        # Backpressure of BLOCK queues: stop reading until they have room,
+        # between reads so that no received message is held back
+        for sub in self._signal_subscriptions:
+            if sub.queue.policy == signals.BLOCK:
+                sub.queue.wait_space()
+        return ClientBase.read(self)
+
+    def on_signal_received(self, msig):
+        matched = False
+        owners = self.name_cache.owners if self.name_cache else None
+        for sub in self._signal_subscriptions:
+            if sub.matches(msig, owners):
+                matched = True
+                sub.queue.put(msig)
+        if self.metrics.enabled:
+            self.metrics.gauge(SIGNAL_QUEUE_DEPTH, sum(
+                len(sub.queue) for sub in self._signal_subscriptions))
+        if not matched:
+            ClientBase.on_signal_received(self, msig)
+
+    def _deliver_signals(self, sub):
+        while True:
+            msig = sub.queue.get_wait()
+            try:
+                sub.callback(msig)
+            except Exception:
+                logger.exception('Error in signal callback for %r', sub)
+
+    # -------------------------------------------------
+    # Exporting objects
+
+    def on_method_call_received(self, mcall):
+        if self._call_workers < self.max_concurrent_calls:
+            self._call_workers += 1
+            gevent.spawn(self._serve_calls, mcall)
+        elif len(self._call_backlog) < self.max_queued_calls:
+            self._call_backlog.append(mcall)
+        else:
+            self.obj_handler.send_error(
+                self, mcall, 'org.freedesktop.DBus.Error.LimitsExceeded',
+                'Too many method calls in progress')
+
+    def _serve_calls(self, mcall):
+        try:
+            while mcall is not None:
+                try:
+                    self.obj_handler.handle_method_call(mcall, self)
+                except Exception:
+                    logger.exception('Error handling method call %r', mcall)
+                backlog = self._call_backlog
+                mcall = backlog.popleft() if backlog else None
+        finally:
+            self._call_workers -= 1
+
+    def export_object(self, obj):
+        """
+        Makes a L{objects.DBusObject} callable over this connection
+        """
+        self.obj_handler.export_object(obj)
+
+    def unexport_object(self, object_path):
+        self.obj_handler.unexport_object(object_path)
+
+    def request_name(self, new_name, flags=NAME_FLAG_DO_NOT_QUEUE):
+        """
+        Requests a well-known bus name for this connection
+
+        @raises error.FailedToAcquireName: unless this connection becomes or
+                                           already is the primary owner
+        """
+        code = self.call_remote(
+            '/org/freedesktop/DBus',
+            'RequestName',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='su',
+            args=[new_name, flags],
+        )
+        if code not in (1, 4):
+            raise FailedToAcquireName(new_name, code)
+        return code
+
+    def release_name(self, name):
+        return self.call_remote(
+            '/org/freedesktop/DBus',
+            'ReleaseName',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s',
+            args=[name],
+        )
@@ -0,0 +1,336 @@
+"""
+Transport independent parts of a DBus connection: message framing, dispatch
+of parsed messages and conversion of replies.
+
+This module must not depend on gevent so that it can be shared by the gevent
+and asyncio client implementations.
+"""
+import itertools
+import logging
+import struct
+
+from .error import RemoteError
+from .metrics import NULL_METRICS, MARSHAL, UNMARSHAL, PENDING_CALLS, clock
+from .tracing import TraceHook, SEND, RECEIVE
+from . import marshal, message
+
+# Message directions of captures, as in the pcapng epb_flags option
+INBOUND = 1
+OUTBOUND = 2
+
+logger = logging.getLogger(__name__)
+
+
+MSG_HDR_LEN = 16  # including 4-byte padding for array of structure
+
+
+def hello_message(serial):
+    """
+    Builds the C{org.freedesktop.DBus.Hello} call every bus client sends
+    first
+    """
+    return message.MethodCallMessage(
+        '/org/freedesktop/DBus',
+        'Hello',
+        interface='org.freedesktop.DBus',
+        destination='org.freedesktop.DBus',
+        serial=serial,
+    )
+
+
+def make_remote_error(merr):
+    """
+    Converts a received L{message.ErrorMessage} into a L{RemoteError}
+    """
+    e = RemoteError(merr.error_name)
+    e.message = ''
+    e.values = []
+    if merr.body:
+        if isinstance(merr.body[0], marshal.string_types):
+            e.message = merr.body[0]
+        e.values = merr.body
+    return e
+
+
+class BaseConnection(object):
+    """
+    Base class for DBus connections. Subclasses provide the transport by
+    implementing C{write} and feeding received bytes to L{on_data_received}.
+
+    Method calls awaiting a reply are kept in C{_pending}, keyed by serial.
+    The values are futures supporting C{done()}, C{set_result()} and
+    C{set_exception()}, as provided by gevent, asyncio and
+    C{concurrent.futures}. Callers remove their entry when they stop
+    waiting, see L{forget_call}; replies without an entry are counted in
+    C{late_replies} and dropped.
+
+    @ivar metrics: L{metrics.MetricsSink} receiving the measurements of the
+                   connection. Nothing is measured unless it is enabled.
+    """
+    _firstByte = True
+    _unix_creds = None  # (pid, uid, gid) from UnixSocket credential passing
+    authenticator = None  # Class to handle DBus authentication
+    MAX_MSG_LENGTH = 2**27
+    metrics = NULL_METRICS
+    _trace_hooks = ()
+    _capture = None  # capture.PcapngWriter
+
+    guid = None  # Filled in with the GUID of the server (for client protocol)
+    # or the username of the authenticated client (for server protocol)
+
+    def __init__(self):
+        self._buffer = b''
+        self._receivedFDs = []
+        self._toBeSentFDs = []
+
+        self._nextMsgLen = 0
+        self._endian = '<'
+
+        self._serials = itertools.count(1)
+        self._pending = {}
+        self.late_replies = 0
+        # Serial to (interface, member, send time) of calls being measured
+        self._call_starts = {}
+
+    def next_serial(self):
+        """
+        Allocates the serial number for the next message sent on this
+        connection. Advancing an C{itertools.count} is atomic, so this may
+        be called from any thread.
+        """
+        return next(self._serials)
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def send_message(self, msg):
+        """
+        Writes a L{message.DBusMessage}, after passing it to the trace hooks
+        """
+        if self._trace_hooks:
+            self._trace(SEND, msg, len(msg.raw_message))
+        if self._capture is not None:
+            self._capture.write_message(OUTBOUND, msg.raw_message)
+        self.write(msg.raw_message)
+
+    def start_capture(self, f):
+        """
+        Records all messages sent or received from now on to a pcapng
+        capture, see L{capture}
+
+        @param f: Binary file object, or the path of a file to create
+        @rtype: L{capture.PcapngWriter}
+        """
+        from .capture import PcapngWriter
+        self.stop_capture()
+        self._capture = PcapngWriter(f)
+        return self._capture
+
+    def stop_capture(self):
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
+
+    # -------------------------------------------------
+    # Tracing
+
+    def add_trace_hook(self, callback, sample_rate=1.0, signals=True):
+        """
+        Registers a callback receiving a L{tracing.TraceEvent} for every
+        message sent before it is written, and for every message received
+        once it is parsed
+
+        @param sample_rate: Share of method calls and signals passed to the
+                            callback. Replies are passed if their call was.
+        @param signals: Pass signals to the callback
+        @rtype: L{tracing.TraceHook}
+        """
+        hook = TraceHook(callback, sample_rate, signals)
+        self._trace_hooks = self._trace_hooks + (hook,)
+        return hook
+
+    def remove_trace_hook(self, hook):
+        self._trace_hooks = tuple(h for h in self._trace_hooks
+                                  if h is not hook)
+
+    def _trace(self, direction, msg, size):
+        for hook in self._trace_hooks:
+            try:
+                hook.on_message(direction, msg, size)
+            except Exception:
+                logger.exception('Error in trace hook %r', hook)
+
+    def _call_sent(self, mcall_msg, started):
+        """
+        Records a method call about to be written, when metrics are enabled
+
+        @param started: L{metrics.clock} time before the message was built
+        """
+        now = clock()
+        self.metrics.time_spent(MARSHAL, now - started)
+        self._call_starts[mcall_msg.serial] = (
+            mcall_msg.interface, mcall_msg.member, now)
+        self.metrics.gauge(PENDING_CALLS, len(self._pending))
+
+    def _call_finished(self, serial, error):
+        """
+        Records the completion of a measured call. Does nothing for calls
+        already recorded, so callers giving up on a call may report it as
+        failed unconditionally.
+        """
+        start = self._call_starts.pop(serial, None)
+        if start is not None:
+            self.metrics.call_completed(start[0], start[1],
+                                        clock() - start[2], error)
+
+    def on_data_received(self, data):
+        """
+        Frames received bytes into messages and dispatches each complete
+        one. A message that fails to parse or dispatch is logged and
+        skipped, so that the messages behind it are still processed.
+        """
+        if data and self.metrics.enabled:
+            self.metrics.bytes_received(len(data))
+        self._buffer = self._buffer + data
+
+        while True:
+            buffer_len = len(self._buffer)
+
+            if self._nextMsgLen == 0:
+                if buffer_len < 16:
+                    return
+                # There would be multiple clients using different endians.
+                # Reset endian every time.
+                if self._buffer[:1] != b'l':
+                    self._endian = '>'
+                else:
+                    self._endian = '<'
+
+                body_len = struct.unpack(
+                    self._endian + 'I', self._buffer[4:8])[0]
+                harr_len = struct.unpack(
+                    self._endian + 'I', self._buffer[12:16])[0]
+
+                hlen = MSG_HDR_LEN + harr_len
+
+                padlen = hlen % 8 and (8 - hlen % 8) or 0
+
+                self._nextMsgLen = (
+                    MSG_HDR_LEN +
+                    harr_len +
+                    padlen +
+                    body_len
+                )
+
+            if buffer_len < self._nextMsgLen:
+                return
+
+            raw_msg = self._buffer[:self._nextMsgLen]
+            self._buffer = self._buffer[self._nextMsgLen:]
+            self._nextMsgLen = 0
+
+            try:
+                self.process_raw_dbus_message(raw_msg)
+            except Exception:
+                logger.exception('Error processing received message')
+
+    def process_raw_dbus_message(self, rawMsg):
+        """
+        Called when the raw bytes for a complete DBus message are received
+
+        @param rawMsg: Byte-string containing the complete message
+        @type rawMsg: C{str}
+        """
+        if self._capture is not None:
+            self._capture.write_message(INBOUND, rawMsg)
+        if self.metrics.enabled:
+            started = clock()
+            m = message.parse_message(rawMsg, self._receivedFDs)
+            self.metrics.time_spent(UNMARSHAL, clock() - started)
+        else:
+            m = message.parse_message(rawMsg, self._receivedFDs)
+        mt = m._message_type
+
+        self._receivedFDs = []
+
+        if self._trace_hooks:
+            self._trace(RECEIVE, m, len(rawMsg))
+
+        if mt == 1:
+            self.on_method_call_received(m)
+        elif mt == 2:
+            self.on_method_return_received(m)
+        elif mt == 3:
+            self.on_error_received(m)
+        elif mt == 4:
+            self.on_signal_received(m)
+
+    def _convert_reply(self, msg):
+        if msg is None:
+            return None
+
+        if msg.body is None or len(msg.body) == 0:
+            return None
+
+        if len(msg.body) == 1 and not msg.signature[0] == '(':
+            return msg.body[0]
+        else:
+            return msg.body
+
+    def on_method_call_received(self, mcall):
+        """
+        Called when a DBus METHOD_CALL message is received
+        """
+        raise NotImplementedError
+
+    def on_method_return_received(self, mret):
+        """
+        Called when a DBus METHOD_RETURN message is received
+        """
+        if self.metrics.enabled:
+            self._call_finished(mret.reply_serial, False)
+        fut = self._pending.pop(mret.reply_serial, None)
+        if fut is None:
+            self.late_replies += 1
+        elif not fut.done():
+            fut.set_result(self._convert_reply(mret))
+
+    def on_error_received(self, merr):
+        """
+        Called when a DBus ERROR message is received
+        """
+        if self.metrics.enabled:
+            self._call_finished(merr.reply_serial, True)
+        fut = self._pending.pop(merr.reply_serial, None)
+        if fut is None:
+            self.late_replies += 1
+        elif not fut.done():
+            fut.set_exception(make_remote_error(merr))
+
+    def _fail_pending(self, exc):
+        """
+        Fails all calls awaiting a reply, eg. when the connection is lost
+        """
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def forget_call(self, serial):
+        """
+        Gives up on a method call whose reply is not waited for any more,
+        eg. one sent with C{call_remote_async}. A reply arriving later is
+        counted in C{late_replies}. Does nothing for calls already
+        completed or forgotten.
+        """
+        self._pending.pop(serial, None)
+        self._call_finished(serial, True)
+
+    def on_signal_received(self, msig):
+        """
+        Called when a DBus SIGNAL message is received
+        """
+        logger.debug('Unhandled signal: %r', msig)
+
+    def on_connection_authenticated(self):
+        logger.debug('authenticated')
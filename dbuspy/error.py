@@ -23,6 +23,13 @@ class MarshallingError (DBusException):
     pass
 
 
+class ConnectionClosed (DBusException):
+    """
+    Raised for method calls that were pending when the connection was lost
+    """
+    pass
+
+
 class TimeOut (DBusException):
     """
     Used to indicate a timeout for remote DBus method calls that
@@ -0,0 +1,188 @@
+"""
+Definitions of DBus interfaces: their methods, signals and properties.
+
+These are used both to describe objects exported by dbuspy and to hold the
+parsed introspection data of remote objects.
+"""
+from . import marshal
+
+
+def quoteattr(s):
+    """
+    Quotes C{s} for use as an XML attribute value. Equivalent to
+    C{xml.sax.saxutils.quoteattr} for the names and signatures found in
+    introspection data, without the cost of importing C{xml.sax}.
+    """
+    return '"%s"' % (s.replace('&', '&amp;').replace('<', '&lt;')
+                     .replace('>', '&gt;').replace('"', '&quot;'),)
+
+
+class Method (object):
+    """
+    A DBus method
+
+    @ivar name: C{str} method name
+    @ivar sig_in: C{str} signature of the arguments
+    @ivar sig_out: C{str} signature of the return values
+    @ivar nargs: Number of complete types in C{sig_in}
+    @ivar nret: Number of complete types in C{sig_out}
+    """
+
+    def __init__(self, name, arguments='', returns='',
+                 arg_names=None, ret_names=None):
+        marshal.validate_member_name(name)
+
+        self.name = name
+        self.sig_in = arguments
+        self.sig_out = returns
+        self.nargs = len(marshal.complete_types(arguments))
+        self.nret = len(marshal.complete_types(returns))
+        self.arg_names = arg_names
+        self.ret_names = ret_names
+
+    def __repr__(self):
+        return '<Method %s(%s) -> (%s)>' % (
+            self.name, self.sig_in, self.sig_out)
+
+
+class Signal (object):
+    """
+    A DBus signal
+
+    @ivar name: C{str} signal name
+    @ivar sig: C{str} signature of the signal arguments
+    """
+
+    def __init__(self, name, arguments='', arg_names=None):
+        marshal.validate_member_name(name)
+
+        self.name = name
+        self.sig = arguments
+        self.nargs = len(marshal.complete_types(arguments))
+        self.arg_names = arg_names
+
+    def __repr__(self):
+        return '<Signal %s(%s)>' % (self.name, self.sig)
+
+
+class Property (object):
+    """
+    A DBus property
+
+    @ivar name: C{str} property name
+    @ivar sig: C{str} signature of the property value
+    @ivar access: 'read', 'write' or 'readwrite'
+    @ivar emits_change: True if changes are announced with
+                        C{PropertiesChanged}. May also be 'invalidates' or
+                        'const', as in the
+                        C{org.freedesktop.DBus.Property.EmitsChangedSignal}
+                        annotation
+    @ivar attr: Name of the attribute of exported objects holding the value.
+                Defaults to C{name}
+    """
+
+    def __init__(self, name, sig, access='read', emits_change=True,
+                 attr=None):
+        if access not in ('read', 'write', 'readwrite'):
+            raise ValueError('Invalid property access: %r' % (access,))
+
+        self.name = name
+        self.sig = sig
+        self.access = access
+        self.emits_change = emits_change
+        self.attr = attr or name
+
+    def __repr__(self):
+        return '<Property %s %s (%s)>' % (self.name, self.sig, self.access)
+
+    @property
+    def readable(self):
+        return self.access != 'write'
+
+    @property
+    def writeable(self):
+        return self.access != 'read'
+
+
+class DBusInterface (object):
+    """
+    A DBus interface: a named collection of methods, signals and properties
+
+    @ivar methods: C{dict} of method name to L{Method}
+    @ivar signals: C{dict} of signal name to L{Signal}
+    @ivar properties: C{dict} of property name to L{Property}
+    """
+
+    def __init__(self, name, *members):
+        marshal.validate_interface_name(name)
+
+        self.name = name
+        self.methods = {}
+        self.signals = {}
+        self.properties = {}
+
+        for m in members:
+            self.add(m)
+
+        self._xml = None
+
+    def __repr__(self):
+        return '<DBusInterface %s>' % (self.name,)
+
+    def add(self, member):
+        if isinstance(member, Method):
+            self.methods[member.name] = member
+        elif isinstance(member, Signal):
+            self.signals[member.name] = member
+        elif isinstance(member, Property):
+            self.properties[member.name] = member
+        else:
+            raise TypeError('Invalid interface member: %r' % (member,))
+        self._xml = None
+
+    def introspection_xml(self):
+        """
+        Returns the C{<interface>} element describing this interface
+        """
+        if self._xml is None:
+            self._xml = ''.join(self._gen_xml())
+        return self._xml
+
+    def _gen_xml(self):
+        yield '  <interface name=%s>\n' % quoteattr(self.name)
+
+        for m in self.methods.values():
+            yield '    <method name=%s>\n' % quoteattr(m.name)
+            for d, sig, names in (('in', m.sig_in, m.arg_names),
+                                  ('out', m.sig_out, m.ret_names)):
+                for i, ct in enumerate(marshal.complete_types(sig)):
+                    yield '      <arg %stype=%s direction="%s"/>\n' % (
+                        _name_attr(names, i), quoteattr(ct), d)
+            yield '    </method>\n'
+
+        for s in self.signals.values():
+            yield '    <signal name=%s>\n' % quoteattr(s.name)
+            for i, ct in enumerate(marshal.complete_types(s.sig)):
+                yield '      <arg %stype=%s/>\n' % (
+                    _name_attr(s.arg_names, i), quoteattr(ct))
+            yield '    </signal>\n'
+
+        for p in self.properties.values():
+            yield '    <property name=%s type=%s access="%s"' % (
+                quoteattr(p.name), quoteattr(p.sig), p.access)
+            if p.emits_change is True:
+                yield '/>\n'
+            else:
+                yield '>\n'
+                yield ('      <annotation name="org.freedesktop.DBus.Property.'
+                       'EmitsChangedSignal" value="%s"/>\n' % (
+                           p.emits_change or 'false'))
+                yield '    </property>\n'
+
+        yield '  </interface>\n'
+
+
+def _name_attr(names, i):
+    if names and i < len(names) and names[i]:
+        return 'name=%s ' % quoteattr(names[i])
+    return ''
@@ -0,0 +1,287 @@
+"""
+Parsing of DBus introspection data.
+
+L{parse_introspection_xml} turns the XML returned by
+C{org.freedesktop.DBus.Introspectable.Introspect} into
+L{interface.DBusInterface} objects. Parsed interfaces are kept in a
+process-wide cache keyed by interface name: interface names are meant to be
+globally unique, so every object implementing, say,
+C{org.freedesktop.systemd1.Unit} shares a single definition.
+
+L{DiskCache} additionally keeps parsed introspection data on disk across
+process restarts.
+"""
+import atexit
+import functools
+import logging
+import os
+import time
+import weakref
+
+from .error import IntrospectionFailed
+from .interface import DBusInterface, Method, Signal, Property
+
+logger = logging.getLogger(__name__)
+
+_EMITS_CHANGE_ANNOTATION = 'org.freedesktop.DBus.Property.EmitsChangedSignal'
+
+_interface_cache = {}
+
+
+def get_cached_interface(name):
+    """
+    Returns the parsed L{DBusInterface} called C{name}, or None if no
+    introspection data for it has been parsed yet
+    """
+    return _interface_cache.get(name)
+
+
+def clear_interface_cache():
+    _interface_cache.clear()
+
+
+def parse_introspection_xml(xml):
+    """
+    Parses introspection data
+
+    @returns: (list of L{DBusInterface}, list of child node names)
+    @raises IntrospectionFailed: if C{xml} is not valid introspection data
+    """
+    # Imported here so that importing dbuspy does not load the XML parser
+    from xml.etree import ElementTree
+
+    if not isinstance(xml, bytes):
+        xml = xml.encode('utf-8')
+    try:
+        root = ElementTree.fromstring(xml)
+    except ElementTree.ParseError as e:
+        raise IntrospectionFailed('Invalid introspection XML: %s' % (e,))
+    if root.tag != 'node':
+        raise IntrospectionFailed('Introspection data must start with <node>')
+
+    interfaces = []
+    for elem in root.findall('interface'):
+        name = elem.get('name')
+        iface = _interface_cache.get(name)
+        if iface is None:
+            iface = _parse_interface(elem)
+            _interface_cache[name] = iface
+        interfaces.append(iface)
+
+    children = [n.get('name') for n in root.findall('node') if n.get('name')]
+
+    return interfaces, children
+
+
+def _parse_interface(elem):
+    try:
+        iface = DBusInterface(elem.get('name'))
+
+        for m in elem.findall('method'):
+            sig_in, sig_out, names_in, names_out = [], [], [], []
+            for arg in m.findall('arg'):
+                if arg.get('direction', 'in') == 'in':
+                    sig_in.append(arg.get('type'))
+                    names_in.append(arg.get('name'))
+                else:
+                    sig_out.append(arg.get('type'))
+                    names_out.append(arg.get('name'))
+            iface.add(Method(m.get('name'), ''.join(sig_in), ''.join(sig_out),
+                             names_in, names_out))
+
+        for s in elem.findall('signal'):
+            args = s.findall('arg')
+            iface.add(Signal(s.get('name'),
+                             ''.join(a.get('type') for a in args),
+                             [a.get('name') for a in args]))
+
+        for p in elem.findall('property'):
+            emits_change = True
+            for a in p.findall('annotation'):
+                if a.get('name') == _EMITS_CHANGE_ANNOTATION:
+                    value = a.get('value')
+                    emits_change = True if value == 'true' else (
+                        value if value in ('invalidates', 'const') else False)
+            iface.add(Property(p.get('name'), p.get('type'),
+                               p.get('access', 'read'), emits_change))
+    except Exception as e:
+        raise IntrospectionFailed('Invalid introspection data for %s: %s' % (
+            elem.get('name'), e))
+
+    return iface
+
+
+def _register(iface):
+    """
+    Returns the cached interface of the same name if there is one, else
+    caches C{iface}
+    """
+    return _interface_cache.setdefault(iface.name, iface)
+
+
+def forget_interfaces(names):
+    """
+    Drops interfaces from the process-wide cache, eg. because the service
+    defining them was restarted and may have been upgraded
+    """
+    for name in names:
+        _interface_cache.pop(name, None)
+
+
+def interface_to_dict(iface):
+    """
+    Returns a JSON serializable description of a L{DBusInterface}
+    """
+    return {
+        'methods': [[m.name, m.sig_in, m.sig_out, m.arg_names, m.ret_names]
+                    for m in iface.methods.values()],
+        'signals': [[s.name, s.sig, s.arg_names]
+                    for s in iface.signals.values()],
+        'properties': [[p.name, p.sig, p.access, p.emits_change]
+                       for p in iface.properties.values()],
+    }
+
+
+def interface_from_dict(name, d):
+    iface = DBusInterface(name)
+    for args in d['methods']:
+        iface.add(Method(*args))
+    for args in d['signals']:
+        iface.add(Signal(*args))
+    for args in d['properties']:
+        iface.add(Property(*args))
+    return iface
+
+
+class DiskCache (object):
+    """
+    On-disk cache of introspection data, so that new processes do not have
+    to introspect the objects of long running services again.
+
+    There is one JSON file per well-known bus name. It records the
+    interfaces of every object path seen and the identity of the name owner
+    the data was obtained from: the bus id, the owner's unique name and,
+    optionally, a version property of the service. Data recorded for
+    another identity is ignored.
+
+    Writes are batched: the file is rewritten at most once every
+    C{flush_interval} seconds, on L{close} and at interpreter exit.
+
+    @ivar directory: Directory holding the cache files
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        if directory is None:
+            directory = os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or
+                os.path.expanduser('~/.cache'),
+                'dbuspy', 'introspection')
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._entries = {}
+        self._dirty = set()
+        self._last_flush = 0
+        # Through a weak reference, so that the exit hook does not keep the
+        # cache alive
+        self._atexit = functools.partial(_flush_at_exit, weakref.ref(self))
+        atexit.register(self._atexit)
+
+    def _path(self, busname):
+        return os.path.join(self.directory, busname + '.json')
+
+    def _load(self, busname):
+        try:
+            return self._entries[busname]
+        except KeyError:
+            pass
+        import json
+        try:
+            with open(self._path(busname)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            entry = None
+        self._entries[busname] = entry
+        return entry
+
+    def get(self, busname, identity, object_path):
+        """
+        Returns the cached L{DBusInterface} list of an object, or None
+        """
+        entry = self._load(busname)
+        if entry is None or entry.get('identity') != list(identity):
+            return None
+        names = entry['objects'].get(object_path)
+        if names is None:
+            return None
+        try:
+            return [get_cached_interface(n) or
+                    _register(interface_from_dict(n, entry['interfaces'][n]))
+                    for n in names]
+        except Exception as e:
+            logger.warning('Ignoring corrupt introspection cache for %s: %r',
+                           busname, e)
+            self.invalidate(busname)
+            return None
+
+    def put(self, busname, identity, object_path, interfaces):
+        entry = self._load(busname)
+        if entry is None or entry.get('identity') != list(identity):
+            entry = {'identity': list(identity), 'objects': {},
+                     'interfaces': {}}
+            self._entries[busname] = entry
+        entry['objects'][object_path] = [i.name for i in interfaces]
+        for iface in interfaces:
+            if iface.name not in entry['interfaces']:
+                entry['interfaces'][iface.name] = interface_to_dict(iface)
+
+        self._dirty.add(busname)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def invalidate(self, busname):
+        """
+        Forgets everything recorded for C{busname}
+        """
+        self._entries.pop(busname, None)
+        self._dirty.discard(busname)
+        try:
+            os.unlink(self._path(busname))
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Writes modified entries to disk and removes the exit hook
+        """
+        atexit.unregister(self._atexit)
+        self.flush()
+
+    def flush(self):
+        """
+        Writes modified entries to disk
+        """
+        import json
+        self._last_flush = time.time()
+        dirty, self._dirty = self._dirty, set()
+        for busname in dirty:
+            entry = self._entries.get(busname)
+            if entry is None:
+                continue
+            path = self._path(busname)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                with open(tmp, 'w') as f:
+                    json.dump(entry, f)
+                # Atomic, so concurrent readers never see a partial file
+                os.rename(tmp, path)
+            except (IOError, OSError) as e:
+                logger.warning('Failed to write introspection cache %s: %r',
+                               path, e)
+
+
+def _flush_at_exit(ref):
+    cache = ref()
+    if cache is not None:
+        cache.flush()
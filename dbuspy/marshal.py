@@ -5,19 +5,32 @@ Provides data marshalling to and from the DBus wire format
 """
 
 import codecs
-import re
 import struct
 
-import six
-
 from .error import MarshallingError
 
 
-invalid_obj_path_re = re.compile('[^a-zA-Z0-9_/]')
-if_re = re.compile('[^A-Za-z0-9_.]')
-bus_re = re.compile('[^A-Za-z0-9_.\-:]')
-mbr_re = re.compile('[^A-Za-z0-9_]')
-dot_digit_re = re.compile('\.\d')
+if str is bytes:  # Python 2
+    string_types = (basestring,)  # noqa: F821
+    integer_types = (int, long)  # noqa: F821
+else:
+    string_types = (str,)
+    integer_types = (int,)
+
+# Character sets of the name validators. Plain sets keep the module free of
+# the re import and regex compilation at startup.
+_mbr_chars = frozenset(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_')
+_obj_path_chars = _mbr_chars | frozenset('/')
+_if_chars = _mbr_chars | frozenset('.')
+_bus_chars = _if_chars | frozenset('-:')
+
+
+def _has_dot_digit(n):
+    """
+    True if any component after the first begins with a digit
+    """
+    return any(c[:1].isdigit() for c in n.split('.')[1:])
 
 
 #                Name      Type code   Alignment
@@ -121,6 +134,40 @@ class ObjectPath (str):
     debus_signature = 'o'
 
 
+class Array (list):
+    """
+    List marshalled as a variant with an explicit signature, see
+    L{wrap_variant}
+    """
+
+    def __init__(self, value, debus_signature):
+        list.__init__(self, value)
+        self.debus_signature = debus_signature
+
+
+class Dictionary (dict):
+    """
+    Dictionary marshalled as a variant with an explicit signature, see
+    L{wrap_variant}
+    """
+
+    def __init__(self, value, debus_signature):
+        dict.__init__(self, value)
+        self.debus_signature = debus_signature
+
+
+class Struct (tuple):
+    """
+    Tuple marshalled as a variant with an explicit signature, see
+    L{wrap_variant}
+    """
+
+    def __new__(cls, value, debus_signature):
+        t = tuple.__new__(cls, value)
+        t.debus_signature = debus_signature
+        return t
+
+
 variantClassMap = {
     'y': Byte,
     'b': Boolean,
@@ -135,6 +182,25 @@ variantClassMap = {
 }
 
 
+def wrap_variant(sig, value):
+    """
+    Returns C{value} wrapped so that it is marshalled as a variant of type
+    C{sig} instead of the type guessed by L{sig_from_py}. Needed for values
+    such as unsigned integers or empty arrays whose DBus type can not be
+    inferred from the Python object.
+    """
+    cls = variantClassMap.get(sig)
+    if cls is not None:
+        return cls(value)
+    elif sig.startswith('a{'):
+        return Dictionary(value, sig)
+    elif sig.startswith('a'):
+        return Array(value, sig)
+    elif sig.startswith('('):
+        return Struct(value, sig)
+    return value
+
+
 def validate_object_path(p):
     """
     Ensures that the provided object path conforms to the DBus standard.
@@ -149,7 +215,7 @@ def validate_object_path(p):
         raise MarshallingError('Object paths may not end with "/"')
     if '//' in p:
         raise MarshallingError('"//" is not allowed in object paths"')
-    if invalid_obj_path_re.search(p):
+    if not _obj_path_chars.issuperset(p):
         raise MarshallingError('Invalid characters contained in object path')
 
 
@@ -172,10 +238,10 @@ def validate_interface_name(n):
             raise Exception('Names may not begin with a "."')
         if n[0].isdigit():
             raise Exception('Names may not begin with a digit')
-        if if_re.search(n):
+        if not _if_chars.issuperset(n):
             raise Exception(
                 'Names contains a character outside the set [A-Za-z0-9_.]')
-        if dot_digit_re.search(n):
+        if _has_dot_digit(n):
             raise Exception(
                 'No components of an interface name may begin with a digit')
     except Exception as e:
@@ -208,10 +274,10 @@ def validate_bus_name(n):
             raise Exception('Names may not begin with a "."')
         if n[0].isdigit():
             raise Exception('Names may not begin with a digit')
-        if bus_re.search(n):
+        if not _bus_chars.issuperset(n):
             raise Exception(
                 'Names contains a character outside the set [A-Za-z0-9_.\-:]')
-        if not n[0] == ':' and dot_digit_re.search(n):
+        if not n[0] == ':' and _has_dot_digit(n):
             raise Exception(
                 'No coponents of an interface name may begin with a digit')
     except Exception as e:
@@ -233,7 +299,7 @@ def validate_member_name(n):
             raise Exception('Name exceeds maximum length of 255')
         if n[0].isdigit():
             raise Exception('Names may not begin with a digit')
-        if mbr_re.search(n):
+        if not _mbr_chars.issuperset(n):
             raise Exception(
                 'Names contains a character outside the set [A-Za-z0-9_]')
     except Exception as e:
@@ -262,11 +328,11 @@ def sig_from_py(pobj):
         return 'b'
     elif isinstance(pobj, int):
         return 'i'
-    elif isinstance(pobj, six.integer_types):
+    elif isinstance(pobj, integer_types):
         return 'x'
     elif isinstance(pobj, float):
         return 'd'
-    elif isinstance(pobj, six.string_types):
+    elif isinstance(pobj, string_types):
         return 's'
     elif isinstance(pobj, bytearray):
         return 'ay'
@@ -288,7 +354,7 @@ def sig_from_py(pobj):
     elif isinstance(pobj, dict):
         same = True
         vtype = None
-        for k, v in six.iteritems(pobj):
+        for k, v in pobj.items():
             if vtype is None:
                 vtype = type(v)
             elif not isinstance(v, vtype):
@@ -375,7 +441,7 @@ def gen_complete_types(compoundSig):
 
         elif c == 'a':
             g = gen_complete_types(compoundSig[i + 1:])
-            ct = six.next(g)
+            ct = next(g)
             i += len(ct)
             yield 'a' + ct
 
@@ -384,6 +450,30 @@ def gen_complete_types(compoundSig):
         i += 1
 
 
+_complete_types_cache = {}
+_COMPLETE_TYPES_CACHE_SIZE = 4096
+
+
+def complete_types(compoundSig):
+    """
+    Returns a tuple of the complete, top-level types in a signature, as
+    produced by L{gen_complete_types}. Results are cached because the same
+    few signatures are (un)marshalled over and over again.
+    """
+    try:
+        return _complete_types_cache[compoundSig]
+    except KeyError:
+        pass
+
+    cts = tuple(gen_complete_types(compoundSig))
+
+    if len(_complete_types_cache) >= _COMPLETE_TYPES_CACHE_SIZE:
+        _complete_types_cache.clear()
+    _complete_types_cache[compoundSig] = cts
+
+    return cts
+
+
 # ------------------------------------------------------------------------
 #                          Marshalling Functions
 # General:
@@ -467,7 +557,7 @@ def marshal_unix_fd(ct, var, start_byte, lendian, oobFDs):
 #       3 - terminating nul byte
 #
 def marshal_string(ct, var, start_byte, lendian, oobFDs):
-    if not isinstance(var, six.string_types):
+    if not isinstance(var, string_types):
         raise MarshallingError('Required string. Received: ' + repr(var))
     if var.find('\0') != -1:
         raise MarshallingError(
@@ -524,7 +614,7 @@ def marshal_array(ct, var, start_byte, lendian, oobFDs):
     if isinstance(var, (list, tuple, bytearray)):
         arr_list = var
     elif isinstance(var, dict):
-        arr_list = [tpl for tpl in six.iteritems(var)]
+        arr_list = list(var.items())
     else:
         raise MarshallingError(
             'List, Tuple, Bytearray, or Dictionary required for DBus array. '
@@ -649,30 +739,8 @@ def marshal(compoundSignature, variableList,
 
     @returns: (number_of_encoded_bytes, list_of_binary_strings)
     """
-    chunks = []
-    bstart = startByte
-
-    if hasattr(variableList, 'dbusOrder'):
-        order = getattr(variableList, 'dbusOrder')
-        variableList = [getattr(variableList, attr_name)
-                        for attr_name in order]
-
-    for ct, var in zip(gen_complete_types(compoundSignature), variableList):
-        tcode = ct[0]
-        padding = pad[tcode](startByte)
-
-        if padding:
-            startByte += len(padding)
-            chunks.append(padding)
-
-        nbytes, vchunks = marshallers[tcode](
-            ct, var, startByte, lendian, oobFDs)
-
-        startByte += nbytes
-
-        chunks.extend(vchunks)
-
-    return startByte - bstart, chunks
+    return compile_signature(compoundSignature).marshal(
+        variableList, startByte, lendian, oobFDs)
 
 
 # ------------------------------------------------------------------------
@@ -874,16 +942,243 @@ def unmarshal(compoundSignature, data, offset=0, lendian=True, oobFDs=None):
 
     @returns: (number_of_bytes_decoded, list_of_values)
     """
-    values = []
-    start_offset = offset
+    return compile_signature(compoundSignature).unmarshal(
+        data, offset, lendian, oobFDs)
 
-    for ct in gen_complete_types(compoundSignature):
-        tcode = ct[0]
-        offset += len(pad[tcode](offset))
 
-        nbytes, value = unmarshallers[tcode](ct, data, offset, lendian, oobFDs)
+# ------------------------------------------------------------------------
+#                            Compiled Codecs
+#
+# The functions above look up the marshaller, padding and complete types of
+# every value by type code. A Codec does these lookups once per signature:
+# it holds, for each complete type, its alignment and a pair of functions
+# specialised for it. Codecs are cached by signature.
+
+_FIXED_FORMATS = {
+    'y': 'B',
+    'n': 'h',
+    'q': 'H',
+    'i': 'i',
+    'u': 'I',
+    'x': 'q',
+    't': 'Q',
+    'd': 'd',
+}
 
-        offset += nbytes
-        values.append(value)
+_alignments = dict((tcode, align) for name, tcode, align in dbus_types)
 
-    return offset - start_offset, values
+
+def _compile_fixed(tcode):
+    le = struct.Struct('<' + _FIXED_FORMATS[tcode])
+    be = struct.Struct('>' + _FIXED_FORMATS[tcode])
+    size = le.size
+    le_pack, be_pack = le.pack, be.pack
+    le_unpack, be_unpack = le.unpack_from, be.unpack_from
+
+    def m(var, start_byte, lendian, oobFDs):
+        return size, [le_pack(var) if lendian else be_pack(var)]
+
+    def u(data, offset, lendian, oobFDs):
+        return size, (le_unpack if lendian else be_unpack)(data, offset)[0]
+
+    return m, u
+
+
+def _compile_string(tcode):
+    le_len, be_len = struct.Struct('<I'), struct.Struct('>I')
+    validate = validate_object_path if tcode == 'o' else None
+
+    def m(var, start_byte, lendian, oobFDs):
+        if not isinstance(var, string_types):
+            raise MarshallingError('Required string. Received: ' + repr(var))
+        if validate is not None:
+            validate(var)
+        elif '\0' in var:
+            raise MarshallingError(
+                'Embedded nul characters are not allowed within DBus '
+                'strings')
+        var = var.encode('utf-8')
+        n = len(var)
+        return 5 + n, [(le_len if lendian else be_len).pack(n), var, b'\0']
+
+    def u(data, offset, lendian, oobFDs):
+        slen = (le_len if lendian else be_len).unpack_from(data, offset)[0]
+        offset += 4
+        return 5 + slen, data[offset:offset + slen].decode('utf-8')
+
+    return m, u
+
+
+def _compile_array(ct):
+    tsig = ct[1:]
+    align, em, eu = _compile_type(tsig)
+    is_dict = tsig[0] == '{'
+    is_bytes = tsig == 'y'
+    le_len, be_len = struct.Struct('<I'), struct.Struct('>I')
+
+    def m(var, start_byte, lendian, oobFDs):
+        if isinstance(var, (list, tuple, bytearray)):
+            arr_list = var
+        elif isinstance(var, dict):
+            arr_list = list(var.items())
+        else:
+            raise MarshallingError(
+                'List, Tuple, Bytearray, or Dictionary required for DBus '
+                'array.  Received: ' + repr(var)
+            )
+
+        chunks = [None]
+        start_byte += 4  # for array size
+        initial = -start_byte % align
+        if initial:
+            chunks.append(padding[initial])
+            start_byte += initial
+        data_start = start_byte
+
+        for item in arr_list:
+            p = -start_byte % align
+            if p:
+                chunks.append(padding[p])
+                start_byte += p
+            nbytes, vchunks = em(item, start_byte, lendian, oobFDs)
+            start_byte += nbytes
+            chunks.extend(vchunks)
+
+        data_len = start_byte - data_start
+        chunks[0] = (le_len if lendian else be_len).pack(data_len)
+        return 4 + initial + data_len, chunks
+
+    def u(data, offset, lendian, oobFDs):
+        start_offset = offset
+        data_len = (le_len if lendian else be_len).unpack_from(
+            data, offset)[0]
+        offset += 4
+        offset += -offset % align
+        end_offset = offset + data_len
+
+        if is_bytes:
+            values = list(bytearray(data[offset:end_offset]))
+            if len(values) != data_len:
+                raise MarshallingError('Invalid array encoding')
+            return end_offset - start_offset, values
+
+        values = []
+        while offset < end_offset:
+            offset += -offset % align
+            nbytes, value = eu(data, offset, lendian, oobFDs)
+            offset += nbytes
+            values.append(value)
+
+        if not offset == end_offset:
+            raise MarshallingError('Invalid array encoding')
+
+        if is_dict:
+            values = dict((item[0], item[1]) for item in values)
+
+        return offset - start_offset, values
+
+    return m, u
+
+
+def _compile_type(ct):
+    """
+    Returns (alignment, marshaller, unmarshaller) for a complete type. The
+    functions take (var, start_byte, lendian, oobFDs) and (data, offset,
+    lendian, oobFDs) and return the same as the module level ones.
+    """
+    tcode = ct[0]
+    if tcode in _FIXED_FORMATS:
+        m, u = _compile_fixed(tcode)
+    elif tcode in 'so':
+        m, u = _compile_string(tcode)
+    elif tcode == 'a':
+        m, u = _compile_array(ct)
+    elif tcode in '({':
+        codec = compile_signature(ct[1:-1])
+        m, u = codec.marshal, codec.unmarshal
+    else:
+        generic_m = marshallers[tcode]
+        generic_u = unmarshallers[tcode]
+
+        def m(var, start_byte, lendian, oobFDs):
+            return generic_m(ct, var, start_byte, lendian, oobFDs)
+
+        def u(data, offset, lendian, oobFDs):
+            return generic_u(ct, data, offset, lendian, oobFDs)
+
+    return _alignments[tcode], m, u
+
+
+class Codec (object):
+    """
+    Marshaller and unmarshaller compiled for a signature, see
+    L{compile_signature}
+
+    @ivar signature: C{str} DBus signature
+    """
+
+    def __init__(self, signature):
+        self.signature = signature
+        self._types = tuple(_compile_type(ct)
+                            for ct in complete_types(signature))
+
+    def __repr__(self):
+        return '<Codec %r>' % (self.signature,)
+
+    def marshal(self, variableList, startByte=0, lendian=True, oobFDs=None):
+        """
+        Same as the module level L{marshal} for this signature
+        """
+        if hasattr(variableList, 'dbusOrder'):
+            order = getattr(variableList, 'dbusOrder')
+            variableList = [getattr(variableList, attr_name)
+                            for attr_name in order]
+
+        chunks = []
+        start = startByte
+        for (align, m, u), var in zip(self._types, variableList):
+            p = -start % align
+            if p:
+                chunks.append(padding[p])
+                start += p
+            nbytes, vchunks = m(var, start, lendian, oobFDs)
+            start += nbytes
+            chunks.extend(vchunks)
+
+        return start - startByte, chunks
+
+    def unmarshal(self, data, offset=0, lendian=True, oobFDs=None):
+        """
+        Same as the module level L{unmarshal} for this signature
+        """
+        values = []
+        start_offset = offset
+        for align, m, u in self._types:
+            offset += -offset % align
+            nbytes, value = u(data, offset, lendian, oobFDs)
+            offset += nbytes
+            values.append(value)
+
+        return offset - start_offset, values
+
+
+_codec_cache = {}
+_CODEC_CACHE_SIZE = 4096
+
+
+def compile_signature(compoundSig):
+    """
+    Returns the cached L{Codec} for a signature, compiling it on first use
+    """
+    try:
+        return _codec_cache[compoundSig]
+    except KeyError:
+        pass
+
+    codec = Codec(compoundSig)
+
+    if len(_codec_cache) >= _CODEC_CACHE_SIZE:
+        _codec_cache.clear()
+    _codec_cache[compoundSig] = codec
+
+    return codec
@@ -3,19 +3,34 @@ Module to represent DBus Messages
 
 @author: Tom Cocagne
 """
+import itertools
+import threading
+
 from . import error, marshal
 
 
 _headerFormat = 'yyyyuua(yv)'
 
+_serial_lock = threading.Lock()
+_serials = itertools.count(1)
+
+
+def _next_serial():
+    """
+    Allocates a serial from the process-wide counter. Only used for messages
+    created without an explicit serial; connections allocate their own.
+    """
+    with _serial_lock:
+        return next(_serials)
+
 
 class DBusMessage (object):
     """
     Abstract base class for DBus messages
 
-    @ivar _messageType: C{int} DBus message type
-    @ivar expectReply: True if a method return message is expected
-    @ivar autoStart: True if a service should be auto started by this message
+    @ivar _message_type: C{int} DBus message type
+    @ivar expect_reply: True if a method return message is expected
+    @ivar auto_start: True if a service should be auto started by this message
     @ivar signature: C{str} DBus signature describing the body content
     @ivar endian: C{int} containing endian code: Little endian = ord('l'). Big
                   endian is ord('B'). Defaults to little-endian
@@ -31,7 +46,6 @@ class DBusMessage (object):
 
     """
     _max_msg_len = 2**27
-    _next_serial = 1
     _protocol_version = 1
 
     # Overriden by subclasses
@@ -124,9 +138,7 @@ class DBusMessage (object):
         self.body_length = len(bin_body)
 
         if newSerial:
-            self.serial = DBusMessage._next_serial
-
-            DBusMessage._next_serial += 1
+            self.serial = _next_serial()
 
         binHeader = b''.join(marshal.marshal(
             _headerFormat,
@@ -173,7 +185,7 @@ class MethodCallMessage (DBusMessage):
 
     def __init__(self, path, member, interface=None, destination=None,
                  signature=None, body=None,
-                 expectReply=True, autoStart=True, oobFDs=None):
+                 expectReply=True, autoStart=True, oobFDs=None, serial=None):
         """
         @param path: C{str} DBus object path
         @param member: C{str} Member name
@@ -188,6 +200,8 @@ class MethodCallMessage (DBusMessage):
                             in reply to this message
         @param autoStart: True if the Bus should auto-start a service to handle
                           this message if the service is not already running.
+        @param serial: C{int} serial number allocated by the sending
+                       connection, or None to use a process-wide counter
         """
 
         marshal.validate_member_name(member)
@@ -208,18 +222,19 @@ class MethodCallMessage (DBusMessage):
         self.destination = destination
         self.signature = signature
         self.body = body
-        self.expectReply = expectReply
-        self.autoStart = autoStart
+        self.expect_reply = expectReply
+        self.auto_start = autoStart
 
-        self._marshal(oobFDs=oobFDs)
+        self.serial = serial
+        self._marshal(newSerial=serial is None, oobFDs=oobFDs)
 
 
 class MethodReturnMessage (DBusMessage):
     """
     A DBus Method Return Message
     """
-    _messageType = 2
-    _headerAttrs = [
+    _message_type = 2
+    _header_attrs = [
         ('reply_serial', 5, True),
         ('destination', 6, False),
         ('sender', 7, False),
@@ -227,7 +242,7 @@ class MethodReturnMessage (DBusMessage):
     ]
 
     def __init__(self, reply_serial, body=None, destination=None,
-                 signature=None):
+                 signature=None, serial=None):
         """
         @param reply_serial: C{int} serial number this message is a reply to
         @param destination: C{str} DBus bus name for message destination or
@@ -236,6 +251,8 @@ class MethodReturnMessage (DBusMessage):
                           C{self.body}
         @param body: C{list} of python objects to encode. Objects must match
                      the C{self.signature}
+        @param serial: C{int} serial number allocated by the sending
+                       connection, or None to use a process-wide counter
         """
         if destination:
             marshal.validate_bus_name(destination)
@@ -244,16 +261,17 @@ class MethodReturnMessage (DBusMessage):
         self.destination = destination
         self.signature = signature
         self.body = body
+        self.serial = serial
 
-        self._marshal()
+        self._marshal(newSerial=serial is None)
 
 
 class ErrorMessage (DBusMessage):
     """
     A DBus Error Message
     """
-    _messageType = 3
-    _headerAttrs = [
+    _message_type = 3
+    _header_attrs = [
         ('error_name', 4, True),
         ('reply_serial', 5, True),
         ('destination', 6, False),
@@ -262,7 +280,7 @@ class ErrorMessage (DBusMessage):
     ]
 
     def __init__(self, error_name, reply_serial, destination=None,
-                 signature=None, body=None, sender=None):
+                 signature=None, body=None, sender=None, serial=None):
         """
         @param error_name: C{str} DBus error name
         @param reply_serial: C{int} serial number this message is a reply to
@@ -273,6 +291,8 @@ class ErrorMessage (DBusMessage):
         @param body: C{list} of python objects to encode. Objects must match
                      the C{self.signature}
         @param sender: C{str} name of the originating Bus connection
+        @param serial: C{int} serial number allocated by the sending
+                       connection, or None to use a process-wide counter
         """
         if destination:
             marshal.validate_bus_name(destination)
@@ -285,16 +305,17 @@ class ErrorMessage (DBusMessage):
         self.signature = signature
         self.body = body
         self.sender = sender
+        self.serial = serial
 
-        self._marshal()
+        self._marshal(newSerial=serial is None)
 
 
 class SignalMessage (DBusMessage):
     """
     A DBus Signal Message
     """
-    _messageType = 4
-    _headerAttrs = [
+    _message_type = 4
+    _header_attrs = [
         ('path', 1, True),
         ('interface', 2, True),
         ('member', 3, True),
@@ -304,7 +325,7 @@ class SignalMessage (DBusMessage):
     ]
 
     def __init__(self, path, member, interface, destination=None,
-                 signature=None, body=None):
+                 signature=None, body=None, serial=None):
         """
         @param path: C{str} DBus object path of the object sending the signal
         @param member: C{str} Member name
@@ -315,6 +336,8 @@ class SignalMessage (DBusMessage):
                           C{self.body}
         @param body: C{list} of python objects to encode. Objects must match
                      the C{self.signature}
+        @param serial: C{int} serial number allocated by the sending
+                       connection, or None to use a process-wide counter
         """
         marshal.validate_member_name(member)
         marshal.validate_interface_name(interface)
@@ -328,8 +351,9 @@ class SignalMessage (DBusMessage):
         self.destination = destination
         self.signature = signature
         self.body = body
+        self.serial = serial
 
-        self._marshal()
+        self._marshal(newSerial=serial is None)
 
     def __repr__(self):
         return "<Signal: path=%s, member=%s, interface=%s, dest=%s, body=%s" % (
@@ -356,13 +380,16 @@ _hcode = {
 }
 
 
-def parse_message(rawMessage, oobFDs):
+def parse_message(rawMessage, oobFDs, body=True):
     """
     Parses the raw binary message and returns a L{DBusMessage} subclass.
     Unmarshalling DBUS 'h' (UNIX_FD) gets the FDs from the oobFDs list.
 
     @type rawMessage: C{str}
     @param rawMessage: Raw binary message to parse
+    @param body: Unmarshal the body. If False, C{body} is left None and only
+                 C{rawBody} is set, eg. to route messages without
+                 inspecting them.
 
     @rtype: L{DBusMessage} subclass
     @returns: The L{DBusMessage} subclass corresponding to the contained
@@ -380,6 +407,7 @@ def parse_message(rawMessage, oobFDs):
     )
 
     messageType = hval[1]
+    flags = hval[2]
 
     if messageType not in _mtype:
         raise error.MarshallingError(
@@ -397,6 +425,8 @@ def parse_message(rawMessage, oobFDs):
     m.rawBody = rawMessage[nheader + npad:]
 
     m.serial = hval[5]
+    m.expect_reply = not flags & 0x1
+    m.auto_start = not flags & 0x2
 
     for code, v in hval[6]:
         try:
@@ -404,7 +434,7 @@ def parse_message(rawMessage, oobFDs):
         except KeyError:
             pass
 
-    if m.signature:
+    if m.signature and body:
         nbytes, m.body = marshal.unmarshal(
             m.signature,
             m.rawBody,
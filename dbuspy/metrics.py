@@ -0,0 +1,207 @@
+"""
+Instrumentation of DBus connections.
+
+Every connection reports to a L{MetricsSink} held in its C{metrics}
+attribute. The default L{NULL_METRICS} sink is disabled, and connections
+skip all measurements for disabled sinks, so instrumentation costs a single
+attribute check per message. L{InMemoryMetrics} keeps counters and latency
+histograms in memory::
+
+    client.metrics = InMemoryMetrics()
+    ...
+    for (interface, member), stats in client.metrics.slowest_calls(5):
+        print(interface, member, stats.count, stats.latency.quantile(0.99))
+
+Other sinks, eg. forwarding to a metrics library, subclass L{MetricsSink}
+and set C{enabled} to True.
+"""
+import bisect
+import time
+
+# Clock used for all durations
+clock = getattr(time, 'perf_counter', time.time)
+
+
+# Activities of L{MetricsSink.time_spent}
+MARSHAL = 'marshal'
+UNMARSHAL = 'unmarshal'
+IO_WAIT = 'io_wait'
+
+# Gauges of L{MetricsSink.gauge}
+PENDING_CALLS = 'pending_calls'
+SIGNAL_QUEUE_DEPTH = 'signal_queue_depth'
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+
+class MetricsSink (object):
+    """
+    Receives the measurements of a connection. This base class ignores
+    them; connections do not even measure while C{enabled} is False.
+
+    Measurements are reported from whatever thread or greenlet handles the
+    message, so sinks shared by threaded clients must be thread safe.
+    """
+    enabled = False
+
+    def call_completed(self, interface, member, seconds, error):
+        """
+        A method call got its reply, or was given up on
+
+        @param seconds: Time from sending the call to its reply
+        @param error: True for error replies and calls that got no reply
+        """
+
+    def bytes_sent(self, n):
+        pass
+
+    def bytes_received(self, n):
+        pass
+
+    def time_spent(self, activity, seconds):
+        """
+        @param activity: L{MARSHAL}, L{UNMARSHAL} or L{IO_WAIT}
+        """
+
+    def gauge(self, name, value):
+        """
+        @param name: L{PENDING_CALLS} or L{SIGNAL_QUEUE_DEPTH}
+        """
+
+
+NULL_METRICS = MetricsSink()
+
+
+class Histogram (object):
+    """
+    Counts of observed values per bucket
+
+    @ivar bounds: Sorted upper bounds of the buckets. Values above the last
+                  bound go to an extra overflow bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the C{q} quantile,
+        capped by the largest value seen
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+
+class CallStats (object):
+    """
+    Statistics of the calls of one (interface, member)
+    """
+    __slots__ = ('count', 'errors', 'latency')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class InMemoryMetrics (MetricsSink):
+    """
+    Keeps measurements in memory
+
+    @ivar calls: C{dict} of (interface, member) to L{CallStats}
+    @ivar times: C{dict} of activity to total seconds spent on it
+    @ivar gauges: C{dict} of gauge name to (last value, highest value)
+    """
+    enabled = True
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.sent = 0
+        self.received = 0
+        self.times = {MARSHAL: 0.0, UNMARSHAL: 0.0, IO_WAIT: 0.0}
+        self.gauges = {}
+
+    def call_completed(self, interface, member, seconds, error):
+        key = (interface, member)
+        stats = self.calls.get(key)
+        if stats is None:
+            stats = self.calls[key] = CallStats()
+        stats.count += 1
+        if error:
+            stats.errors += 1
+        stats.latency.observe(seconds)
+
+    def bytes_sent(self, n):
+        self.sent += n
+
+    def bytes_received(self, n):
+        self.received += n
+
+    def time_spent(self, activity, seconds):
+        self.times[activity] = self.times.get(activity, 0.0) + seconds
+
+    def gauge(self, name, value):
+        old = self.gauges.get(name)
+        self.gauges[name] = (value, value if old is None or value > old[1]
+                             else old[1])
+
+    def slowest_calls(self, n=10):
+        """
+        Returns the C{n} (interface, member), L{CallStats} pairs with the
+        most time spent waiting for replies
+        """
+        return sorted(self.calls.items(),
+                      key=lambda item: item[1].latency.sum, reverse=True)[:n]
+
+    def snapshot(self):
+        """
+        Returns all measurements as a C{dict} of plain values
+        """
+        return {
+            'calls': dict(
+                ('%s.%s' % key, {
+                    'count': s.count,
+                    'errors': s.errors,
+                    'mean': s.latency.mean(),
+                    'p50': s.latency.quantile(0.5),
+                    'p99': s.latency.quantile(0.99),
+                    'max': s.latency.max,
+                }) for key, s in self.calls.items()),
+            'bytes_sent': self.sent,
+            'bytes_received': self.received,
+            'times': dict(self.times),
+            'gauges': dict(self.gauges),
+        }
@@ -0,0 +1,976 @@
+"""
+A lightweight in-process message bus for tests and benchmarks.
+
+L{MockBus} listens on a unix socket in a temporary directory and implements
+enough of a bus daemon for real dbuspy connections: SASL EXTERNAL, C{Hello},
+name ownership with queueing, routing of method calls and replies, and
+C{AddMatch} based signal routing. L{FakeSystemd} serves a scriptable
+C{org.freedesktop.systemd1} on it::
+
+    bus = MockBus().start()
+    systemd = FakeSystemd(bus).start()
+    systemd.add_unit('nginx.service')
+
+    manager = SystemdManager(dbuspy.get_client(bus.address).connect())
+    manager.start_unit('nginx.service', wait=True)
+
+Threaded and asyncio clients need the bus to run in another thread, see
+L{MockBus.start_thread}.
+
+With pytest, enable the C{mock_bus}, C{mock_bus_client} and
+C{fake_systemd} fixtures in a C{conftest.py}::
+
+    pytest_plugins = ['dbuspy.mockbus']
+"""
+import binascii
+import itertools
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import gevent
+from gevent.server import StreamServer
+import gevent.socket as gsocket
+
+from . import marshal
+from .authentication import ServerAuthenticator
+from .error import DBusAuthenticationFailed, RemoteError
+from .interface import DBusInterface, Method, Signal, Property
+from .message import (MethodReturnMessage, ErrorMessage, SignalMessage,
+                      _headerFormat, parse_message)
+from .objects import DBusObject
+from .protocol import ClientBase
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+logger = logging.getLogger(__name__)
+
+
+BUS_NAME = 'org.freedesktop.DBus'
+BUS_PATH = '/org/freedesktop/DBus'
+
+# Flags and replies of RequestName and ReleaseName
+NAME_FLAG_ALLOW_REPLACEMENT = 0x1
+NAME_FLAG_REPLACE_EXISTING = 0x2
+NAME_FLAG_DO_NOT_QUEUE = 0x4
+
+REQUEST_NAME_PRIMARY_OWNER = 1
+REQUEST_NAME_IN_QUEUE = 2
+REQUEST_NAME_EXISTS = 3
+REQUEST_NAME_ALREADY_OWNER = 4
+
+RELEASE_NAME_RELEASED = 1
+RELEASE_NAME_NON_EXISTENT = 2
+RELEASE_NAME_NOT_OWNER = 3
+
+_MESSAGE_TYPES = {
+    'method_call': 1,
+    'method_return': 2,
+    'error': 3,
+    'signal': 4,
+}
+
+
+def _error(name, message=''):
+    e = RemoteError(name)
+    e.message = message
+    return e
+
+
+def _load_body(msg):
+    """
+    Unmarshals the body of a message parsed without it
+    """
+    if msg.body is None and msg.signature:
+        lendian = bytearray(msg.rawHeader[:1])[0] == ord('l')
+        msg.body = marshal.unmarshal(msg.signature, msg.rawBody,
+                                     lendian=lendian)[1]
+    return msg.body or ()
+
+
+def _with_sender(msg, sender):
+    """
+    Returns the raw bytes of a parsed message with its sender header set,
+    as the bus daemon does for every message it routes. The body is copied
+    as is.
+    """
+    headers = []
+    for attr, code, _ in msg._header_attrs + [('unix_fds', 9, False)]:
+        value = sender if attr == 'sender' else getattr(msg, attr, None)
+        if value is None:
+            continue
+        if attr == 'path':
+            value = marshal.ObjectPath(value)
+        elif attr == 'signature':
+            value = marshal.Signature(value)
+        elif attr in ('reply_serial', 'unix_fds'):
+            value = marshal.UInt32(value)
+        headers.append([code, value])
+
+    flags = (0 if msg.expect_reply else 0x1) | (0 if msg.auto_start else 0x2)
+    endian = bytearray(msg.rawHeader[:1])[0]
+    header = b''.join(marshal.marshal(
+        _headerFormat,
+        [endian, msg._message_type, flags, 1, len(msg.rawBody), msg.serial,
+         headers],
+        lendian=endian == ord('l'),
+    )[1])
+    return header + marshal.pad['header'](len(header)) + msg.rawBody
+
+
+def parse_match_rule(rule):
+    """
+    Parses a match rule into a C{dict} of key to value
+
+    @raises RemoteError: C{MatchRuleInvalid} if the rule cannot be parsed
+    """
+    keys = {}
+    i = 0
+    n = len(rule)
+    while i < n:
+        eq = rule.find('=', i)
+        if eq < 0:
+            raise _error('org.freedesktop.DBus.Error.MatchRuleInvalid', rule)
+        key = rule[i:eq].strip()
+        i = eq + 1
+        value = []
+        # Values are quoted with ', a quote itself is written as \'
+        quoted = False
+        while i < n:
+            c = rule[i]
+            if c == "'":
+                quoted = not quoted
+            elif c == '\\' and not quoted and rule[i + 1:i + 2] == "'":
+                value.append("'")
+                i += 1
+            elif c == ',' and not quoted:
+                break
+            else:
+                value.append(c)
+            i += 1
+        if quoted:
+            raise _error('org.freedesktop.DBus.Error.MatchRuleInvalid', rule)
+        keys[key] = ''.join(value)
+        i += 1
+    if keys.get('type', 'signal') not in _MESSAGE_TYPES:
+        raise _error('org.freedesktop.DBus.Error.MatchRuleInvalid', rule)
+    return keys
+
+
+class MatchRule (object):
+    """
+    A parsed match rule. Supports the C{type}, C{sender}, C{interface},
+    C{member}, C{path}, C{path_namespace}, C{destination} and C{argN} keys.
+    """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.keys = parse_match_rule(rule)
+        self.type = _MESSAGE_TYPES[self.keys.get('type', 'signal')]
+        self.args = []
+        for key, value in self.keys.items():
+            if key.startswith('arg') and key[3:].isdigit():
+                self.args.append((int(key[3:]), value))
+
+    def matches(self, msg, sender_names):
+        """
+        @param sender_names: Unique and well-known names of the sender
+        """
+        keys = self.keys
+        if msg._message_type != self.type:
+            return False
+        if 'sender' in keys and keys['sender'] not in sender_names:
+            return False
+        for key in ('interface', 'member', 'path', 'destination'):
+            if key in keys and getattr(msg, key, None) != keys[key]:
+                return False
+        namespace = keys.get('path_namespace')
+        if namespace is not None and namespace != '/':
+            path = msg.path or ''
+            if path != namespace and not path.startswith(namespace + '/'):
+                return False
+        if self.args:
+            body = _load_body(msg)
+            for index, value in self.args:
+                if index >= len(body) or body[index] != value:
+                    return False
+        return True
+
+
+class BusConnection (ClientBase):
+    """
+    The bus side of a connection to a L{MockBus}
+
+    @ivar unique_name: Unique name assigned by C{Hello}, or None
+    @ivar match_rules: List of L{MatchRule} added by the peer
+    """
+    unique_name = None
+
+    def __init__(self, bus, transport):
+        ClientBase.__init__(self, transport)
+        self.bus = bus
+        self.match_rules = []
+
+    def __repr__(self):
+        return '<BusConnection(%s)>' % (self.unique_name,)
+
+    def on_connection_authenticated(self):
+        pass
+
+    def process_raw_dbus_message(self, rawMsg):
+        # Bodies are only unmarshalled when the bus needs them, see
+        # _load_body
+        m = parse_message(rawMsg, self._receivedFDs, body=False)
+        self._receivedFDs = []
+        mt = m._message_type
+        if mt == 1:
+            self.on_method_call_received(m)
+        elif mt == 2:
+            self.on_method_return_received(m)
+        elif mt == 3:
+            self.on_error_received(m)
+        elif mt == 4:
+            self.on_signal_received(m)
+
+    def on_method_call_received(self, mcall):
+        self.bus.route_call(self, mcall)
+
+    def on_method_return_received(self, mret):
+        self.bus.route_reply(self, mret)
+
+    def on_error_received(self, merr):
+        self.bus.route_reply(self, merr)
+
+    def on_signal_received(self, msig):
+        self.bus.route_signal(self, msig)
+
+
+class MockBus (object):
+    """
+    Message bus daemon running in the current process. Connections are
+    served by greenlets.
+
+    @ivar connections: C{dict} of unique name to L{BusConnection}
+    @ivar messages: Number of messages routed
+    """
+
+    def __init__(self, path=None, allowed_uids=None):
+        """
+        @param path: Path of the socket. Defaults to a new temporary
+                     directory, removed by L{stop}
+        @param allowed_uids: uids allowed to connect. Defaults to the uid of
+                             this process
+        """
+        self._tmpdir = None
+        if path is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='dbuspy-mockbus-')
+            path = os.path.join(self._tmpdir, 'bus')
+        self.path = path
+        self.allowed_uids = allowed_uids
+        self.guid = binascii.hexlify(os.urandom(16))
+        self.connections = {}
+        self.messages = 0
+        # Well-known name to queue of [connection, flags]; the first is the
+        # owner
+        self._names = {}
+        self._unique_ids = itertools.count(1)
+        self._serials = itertools.count(1)
+        self._server = None
+        self._thread = None
+        self._wakeup = None
+
+    @property
+    def address(self):
+        return 'unix:path=%s,guid=%s' % (self.path, self.guid.decode('ascii'))
+
+    def start(self):
+        sock = gsocket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(128)
+        self._server = StreamServer(sock, self._handle)
+        self._server.start()
+        return self
+
+    def start_thread(self):
+        """
+        Starts the bus in a new thread with its own gevent hub. Needed for
+        L{threaded.ThreadedClient} and L{aio.AsyncClient}, which would block
+        a bus running in their own thread while waiting for a reply.
+        """
+        rfd, self._wakeup = os.pipe()
+        ready = threading.Event()
+
+        def run():
+            self.start()
+            ready.set()
+            gsocket.wait_read(rfd)
+            os.close(rfd)
+            self._stop()
+
+        self._thread = threading.Thread(target=run, name='MockBus')
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        """
+        Stops listening, closes all connections and removes the socket
+        """
+        if self._thread is None:
+            self._stop()
+            return
+        thread, self._thread = self._thread, None
+        os.write(self._wakeup, b'x')
+        thread.join()
+        os.close(self._wakeup)
+
+    def _stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        for conn in list(self.connections.values()):
+            conn.teardown()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+        else:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _handle(self, sock, addr):
+        conn = BusConnection(self, sock)
+        try:
+            ServerAuthenticator(self.guid, self.allowed_uids).authenticate(
+                conn)
+        except (DBusAuthenticationFailed, socket.error) as e:
+            logger.info('Rejected bus connection: %s', e)
+            sock.close()
+            return
+        try:
+            conn._reader = gevent.getcurrent()
+            conn._read_loop()
+        finally:
+            self._disconnected(conn)
+            sock.close()
+
+    # -------------------------------------------------
+    # Names
+
+    def get_owner(self, name):
+        """
+        Returns the connection owning a unique or well-known name, or None
+        """
+        if name[:1] == ':':
+            return self.connections.get(name)
+        queue = self._names.get(name)
+        return queue[0][0] if queue else None
+
+    def names_of(self, conn):
+        """
+        Returns the unique and well-known names owned by a connection
+        """
+        names = [conn.unique_name]
+        for name, queue in self._names.items():
+            if queue[0][0] is conn:
+                names.append(name)
+        return names
+
+    def _owner_changed(self, name, old, new):
+        self._emit(BUS_PATH, BUS_NAME, 'NameOwnerChanged', 'sss',
+                   [name, old.unique_name if old else '',
+                    new.unique_name if new else ''])
+        if old is not None:
+            self._emit(BUS_PATH, BUS_NAME, 'NameLost', 's', [name],
+                       destination=old)
+        if new is not None:
+            self._emit(BUS_PATH, BUS_NAME, 'NameAcquired', 's', [name],
+                       destination=new)
+
+    def request_name(self, conn, name, flags):
+        queue = self._names.setdefault(name, [])
+        if not queue:
+            queue.append([conn, flags])
+            self._owner_changed(name, None, conn)
+            return REQUEST_NAME_PRIMARY_OWNER
+
+        owner, owner_flags = queue[0]
+        if owner is conn:
+            queue[0][1] = flags
+            return REQUEST_NAME_ALREADY_OWNER
+
+        queue[:] = [entry for entry in queue if entry[0] is not conn]
+        if (flags & NAME_FLAG_REPLACE_EXISTING and
+                owner_flags & NAME_FLAG_ALLOW_REPLACEMENT):
+            queue.pop(0)
+            if not owner_flags & NAME_FLAG_DO_NOT_QUEUE:
+                queue.insert(0, [owner, owner_flags])
+            queue.insert(0, [conn, flags])
+            self._owner_changed(name, owner, conn)
+            return REQUEST_NAME_PRIMARY_OWNER
+
+        if flags & NAME_FLAG_DO_NOT_QUEUE:
+            return REQUEST_NAME_EXISTS
+        queue.append([conn, flags])
+        return REQUEST_NAME_IN_QUEUE
+
+    def release_name(self, conn, name):
+        queue = self._names.get(name)
+        if not queue:
+            return RELEASE_NAME_NON_EXISTENT
+        if not any(entry[0] is conn for entry in queue):
+            return RELEASE_NAME_NOT_OWNER
+        was_owner = queue[0][0] is conn
+        queue[:] = [entry for entry in queue if entry[0] is not conn]
+        if was_owner:
+            self._owner_changed(name, conn, queue[0][0] if queue else None)
+        if not queue:
+            del self._names[name]
+        return RELEASE_NAME_RELEASED
+
+    def _disconnected(self, conn):
+        if conn.unique_name is None:
+            return
+        for name in list(self._names):
+            self.release_name(conn, name)
+        del self.connections[conn.unique_name]
+        self._emit(BUS_PATH, BUS_NAME, 'NameOwnerChanged', 'sss',
+                   [conn.unique_name, conn.unique_name, ''])
+
+    # -------------------------------------------------
+    # Routing
+
+    def _send(self, conn, data):
+        try:
+            conn.write(data)
+        except (socket.error, OSError) as e:
+            logger.debug('Failed to send to %r: %r', conn, e)
+
+    def _bus_message(self, msg, destination):
+        msg.sender = BUS_NAME
+        msg.destination = destination.unique_name
+        msg._marshal(newSerial=False)
+        return msg
+
+    def _emit(self, path, interface, member, signature, body,
+              destination=None):
+        msig = SignalMessage(path, member, interface, signature=signature,
+                             body=body, serial=next(self._serials))
+        if destination is not None:
+            self._send(destination,
+                       self._bus_message(msig, destination).raw_message)
+            return
+        msig.sender = BUS_NAME
+        msig._marshal(newSerial=False)
+        sender_names = (BUS_NAME,)
+        for conn in list(self.connections.values()):
+            for rule in conn.match_rules:
+                if rule.matches(msig, sender_names):
+                    self._send(conn, msig.raw_message)
+                    break
+
+    def _reply_error(self, conn, mcall, name, message=''):
+        if not mcall.expect_reply:
+            return
+        merr = ErrorMessage(name, mcall.serial, signature='s', body=[message],
+                            serial=next(self._serials))
+        self._send(conn, self._bus_message(merr, conn).raw_message)
+
+    def route_call(self, conn, mcall):
+        self.messages += 1
+        if conn.unique_name is None and mcall.member != 'Hello':
+            conn.teardown()
+            return
+        if mcall.destination == BUS_NAME:
+            self._handle_bus_call(conn, mcall)
+            return
+        target = self.get_owner(mcall.destination or '')
+        if target is None:
+            self._reply_error(conn, mcall,
+                              'org.freedesktop.DBus.Error.ServiceUnknown',
+                              'The name %s is not owned by anyone' % (
+                                  mcall.destination,))
+            return
+        self._send(target, _with_sender(mcall, conn.unique_name))
+
+    def route_reply(self, conn, msg):
+        self.messages += 1
+        target = self.get_owner(msg.destination or '')
+        if target is not None:
+            self._send(target, _with_sender(msg, conn.unique_name))
+
+    def route_signal(self, conn, msig):
+        self.messages += 1
+        raw = None
+        if msig.destination:
+            target = self.get_owner(msig.destination)
+            if target is not None:
+                self._send(target, _with_sender(msig, conn.unique_name))
+            return
+        sender_names = self.names_of(conn)
+        for target in list(self.connections.values()):
+            for rule in target.match_rules:
+                if rule.matches(msig, sender_names):
+                    if raw is None:
+                        raw = _with_sender(msig, conn.unique_name)
+                    self._send(target, raw)
+                    break
+
+    # -------------------------------------------------
+    # org.freedesktop.DBus
+
+    def _handle_bus_call(self, conn, mcall):
+        handler = getattr(self, '_bus_' + (mcall.member or ''), None)
+        if handler is None:
+            self._reply_error(conn, mcall,
+                              'org.freedesktop.DBus.Error.UnknownMethod',
+                              'Unknown method %s' % (mcall.member,))
+            return
+        try:
+            signature, body = handler(conn, *_load_body(mcall))
+        except RemoteError as e:
+            self._reply_error(conn, mcall, e.errName, e.message)
+            return
+        except TypeError as e:
+            self._reply_error(conn, mcall,
+                              'org.freedesktop.DBus.Error.InvalidArgs', str(e))
+            return
+        if mcall.expect_reply:
+            mret = MethodReturnMessage(mcall.serial, body=body,
+                                       signature=signature,
+                                       serial=next(self._serials))
+            self._send(conn, self._bus_message(mret, conn).raw_message)
+        if mcall.member == 'Hello':
+            self._owner_changed(conn.unique_name, None, conn)
+
+    def _bus_Hello(self, conn):
+        if conn.unique_name is not None:
+            raise _error('org.freedesktop.DBus.Error.Failed',
+                         'Already handled an Hello message')
+        conn.unique_name = ':1.%d' % (next(self._unique_ids),)
+        self.connections[conn.unique_name] = conn
+        return 's', [conn.unique_name]
+
+    def _bus_RequestName(self, conn, name, flags):
+        return 'u', [self.request_name(conn, name, flags)]
+
+    def _bus_ReleaseName(self, conn, name):
+        return 'u', [self.release_name(conn, name)]
+
+    def _bus_GetNameOwner(self, conn, name):
+        owner = self.get_owner(name)
+        if owner is None:
+            raise _error('org.freedesktop.DBus.Error.NameHasNoOwner',
+                         'Could not get owner of name %s' % (name,))
+        return 's', [owner.unique_name]
+
+    def _bus_NameHasOwner(self, conn, name):
+        return 'b', [self.get_owner(name) is not None]
+
+    def _bus_ListNames(self, conn):
+        return 'as', [[BUS_NAME] + list(self.connections) + list(self._names)]
+
+    def _bus_ListActivatableNames(self, conn):
+        return 'as', [[BUS_NAME]]
+
+    def _bus_AddMatch(self, conn, rule):
+        conn.match_rules.append(MatchRule(rule))
+        return None, None
+
+    def _bus_RemoveMatch(self, conn, rule):
+        for i, match in enumerate(conn.match_rules):
+            if match.rule == rule:
+                del conn.match_rules[i]
+                return None, None
+        raise _error('org.freedesktop.DBus.Error.MatchRuleNotFound', rule)
+
+    def _bus_GetId(self, conn):
+        return 's', [self.guid.decode('ascii')]
+
+    def _bus_GetConnectionUnixUser(self, conn, name):
+        owner = self.get_owner(name)
+        if owner is None or owner._unix_creds is None:
+            raise _error('org.freedesktop.DBus.Error.NameHasNoOwner', name)
+        return 'u', [owner._unix_creds[1]]
+
+    def _bus_Ping(self, conn):
+        return None, None
+
+
+# ---------------------------------------------------------------------------
+# Fake systemd
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+_MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+_UNIT_INTERFACE = 'org.freedesktop.systemd1.Unit'
+_SERVICE_INTERFACE = 'org.freedesktop.systemd1.Service'
+
+# ActiveState and SubState reached by successful jobs
+_JOB_STATES = {
+    'start': ('active', 'running'),
+    'stop': ('inactive', 'dead'),
+    'restart': ('active', 'running'),
+    'reload': ('active', 'running'),
+}
+
+_UINT64_MAX = 2 ** 64 - 1
+
+
+class FakeUnit (DBusObject):
+    """
+    A unit object of L{FakeSystemd}. Services also implement the Service
+    interface, with resource counters that tests may set.
+    """
+    dbus_interfaces = [
+        DBusInterface(
+            _UNIT_INTERFACE,
+            Property('Id', 's'),
+            Property('Names', 'as'),
+            Property('Description', 's'),
+            Property('LoadState', 's'),
+            Property('ActiveState', 's'),
+            Property('SubState', 's'),
+            Property('UnitFileState', 's'),
+            Property('Following', 's'),
+        ),
+    ]
+
+    def __init__(self, name, description='', load_state='loaded',
+                 active_state='inactive', sub_state='dead',
+                 unit_file_state='enabled'):
+        from .systemd import unit_path
+        DBusObject.__init__(self, unit_path(name))
+        self.Id = name
+        self.Names = [name]
+        self.Description = description or name
+        self.LoadState = load_state
+        self.ActiveState = active_state
+        self.SubState = sub_state
+        self.UnitFileState = unit_file_state
+        self.Following = ''
+
+    def status(self):
+        """
+        Returns the entry of the unit in C{ListUnits}
+        """
+        return [self.Id, self.Description, self.LoadState, self.ActiveState,
+                self.SubState, self.Following, self.object_path, 0, '', '/']
+
+    def set_state(self, active_state, sub_state):
+        """
+        Changes the state of the unit and emits C{PropertiesChanged}
+        """
+        self.ActiveState = active_state
+        self.SubState = sub_state
+        self.emit_properties_changed(_UNIT_INTERFACE, {
+            'ActiveState': active_state,
+            'SubState': sub_state,
+        })
+
+
+class FakeService (FakeUnit):
+    dbus_interfaces = FakeUnit.dbus_interfaces + [
+        DBusInterface(
+            _SERVICE_INTERFACE,
+            Property('MainPID', 'u'),
+            Property('ExecMainStatus', 'i'),
+            Property('MemoryCurrent', 't'),
+            Property('CPUUsageNSec', 't'),
+            Property('TasksCurrent', 't'),
+            Property('IOReadBytes', 't'),
+            Property('IOWriteBytes', 't'),
+        ),
+    ]
+
+    MainPID = 0
+    ExecMainStatus = 0
+    MemoryCurrent = _UINT64_MAX
+    CPUUsageNSec = _UINT64_MAX
+    TasksCurrent = _UINT64_MAX
+    IOReadBytes = _UINT64_MAX
+    IOWriteBytes = _UINT64_MAX
+
+
+class FakeSystemd (DBusObject):
+    """
+    Scriptable stand-in for the systemd Manager, connected to a bus as
+    C{org.freedesktop.systemd1}.
+
+    Jobs complete after L{job_delay} seconds with the result found in
+    L{job_results} for the unit, C{done} by default, and update the unit's
+    state when successful.
+
+    @ivar units: C{dict} of unit name to L{FakeUnit}
+    @ivar calls: C{list} of (method, args) of the Manager calls received
+    @ivar job_delay: Seconds before a job finishes
+    @ivar job_results: C{dict} of unit name to job result
+    """
+    dbus_interfaces = [
+        DBusInterface(
+            _MANAGER_INTERFACE,
+            Method('GetUnit', 's', 'o'),
+            Method('LoadUnit', 's', 'o'),
+            Method('ListUnits', '', 'a(ssssssouso)'),
+            Method('ListUnitsByPatterns', 'asas', 'a(ssssssouso)'),
+            Method('ListUnitsByNames', 'as', 'a(ssssssouso)'),
+            Method('ListUnitFiles', '', 'a(ss)'),
+            Method('ListUnitFilesByPatterns', 'asas', 'a(ss)'),
+            Method('StartUnit', 'ss', 'o'),
+            Method('StopUnit', 'ss', 'o'),
+            Method('RestartUnit', 'ss', 'o'),
+            Method('ReloadUnit', 'ss', 'o'),
+            Method('EnableUnitFiles', 'asbb', 'ba(sss)'),
+            Method('DisableUnitFiles', 'asb', 'a(sss)'),
+            Method('MaskUnitFiles', 'asbb', 'a(sss)'),
+            Method('UnmaskUnitFiles', 'asb', 'a(sss)'),
+            Method('Reload'),
+            Method('Subscribe'),
+            Method('Unsubscribe'),
+            Signal('UnitNew', 'so'),
+            Signal('UnitRemoved', 'so'),
+            Signal('JobNew', 'uos'),
+            Signal('JobRemoved', 'uoss'),
+            Property('Version', 's'),
+        ),
+    ]
+
+    Version = '255'
+
+    def __init__(self, bus_or_client):
+        """
+        @param bus_or_client: A L{MockBus} to connect to, or a connected
+                              client
+        """
+        DBusObject.__init__(self, SYSTEMD_PATH)
+        self._bus = bus_or_client if isinstance(bus_or_client, MockBus) \
+            else None
+        self.client = None if self._bus is not None else bus_or_client
+        self.units = {}
+        self.calls = []
+        self.job_delay = 0.0
+        self.job_results = {}
+        self._job_ids = itertools.count(1)
+
+    def start(self):
+        if self.client is None:
+            from . import get_client
+            self.client = get_client(self._bus.address).connect()
+        self.client.export_object(self)
+        for unit in self.units.values():
+            self.client.export_object(unit)
+        self.client.request_name(SYSTEMD_BUS_NAME)
+        return self
+
+    def stop(self):
+        if self.client is not None:
+            self.client.teardown()
+
+    # -------------------------------------------------
+    # Scripting
+
+    def add_unit(self, name, **kwargs):
+        """
+        Adds a unit, a L{FakeService} for C{.service} units. Keyword
+        arguments set the initial state (see L{FakeUnit}) or other
+        properties.
+
+        @rtype: L{FakeUnit}
+        """
+        cls = FakeService if name.endswith('.service') else FakeUnit
+        init = dict((k, kwargs.pop(k)) for k in list(kwargs) if k in (
+            'description', 'load_state', 'active_state', 'sub_state',
+            'unit_file_state'))
+        unit = cls(name, **init)
+        for key, value in kwargs.items():
+            setattr(unit, key, value)
+        self.units[name] = unit
+        if self.client is not None:
+            self.client.export_object(unit)
+            self.emit_signal(_MANAGER_INTERFACE, 'UnitNew', name,
+                             unit.object_path)
+        return unit
+
+    def remove_unit(self, name):
+        unit = self.units.pop(name)
+        if self.client is not None:
+            self.client.unexport_object(unit.object_path)
+            self.emit_signal(_MANAGER_INTERFACE, 'UnitRemoved', name,
+                             unit.object_path)
+
+    def _log(self, method, *args):
+        self.calls.append((method, args))
+
+    def _unit(self, name):
+        try:
+            return self.units[name]
+        except KeyError:
+            raise _error('org.freedesktop.systemd1.NoSuchUnit',
+                         'Unit %s not loaded.' % (name,))
+
+    # -------------------------------------------------
+    # org.freedesktop.systemd1.Manager
+
+    def dbus_GetUnit(self, name):
+        self._log('GetUnit', name)
+        return self._unit(name).object_path
+
+    def dbus_LoadUnit(self, name):
+        self._log('LoadUnit', name)
+        if name not in self.units:
+            self.add_unit(name, load_state='not-found')
+        return self.units[name].object_path
+
+    def dbus_ListUnits(self):
+        self._log('ListUnits')
+        return [u.status() for u in self.units.values()
+                if u.LoadState != 'not-found']
+
+    def dbus_ListUnitsByPatterns(self, states, patterns):
+        import fnmatch
+        self._log('ListUnitsByPatterns', states, patterns)
+        return [u.status() for u in self.units.values()
+                if (not states or u.ActiveState in states or
+                    u.LoadState in states or u.SubState in states) and
+                (not patterns or any(fnmatch.fnmatchcase(u.Id, p)
+                                     for p in patterns))]
+
+    def dbus_ListUnitsByNames(self, names):
+        self._log('ListUnitsByNames', names)
+        result = []
+        for name in names:
+            if name not in self.units:
+                self.add_unit(name, load_state='not-found')
+            result.append(self.units[name].status())
+        return result
+
+    def _unit_files(self):
+        return [['/usr/lib/systemd/system/' + u.Id, u.UnitFileState]
+                for u in self.units.values() if u.LoadState != 'not-found']
+
+    def dbus_ListUnitFiles(self):
+        self._log('ListUnitFiles')
+        return self._unit_files()
+
+    def dbus_ListUnitFilesByPatterns(self, states, patterns):
+        import fnmatch
+        self._log('ListUnitFilesByPatterns', states, patterns)
+        return [f for f in self._unit_files()
+                if (not states or f[1] in states) and
+                (not patterns or any(
+                    fnmatch.fnmatchcase(os.path.basename(f[0]), p)
+                    for p in patterns))]
+
+    def _job(self, kind, name, mode):
+        self._log(kind.capitalize() + 'Unit', name, mode)
+        unit = self._unit(name)
+        job_id = next(self._job_ids)
+        job_path = '%s/job/%d' % (SYSTEMD_PATH, job_id)
+        self.emit_signal(_MANAGER_INTERFACE, 'JobNew', job_id, job_path,
+                         name)
+
+        def finish():
+            result = self.job_results.get(name, 'done')
+            if result == 'done':
+                unit.set_state(*_JOB_STATES[kind])
+            elif result == 'failed':
+                unit.set_state('failed', 'failed')
+            self.emit_signal(_MANAGER_INTERFACE, 'JobRemoved', job_id,
+                             job_path, name, result)
+
+        gevent.spawn_later(self.job_delay, finish)
+        return job_path
+
+    def dbus_StartUnit(self, name, mode):
+        return self._job('start', name, mode)
+
+    def dbus_StopUnit(self, name, mode):
+        return self._job('stop', name, mode)
+
+    def dbus_RestartUnit(self, name, mode):
+        return self._job('restart', name, mode)
+
+    def dbus_ReloadUnit(self, name, mode):
+        return self._job('reload', name, mode)
+
+    def _set_file_state(self, names, state, change, destination):
+        # Like systemd, change nothing if a unit is unknown
+        units = [self._unit(name) for name in names]
+        changes = []
+        for name, unit in zip(names, units):
+            if unit.UnitFileState != state:
+                unit.UnitFileState = state
+                changes.append([change, '/etc/systemd/system/' + name,
+                                destination(name)])
+        return changes
+
+    def dbus_EnableUnitFiles(self, names, runtime, force):
+        self._log('EnableUnitFiles', names, runtime, force)
+        return [True, self._set_file_state(
+            names, 'enabled', 'symlink',
+            lambda n: '/usr/lib/systemd/system/' + n)]
+
+    def dbus_DisableUnitFiles(self, names, runtime):
+        self._log('DisableUnitFiles', names, runtime)
+        return self._set_file_state(names, 'disabled', 'unlink',
+                                    lambda n: '')
+
+    def dbus_MaskUnitFiles(self, names, runtime, force):
+        self._log('MaskUnitFiles', names, runtime, force)
+        return self._set_file_state(names, 'masked', 'symlink',
+                                    lambda n: '/dev/null')
+
+    def dbus_UnmaskUnitFiles(self, names, runtime):
+        self._log('UnmaskUnitFiles', names, runtime)
+        return self._set_file_state(names, 'disabled', 'unlink',
+                                    lambda n: '')
+
+    def dbus_Reload(self):
+        self._log('Reload')
+
+    def dbus_Subscribe(self):
+        self._log('Subscribe')
+
+    def dbus_Unsubscribe(self):
+        self._log('Unsubscribe')
+
+
+# ---------------------------------------------------------------------------
+# pytest fixtures, enabled with pytest_plugins = ['dbuspy.mockbus']
+
+if pytest is not None:
+
+    @pytest.fixture
+    def mock_bus():
+        """
+        A running L{MockBus}
+        """
+        bus = MockBus().start()
+        yield bus
+        bus.stop()
+
+    @pytest.fixture
+    def mock_bus_client(mock_bus):
+        """
+        A client connected to the C{mock_bus}
+        """
+        from . import get_client
+        client = get_client(mock_bus.address, timeout=5).connect()
+        yield client
+        client.teardown()
+
+    @pytest.fixture
+    def fake_systemd(mock_bus):
+        """
+        A L{FakeSystemd} serving on the C{mock_bus}
+        """
+        systemd = FakeSystemd(mock_bus).start()
+        yield systemd
+        systemd.stop()
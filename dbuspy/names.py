@@ -0,0 +1,191 @@
+"""
+Cache of bus name owners.
+
+Messages from a service carry the unique connection name of its owner
+(C{:1.23}), not the well-known name it was addressed by. A
+L{NameOwnerCache} maps well-known names to their owners and back. It is
+filled by C{GetNameOwner} and C{ListNames} and kept current by
+C{NameOwnerChanged}, so resolving a name is a dictionary lookup.
+"""
+import logging
+
+from .error import RemoteError
+
+logger = logging.getLogger(__name__)
+
+
+DBUS_NAME = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+
+
+class NameOwnerCache (object):
+    """
+    Owners of well-known bus names, as seen by one connection.
+
+    Names without an owner are cached too (as None): every
+    C{NameOwnerChanged} on the bus is received, so the absence of an owner
+    is reliable as well. When signals were lost to queue overflow the
+    cache is cleared and refilled on demand.
+
+    @ivar owners: C{dict} mapping well-known names to the unique name of
+                  their owner, or None. Do not modify.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.owners = {DBUS_NAME: DBUS_NAME}
+        self._names_by_owner = {}
+        # Bumped on every change of a name, so that the result of a lookup
+        # that raced with a change is not stored over the newer value
+        self._generation = {}
+        # Bumped when the cache is cleared, for the same reason
+        self._resets = 0
+        self._subscription = None
+        self._dropped = 0
+
+    def start(self):
+        """
+        Subscribes to C{NameOwnerChanged}. Must be called before lookups.
+        """
+        if self._subscription is None:
+            self._subscription = self.client.add_signal_receiver(
+                self._on_name_owner_changed,
+                interface=DBUS_NAME,
+                member='NameOwnerChanged',
+                path=DBUS_PATH,
+                sender=DBUS_NAME,
+            )
+            self._dropped = self._subscription.queue.dropped
+        return self
+
+    def close(self):
+        if self._subscription is not None:
+            self.client.remove_signal_receiver(self._subscription)
+            self._subscription = None
+
+    # -------------------------------------------------
+
+    def get_owner(self, name):
+        """
+        Returns the unique name owning C{name}, or None if it has no owner.
+        Asks the bus on a cache miss.
+        """
+        if name[:1] == ':':
+            return name
+        self._check_dropped()
+        try:
+            return self.owners[name]
+        except KeyError:
+            pass
+
+        generation = self._generation_of(name)
+        try:
+            owner = self.client.call_remote(
+                DBUS_PATH,
+                'GetNameOwner',
+                interface=DBUS_NAME,
+                destination=DBUS_NAME,
+                signature='s',
+                args=[name],
+            )
+        except RemoteError as e:
+            if e.errName != 'org.freedesktop.DBus.Error.NameHasNoOwner':
+                raise
+            owner = None
+
+        if self._generation_of(name) == generation:
+            self._set(name, owner)
+        return self.owners.get(name, owner)
+
+    def cached_owner(self, name):
+        """
+        Like L{get_owner} but never asks the bus. Returns False for names
+        that are not cached.
+        """
+        if name[:1] == ':':
+            return name
+        self._check_dropped()
+        return self.owners.get(name, False)
+
+    def names_of(self, owner):
+        """
+        Returns the set of cached well-known names owned by a unique name
+        """
+        self._check_dropped()
+        return self._names_by_owner.get(owner, frozenset())
+
+    def preload(self):
+        """
+        Resolves the owners of all names currently on the bus. The
+        C{GetNameOwner} calls are pipelined.
+        """
+        self._check_dropped()
+        names = self.client.call_remote(
+            DBUS_PATH,
+            'ListNames',
+            interface=DBUS_NAME,
+            destination=DBUS_NAME,
+        )
+        calls = []
+        for name in names:
+            if name[:1] == ':' or name in self.owners:
+                continue
+            serial, result = self.client.call_remote_async(
+                DBUS_PATH,
+                'GetNameOwner',
+                interface=DBUS_NAME,
+                destination=DBUS_NAME,
+                signature='s',
+                args=[name],
+            )
+            calls.append((name, serial, result, self._generation_of(name)))
+
+        for name, serial, result, generation in calls:
+            try:
+                owner = self.client.await_reply(
+                    serial, self.client.default_timeout, result)
+            except RemoteError:
+                owner = None
+            if self._generation_of(name) == generation:
+                self._set(name, owner)
+
+    # -------------------------------------------------
+
+    def _generation_of(self, name):
+        return self._resets, self._generation.get(name, 0)
+
+    def _check_dropped(self):
+        if self._subscription is None:
+            return
+        dropped = self._subscription.queue.dropped
+        if dropped == self._dropped:
+            return
+        # Signals were lost to queue overflow, so any entry may be stale
+        self._dropped = dropped
+        logger.warning('Signal queue overflowed, clearing name owner cache')
+        self._resets += 1
+        self.owners = {DBUS_NAME: DBUS_NAME}
+        self._names_by_owner = {}
+
+    def _set(self, name, owner):
+        old = self.owners.get(name)
+        if old is not None and old != owner:
+            names = self._names_by_owner.get(old)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._names_by_owner[old]
+        self.owners[name] = owner
+        if owner is not None:
+            self._names_by_owner.setdefault(owner, set()).add(name)
+
+    def _on_name_owner_changed(self, msig):
+        self._check_dropped()
+        name, old_owner, new_owner = msig.body
+        if name[:1] == ':':
+            if not new_owner:
+                # The connection went away along with all its names
+                self._names_by_owner.pop(name, None)
+            return
+        self._generation[name] = self._generation.get(name, 0) + 1
+        self._set(name, new_owner or None)
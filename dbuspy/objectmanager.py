@@ -0,0 +1,262 @@
+"""
+Client-side mirror of an C{org.freedesktop.DBus.ObjectManager} tree.
+
+An L{ObjectManagerMirror} fetches the whole tree once with
+C{GetManagedObjects} and then follows C{InterfacesAdded},
+C{InterfacesRemoved} and C{PropertiesChanged}, so the tree is read from
+memory instead of being fetched again::
+
+    mirror = ObjectManagerMirror(client, 'org.bluez', '/').start()
+    for path, props in mirror.objects_with('org.bluez.Device1').items():
+        print(path, props['Address'])
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+class ObjectManagerMirror (object):
+    """
+    In-memory copy of the objects, interfaces and properties managed by a
+    remote ObjectManager.
+
+    Callbacks registered with L{add_callback} are called as
+    C{callback(event, path, interface, data)} where C{event} is L{ADDED}
+    (C{data} is the property C{dict}), L{REMOVED} (C{data} is None) or
+    L{CHANGED} (C{data} is a C{dict} of the changed properties).
+
+    @ivar objects: C{dict} of path to C{dict} of interface to C{dict} of
+                   property values. Do not modify.
+    """
+
+    MAX_FETCH_ATTEMPTS = 3
+
+    def __init__(self, client, busname, path='/'):
+        self.client = client
+        self.busname = busname
+        self.path = path
+        self.objects = {}
+        self._by_interface = {}
+        self._callbacks = []
+        self._subscriptions = ()
+        self._fetching = False
+        self._missed = []
+        self._dropped = 0
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __contains__(self, path):
+        return path in self.objects
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    # -------------------------------------------------
+
+    def start(self):
+        """
+        Subscribes to the change signals and fetches the tree
+        """
+        # A single subscription keeps the signals in order, eg. an object's
+        # InterfacesAdded before its first PropertiesChanged
+        self._subscriptions = (
+            self.client.add_signal_receiver(
+                self._on_signal,
+                path_namespace=self.path,
+                sender=self.busname,
+            ),
+        )
+        self.refresh()
+        return self
+
+    def close(self):
+        subs, self._subscriptions = self._subscriptions, ()
+        for sub in subs:
+            self.client.remove_signal_receiver(sub)
+
+    def refresh(self):
+        """
+        Replaces the mirror with a fresh copy of the tree, reporting the
+        differences to the previous copy to the callbacks. If change signals
+        arrive while the tree is being fetched, their effect may or may not
+        be part of the result, so the tree is fetched again. After
+        C{MAX_FETCH_ATTEMPTS} the signals are applied on top of the last
+        result.
+        """
+        for attempt in range(self.MAX_FETCH_ATTEMPTS):
+            self._fetching = True
+            self._missed = []
+            try:
+                tree = self.client.call_remote(
+                    self.path,
+                    'GetManagedObjects',
+                    interface=OBJECT_MANAGER_INTERFACE,
+                    destination=self.busname,
+                )
+            finally:
+                self._fetching = False
+            if not self._missed:
+                break
+
+        old, self.objects = self.objects, {}
+        self._by_interface = {}
+        for path, interfaces in (tree or {}).items():
+            self._add(path, interfaces)
+        self._notify_differences(old)
+
+        missed, self._missed = self._missed, []
+        for msig in missed:
+            self._on_signal(msig)
+
+    # -------------------------------------------------
+    # Lookups
+
+    def get(self, path, interface=None):
+        """
+        Returns the interfaces C{dict} of an object, or the properties of
+        one of its interfaces. None if there is no such object or interface.
+        """
+        interfaces = self.objects.get(path)
+        if interface is None or interfaces is None:
+            return interfaces
+        return interfaces.get(interface)
+
+    def get_property(self, path, interface, name):
+        """
+        Returns a property value. Properties invalidated by the service are
+        fetched with C{Get}.
+
+        @raises KeyError: if the object does not implement C{interface}
+        """
+        props = self.objects[path][interface]
+        try:
+            return props[name]
+        except KeyError:
+            pass
+        value = self.client.call_remote(
+            path,
+            'Get',
+            interface=PROPERTIES_INTERFACE,
+            destination=self.busname,
+            signature='ss',
+            args=[interface, name],
+        )
+        props[name] = value
+        return value
+
+    def paths(self, interface=None):
+        """
+        Returns the paths of all objects, or of those implementing
+        C{interface}
+        """
+        if interface is None:
+            return list(self.objects)
+        return list(self._by_interface.get(interface, ()))
+
+    def objects_with(self, interface):
+        """
+        Returns a C{dict} of path to the properties of C{interface} for the
+        objects implementing it
+        """
+        return dict((path, self.objects[path][interface])
+                    for path in self._by_interface.get(interface, ()))
+
+    # -------------------------------------------------
+
+    def _notify(self, event, path, interface, data):
+        for callback in self._callbacks:
+            try:
+                callback(event, path, interface, data)
+            except Exception:
+                logger.exception('Error in object manager callback')
+
+    def _notify_differences(self, old):
+        for path, interfaces in self.objects.items():
+            old_interfaces = old.get(path, {})
+            for interface, props in interfaces.items():
+                old_props = old_interfaces.get(interface)
+                if old_props is None:
+                    self._notify(ADDED, path, interface, props)
+                    continue
+                changed = dict((name, value) for name, value in props.items()
+                               if name not in old_props or
+                               old_props[name] != value)
+                if changed:
+                    self._notify(CHANGED, path, interface, changed)
+        for path, old_interfaces in old.items():
+            interfaces = self.objects.get(path, {})
+            for interface in old_interfaces:
+                if interface not in interfaces:
+                    self._notify(REMOVED, path, interface, None)
+
+    def _add(self, path, interfaces, notify=False):
+        obj = self.objects.setdefault(path, {})
+        for interface, props in interfaces.items():
+            obj[interface] = dict(props)
+            self._by_interface.setdefault(interface, set()).add(path)
+            if notify:
+                self._notify(ADDED, path, interface, obj[interface])
+
+    def _remove(self, path, interfaces):
+        obj = self.objects.get(path)
+        if obj is None:
+            return
+        for interface in interfaces:
+            if obj.pop(interface, None) is None:
+                continue
+            paths = self._by_interface.get(interface)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self._by_interface[interface]
+            self._notify(REMOVED, path, interface, None)
+        if not obj:
+            del self.objects[path]
+
+    def _on_signal(self, msig):
+        if self._fetching:
+            self._missed.append(msig)
+            return
+
+        queue = self._subscriptions[0].queue if self._subscriptions else None
+        if queue is not None and queue.dropped != self._dropped:
+            # Signals were lost to queue overflow; the mirror cannot be
+            # patched up incrementally any more
+            self._dropped = queue.dropped
+            logger.warning('Signal queue overflowed, refreshing %s %s',
+                           self.busname, self.path)
+            self.refresh()
+            return
+
+        if msig.interface == OBJECT_MANAGER_INTERFACE:
+            if msig.path != self.path:
+                return
+            if msig.member == 'InterfacesAdded':
+                path, interfaces = msig.body
+                self._add(path, interfaces, notify=True)
+            elif msig.member == 'InterfacesRemoved':
+                path, interfaces = msig.body
+                self._remove(path, interfaces)
+
+        elif (msig.interface == PROPERTIES_INTERFACE and
+                msig.member == 'PropertiesChanged'):
+            interface, changed, invalidated = msig.body
+            props = self.get(msig.path, interface)
+            if props is None:
+                return
+            props.update(changed)
+            for name in invalidated:
+                props.pop(name, None)
+            self._notify(CHANGED, msig.path, interface, changed)
@@ -1,17 +1,698 @@
+"""
+Exporting Python objects over DBus.
 
+An exported object subclasses L{DBusObject}, lists the interfaces it
+implements in C{dbus_interfaces} and provides a C{dbus_<Member>} method for
+every DBus method::
+
+    class Calculator(DBusObject):
+        dbus_interfaces = [
+            DBusInterface('com.example.Calculator',
+                          Method('Add', arguments='ii', returns='i'),
+                          Signal('Overflow', arguments='s')),
+        ]
+
+        def dbus_Add(self, a, b):
+            return a + b
+
+    client.export_object(Calculator('/com/example/Calculator'))
+
+The standard Introspectable, Peer and Properties interfaces are implemented
+for every exported object.
+"""
+import logging
+
+from . import marshal
+from .error import IntrospectionFailed, RemoteError
+from .interface import DBusInterface, Method, Signal, quoteattr
+from .message import MethodReturnMessage, ErrorMessage, SignalMessage
+
+logger = logging.getLogger(__name__)
+
+
+INTROSPECTABLE_INTERFACE = 'org.freedesktop.DBus.Introspectable'
+PEER_INTERFACE = 'org.freedesktop.DBus.Peer'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+_introspectable = DBusInterface(
+    INTROSPECTABLE_INTERFACE,
+    Method('Introspect', returns='s'),
+)
+
+_peer = DBusInterface(
+    PEER_INTERFACE,
+    Method('Ping'),
+    Method('GetMachineId', returns='s'),
+)
+
+_properties = DBusInterface(
+    PROPERTIES_INTERFACE,
+    Method('Get', arguments='ss', returns='v'),
+    Method('GetAll', arguments='s', returns='a{sv}'),
+    Method('Set', arguments='ssv'),
+    Signal('PropertiesChanged', arguments='sa{sv}as'),
+)
+
+_standard_interfaces = (_introspectable, _peer, _properties)
+
+_INTROSPECT_HEADER = (
+    '<!DOCTYPE node PUBLIC '
+    '"-//freedesktop//DTD D-BUS Object Introspection 1.0//EN"\n'
+    '"http://www.freedesktop.org/standards/dbus/1.0/introspect.dtd">\n'
+)
+
+_machine_id = None
+
+
+def _get_machine_id():
+    global _machine_id
+    if _machine_id is None:
+        for p in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+            try:
+                with open(p) as f:
+                    _machine_id = f.read().strip()
+                    break
+            except IOError:
+                pass
+        else:
+            raise RemoteError('org.freedesktop.DBus.Error.FileNotFound')
+    return _machine_id
+
+
+def _dbus_error(e):
+    """
+    Returns (error_name, message) for an exception raised by an exported
+    method
+    """
+    if isinstance(e, RemoteError):
+        return e.errName, e.message
+    name = getattr(e, 'dbus_error_name', None)
+    if name is None:
+        name = 'org.freedesktop.DBus.Python.' + type(e).__name__
+    return name, str(e)
+
+
+class DBusObject (object):
+    """
+    Base class for objects exported over DBus
+
+    @ivar object_path: C{str} path the object is exported at
+    @cvar dbus_interfaces: List of L{DBusInterface} implemented by the object
+    """
+    dbus_interfaces = ()
+
+    def __init__(self, object_path):
+        marshal.validate_object_path(object_path)
+        self.object_path = object_path
+        self._handler = None
+
+    def _find_interface(self, interface, kind, name):
+        for iface in self.dbus_interfaces:
+            if interface and iface.name != interface:
+                continue
+            member = getattr(iface, kind).get(name)
+            if member is not None:
+                return iface, member
+        raise RemoteError(
+            'org.freedesktop.DBus.Error.UnknownProperty'
+            if kind == 'properties' else
+            'org.freedesktop.DBus.Error.UnknownMethod')
+
+    def emit_signal(self, interface, name, *args):
+        """
+        Emits a signal defined by one of the object's interfaces. Does
+        nothing while the object is not exported.
+        """
+        iface, sig = self._find_interface(interface, 'signals', name)
+        if self._handler is None:
+            return
+        self._handler.send_signal(
+            self.object_path, iface.name, name, sig.sig, list(args))
+
+    def emit_properties_changed(self, interface, changed, invalidated=()):
+        """
+        Emits C{org.freedesktop.DBus.Properties.PropertiesChanged}
+
+        @param changed: C{dict} of property name to new value
+        @param invalidated: Names of properties whose value changed but is
+                            not sent
+        """
+        if self._handler is None:
+            return
+        values = {}
+        for name, value in changed.items():
+            _, prop = self._find_interface(interface, 'properties', name)
+            values[name] = marshal.wrap_variant(prop.sig, value)
+        self._handler.send_signal(
+            self.object_path, PROPERTIES_INTERFACE, 'PropertiesChanged',
+            'sa{sv}as', [interface, values, list(invalidated)])
+
+    # -------------------------------------------------
+    # org.freedesktop.DBus.Properties
+
+    def get_dbus_property(self, interface, name):
+        _, prop = self._find_interface(interface, 'properties', name)
+        if not prop.readable:
+            raise RemoteError('org.freedesktop.DBus.Error.PropertyWriteOnly')
+        return marshal.wrap_variant(prop.sig, getattr(self, prop.attr))
+
+    def get_all_dbus_properties(self, interface):
+        d = {}
+        for iface in self.dbus_interfaces:
+            if interface and iface.name != interface:
+                continue
+            for prop in iface.properties.values():
+                if prop.readable:
+                    d[prop.name] = marshal.wrap_variant(
+                        prop.sig, getattr(self, prop.attr))
+        return d
+
+    def set_dbus_property(self, interface, name, value):
+        iface, prop = self._find_interface(interface, 'properties', name)
+        if not prop.writeable:
+            raise RemoteError('org.freedesktop.DBus.Error.PropertyReadOnly')
+        setattr(self, prop.attr, value)
+        if prop.emits_change is True:
+            self.emit_properties_changed(iface.name, {name: value})
+        elif prop.emits_change == 'invalidates':
+            self.emit_properties_changed(iface.name, {}, [name])
 
 
 class DBusObjectHandler(object):
+    """
+    Keeps track of the objects exported on a connection and dispatches
+    incoming method calls to them.
+
+    Dispatch goes through a dictionary keyed by (path, interface, member)
+    which is filled when an object is exported, so each call costs a single
+    lookup. Calls without an interface use the (path, None, member) entry.
+    Arguments and replies go through the L{marshal.Codec} of their
+    signature, compiled at export time.
+
+    @ivar disk_cache: Optional L{introspection.DiskCache} used by
+                      L{introspect_remote}
+    @ivar version_properties: C{dict} mapping bus names to the (path,
+                              interface, property) of a version property
+                              that is part of the disk cache key
+    """
 
     def __init__(self, client):
         self.client = client
+        self.exports = {}
+        self._dispatch = {}
+        self._xml_cache = {}
+        self._remote_interfaces = {}
 
+        self.disk_cache = None
+        self.version_properties = {}
+        self._owner_identities = {}
+        # busname -> [NameOwnerChanged subscription, dropped count seen]
+        self._owner_watches = {}
+        self._bus_id = None
 
     def get_remote_object_proxy(self, busname, object_path, interfaces):
-        return RemoteObjectProxy(self, busname, object_path)
+        return RemoteObjectProxy(self, busname, object_path, interfaces)
+
+    def introspect_remote(self, busname, object_path):
+        """
+        Returns the list of L{DBusInterface} implemented by a remote object.
+        Each (busname, object_path) is introspected once per connection, and
+        only once overall for well-known names when a L{disk_cache} is set.
+        The owner of a well-known name is watched, and what was learnt from
+        it is forgotten when it changes, eg. because the service restarted.
+
+        @raises IntrospectionFailed: if the object cannot be introspected
+        """
+        key = (busname, object_path)
+        if busname in self._owner_watches:
+            self._check_owner_watch(busname)
+        try:
+            return self._remote_interfaces[key]
+        except KeyError:
+            pass
+
+        # Imported here to keep the XML parser out of client start up
+        from .introspection import parse_introspection_xml
+
+        if busname[:1] != ':':
+            self._watch_owner(busname)
+        use_disk = self.disk_cache is not None and busname[:1] != ':'
+        identity = None
+        if use_disk:
+            identity = self._owner_identity(busname)
+            if identity is not None:
+                interfaces = self.disk_cache.get(
+                    busname, identity, object_path)
+                if interfaces is not None:
+                    self._remote_interfaces[key] = interfaces
+                    return interfaces
+
+        try:
+            xml = self.client.call_remote(
+                object_path,
+                'Introspect',
+                interface=INTROSPECTABLE_INTERFACE,
+                destination=busname,
+            )
+        except RemoteError as e:
+            raise IntrospectionFailed(
+                'Introspection of %s %s failed: %s' % (
+                    busname, object_path, e))
+
+        interfaces, _ = parse_introspection_xml(xml)
+        self._remote_interfaces[key] = interfaces
+
+        if use_disk:
+            if identity is None:
+                # The call above may have activated the service
+                identity = self._owner_identity(busname)
+            if identity is not None:
+                self.disk_cache.put(busname, identity, object_path,
+                                    interfaces)
+        return interfaces
+
+    def _owner_identity(self, busname):
+        """
+        Returns (bus id, unique name of the owner, version) identifying the
+        process currently owning C{busname}, or None if it has no owner.
+        The owner is watched so that cached data is dropped when it changes.
+        """
+        if busname in self._owner_watches:
+            self._check_owner_watch(busname)
+        try:
+            return self._owner_identities[busname]
+        except KeyError:
+            pass
+
+        client = self.client
+        try:
+            if self._bus_id is None:
+                self._bus_id = client.call_remote(
+                    '/org/freedesktop/DBus',
+                    'GetId',
+                    interface='org.freedesktop.DBus',
+                    destination='org.freedesktop.DBus',
+                )
+            owner = client.call_remote(
+                '/org/freedesktop/DBus',
+                'GetNameOwner',
+                interface='org.freedesktop.DBus',
+                destination='org.freedesktop.DBus',
+                signature='s',
+                args=[busname],
+            )
+            version = None
+            if busname in self.version_properties:
+                path, interface, name = self.version_properties[busname]
+                version = str(client.call_remote(
+                    path,
+                    'Get',
+                    interface=PROPERTIES_INTERFACE,
+                    destination=busname,
+                    signature='ss',
+                    args=[interface, name],
+                ))
+        except RemoteError as e:
+            logger.debug('Cannot identify owner of %s: %s', busname, e)
+            return None
+
+        self._watch_owner(busname)
+        identity = (self._bus_id, owner, version)
+        self._owner_identities[busname] = identity
+        return identity
+
+    def _watch_owner(self, busname):
+        if busname in self._owner_watches:
+            return
+        sub = self.client.add_signal_receiver(
+            self._on_name_owner_changed,
+            interface='org.freedesktop.DBus',
+            member='NameOwnerChanged',
+            path='/org/freedesktop/DBus',
+            arg0=busname,
+        )
+        self._owner_watches[busname] = [sub, sub.queue.dropped]
+
+    def _check_owner_watch(self, busname):
+        watch = self._owner_watches[busname]
+        dropped = watch[0].queue.dropped
+        if dropped != watch[1]:
+            # NameOwnerChanged signals were lost to queue overflow, so the
+            # owner may have changed unnoticed
+            watch[1] = dropped
+            logger.warning('Signal queue overflowed, forgetting owner of %s',
+                           busname)
+            self._forget_owner(busname)
 
+    def _on_name_owner_changed(self, msig):
+        busname = msig.body[0]
+        watch = self._owner_watches.get(busname)
+        if watch is not None:
+            # Everything is forgotten below, lost signals included
+            watch[1] = watch[0].queue.dropped
+        self._forget_owner(busname)
 
+    def _forget_owner(self, busname):
+        from .introspection import forget_interfaces
+
+        self._owner_identities.pop(busname, None)
+
+        names = set()
+        for key in [k for k in self._remote_interfaces if k[0] == busname]:
+            names.update(i.name for i in self._remote_interfaces.pop(key))
+        # The new owner may be an upgraded service with changed interfaces
+        forget_interfaces(n for n in names
+                          if not n.startswith('org.freedesktop.DBus.'))
+
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(busname)
+
+    # -------------------------------------------------
+
+    def export_object(self, obj):
+        """
+        Exports a L{DBusObject} at its C{object_path}
+        """
+        path = obj.object_path
+        if path in self.exports:
+            raise ValueError('An object is already exported at ' + path)
+
+        table = {}
+
+        def add(iface, method, func):
+            table[(path, iface.name, method.name)] = (func, method)
+            table.setdefault((path, None, method.name), (func, method))
+
+        for iface in obj.dbus_interfaces:
+            for method in iface.methods.values():
+                func = getattr(obj, 'dbus_' + method.name, None)
+                if func is None:
+                    raise AttributeError(
+                        '%r does not implement %s.%s' % (
+                            obj, iface.name, method.name))
+                add(iface, method, func)
+                # Compile the argument and reply codecs now rather than on
+                # the first call
+                marshal.compile_signature(method.sig_in)
+                marshal.compile_signature(method.sig_out)
+
+        m = _introspectable.methods
+        add(_introspectable, m['Introspect'],
+            lambda: self.introspect(path))
+        m = _peer.methods
+        add(_peer, m['Ping'], lambda: None)
+        add(_peer, m['GetMachineId'], _get_machine_id)
+        m = _properties.methods
+        add(_properties, m['Get'], obj.get_dbus_property)
+        add(_properties, m['GetAll'], obj.get_all_dbus_properties)
+        add(_properties, m['Set'], obj.set_dbus_property)
+
+        self.exports[path] = obj
+        self._dispatch.update(table)
+        self._xml_cache.clear()
+        obj._handler = self
+
+    def unexport_object(self, path):
+        obj = self.exports.pop(path)
+        obj._handler = None
+        for key in [k for k in self._dispatch if k[0] == path]:
+            del self._dispatch[key]
+        self._xml_cache.clear()
+
+    def introspect(self, path):
+        """
+        Returns the introspection XML for C{path}. Paths without an exported
+        object list their child nodes only.
+        """
+        try:
+            return self._xml_cache[path]
+        except KeyError:
+            pass
+
+        parts = [_INTROSPECT_HEADER, '<node name=%s>\n' % quoteattr(path)]
+
+        obj = self.exports.get(path)
+        if obj is not None:
+            for iface in _standard_interfaces + tuple(obj.dbus_interfaces):
+                parts.append(iface.introspection_xml())
+
+        prefix = path.rstrip('/') + '/'
+        children = set()
+        for p in self.exports:
+            if p.startswith(prefix):
+                children.add(p[len(prefix):].split('/', 1)[0])
+        for child in sorted(children):
+            parts.append('  <node name=%s/>\n' % quoteattr(child))
+
+        parts.append('</node>\n')
+        xml = ''.join(parts)
+        self._xml_cache[path] = xml
+        return xml
+
+    # -------------------------------------------------
+
+    def handle_method_call(self, mcall, conn=None):
+        """
+        Invokes the exported method addressed by C{mcall} and sends the
+        method return or error reply over C{conn}, by default the handler's
+        client
+        """
+        if conn is None:
+            conn = self.client
+        try:
+            func, method = self._dispatch[
+                (mcall.path, mcall.interface, mcall.member)]
+        except KeyError:
+            if (mcall.member == 'Introspect' and
+                    mcall.interface in (None, INTROSPECTABLE_INTERFACE)):
+                self.send_reply(
+                    conn, mcall, 's', [self.introspect(mcall.path)])
+            elif mcall.path in self.exports:
+                self.send_error(
+                    conn, mcall, 'org.freedesktop.DBus.Error.UnknownMethod',
+                    'Unknown method %s.%s' % (mcall.interface, mcall.member))
+            else:
+                self.send_error(
+                    conn, mcall, 'org.freedesktop.DBus.Error.UnknownObject',
+                    'No object exported at ' + mcall.path)
+            return
+
+        if (mcall.signature or '') != method.sig_in:
+            self.send_error(
+                conn, mcall, 'org.freedesktop.DBus.Error.InvalidArgs',
+                'Expected signature "%s", received "%s"' % (
+                    method.sig_in, mcall.signature or ''))
+            return
+
+        try:
+            result = func(*(mcall.body or ()))
+        except Exception as e:
+            if not isinstance(e, RemoteError):
+                logger.debug('Exported method %s raised', method.name,
+                             exc_info=True)
+            name, msg = _dbus_error(e)
+            self.send_error(conn, mcall, name, msg)
+            return
+
+        if method.nret == 0:
+            body = None
+        elif method.nret == 1:
+            body = [result]
+        else:
+            body = list(result)
+
+        self.send_reply(conn, mcall, method.sig_out, body)
+
+    def answer_peer_call(self, conn, mcall, reason):
+        """
+        Answers the C{org.freedesktop.DBus.Peer} methods every connection
+        implements and replies C{UnknownMethod} to any other call. For
+        clients that cannot export objects.
+
+        @param reason: Why other calls are rejected, for the error message
+        """
+        if mcall.interface in (None, PEER_INTERFACE):
+            if mcall.member == 'Ping':
+                self.send_reply(conn, mcall, None, None)
+                return
+            if mcall.member == 'GetMachineId':
+                self.send_reply(conn, mcall, 's', [_get_machine_id()])
+                return
+        self.send_error(
+            conn, mcall, 'org.freedesktop.DBus.Error.UnknownMethod',
+            'No method %s.%s %s' % (mcall.interface, mcall.member, reason))
+
+    def send_reply(self, conn, mcall, signature, body):
+        if not mcall.expect_reply:
+            return
+        mret = MethodReturnMessage(
+            mcall.serial,
+            body=body,
+            destination=mcall.sender,
+            signature=signature or None,
+            serial=conn.next_serial(),
+        )
+        conn.send_message(mret)
+
+    def send_error(self, conn, mcall, error_name, msg=None):
+        if not mcall.expect_reply:
+            return
+        merr = ErrorMessage(
+            error_name,
+            mcall.serial,
+            destination=mcall.sender,
+            signature='s' if msg else None,
+            body=[msg] if msg else None,
+            serial=conn.next_serial(),
+        )
+        conn.send_message(merr)
+
+    def send_signal(self, path, interface, member, signature, body):
+        self._send_signal(self.client, path, interface, member, signature,
+                          body)
+
+    def _send_signal(self, conn, path, interface, member, signature, body):
+        msig = SignalMessage(
+            path,
+            member,
+            interface,
+            signature=signature or None,
+            body=body,
+            serial=conn.next_serial(),
+        )
+        conn.send_message(msig)
+
+
+class RemoteMethod (object):
+    """
+    A method of a remote object, called with its DBus arguments. The
+    C{timeout} keyword argument overrides the client's default timeout.
+    """
+    __slots__ = ('proxy', 'interface', 'method')
+
+    def __init__(self, proxy, interface, method):
+        self.proxy = proxy
+        self.interface = interface
+        self.method = method
+
+    def __repr__(self):
+        return '<RemoteMethod %s.%s(%s) of %s>' % (
+            self.interface, self.method.name, self.method.sig_in,
+            self.proxy.object_path)
+
+    def __call__(self, *args, **kwargs):
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % (
+                ', '.join(kwargs),))
+        method = self.method
+        if len(args) != method.nargs:
+            raise TypeError('%s takes %d arguments (%d given)' % (
+                method.name, method.nargs, len(args)))
+        proxy = self.proxy
+        return proxy._handler.client.call_remote(
+            proxy.object_path,
+            method.name,
+            interface=self.interface,
+            destination=proxy.busname,
+            signature=method.sig_in or None,
+            args=list(args) if args else None,
+            timeout=timeout,
+        )
 
 
 class RemoteObjectProxy(object):
-    pass
\ No newline at end of file
+    """
+    Proxy for an object exported by another connection. The object is
+    introspected on first use and its DBus methods become attributes::
+
+        manager = client.get_object('org.freedesktop.systemd1',
+                                    '/org/freedesktop/systemd1')
+        unit_path = manager.GetUnit('dbus.service')
+
+    @ivar interfaces: The L{DBusInterface} list of the object, restricted to
+                      the interface names given to the constructor if any
+    """
+
+    def __init__(self, obj_handler, busname, object_path, interfaces=None):
+        if isinstance(interfaces, marshal.string_types):
+            interfaces = [interfaces]
+        self._handler = obj_handler
+        self._interface_names = interfaces
+        self._interfaces = None
+        self.busname = busname
+        self.object_path = object_path
+
+    def __repr__(self):
+        return '<RemoteObjectProxy %s %s>' % (self.busname, self.object_path)
+
+    @property
+    def interfaces(self):
+        if self._interfaces is None:
+            found = self._handler.introspect_remote(
+                self.busname, self.object_path)
+            if self._interface_names:
+                by_name = dict((i.name, i) for i in found)
+                found = [by_name[n] for n in self._interface_names
+                         if n in by_name]
+            self._interfaces = found
+        return self._interfaces
+
+    def _find(self, kind, name, interface=None):
+        for iface in self.interfaces:
+            if interface and iface.name != interface:
+                continue
+            member = getattr(iface, kind).get(name)
+            if member is not None:
+                return iface, member
+        return None, None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        iface, method = self._find('methods', name)
+        if method is None:
+            raise AttributeError('%r has no method %s' % (self, name))
+        func = RemoteMethod(self, iface.name, method)
+        # Later lookups find the method without going through __getattr__
+        self.__dict__[name] = func
+        return func
+
+    def get_property(self, name, interface=None, timeout=None):
+        iface, prop = self._find('properties', name, interface)
+        if prop is None:
+            raise AttributeError('%r has no property %s' % (self, name))
+        return self._handler.client.call_remote(
+            self.object_path,
+            'Get',
+            interface=PROPERTIES_INTERFACE,
+            destination=self.busname,
+            signature='ss',
+            args=[iface.name, name],
+            timeout=timeout,
+        )
+
+    def set_property(self, name, value, interface=None, timeout=None):
+        iface, prop = self._find('properties', name, interface)
+        if prop is None:
+            raise AttributeError('%r has no property %s' % (self, name))
+        self._handler.client.call_remote(
+            self.object_path,
+            'Set',
+            interface=PROPERTIES_INTERFACE,
+            destination=self.busname,
+            signature='ssv',
+            args=[iface.name, name, marshal.wrap_variant(prop.sig, value)],
+            timeout=timeout,
+        )
+
+    def get_all_properties(self, interface, timeout=None):
+        return self._handler.client.call_remote(
+            self.object_path,
+            'GetAll',
+            interface=PROPERTIES_INTERFACE,
+            destination=self.busname,
+            signature='s',
+            args=[interface],
+            timeout=timeout,
+        )
@@ -0,0 +1,340 @@
+"""
+Pool of bus connections for spreading calls from many greenlets.
+
+Every L{dbuspy.client.Client} pays for a socket, the SASL exchange and a
+C{Hello} round trip, and the bus daemon queues messages per connection. A
+L{ClientPool} keeps between C{min_size} and C{max_size} connections around
+and hands them out either exclusively (L{CHECKOUT}) or by routing each call
+to the connection with the fewest calls in flight (L{LEAST_OUTSTANDING})::
+
+    pool = ClientPool('system', max_size=8)
+    with pool.connection() as client:
+        client.call_remote(...)
+    pool.call_remote(...)
+"""
+import collections
+import contextlib
+import logging
+import socket
+import time
+
+from gevent.lock import Semaphore
+
+from . import get_client
+from .error import ConnectionClosed, DBusException, TimeOut
+
+logger = logging.getLogger(__name__)
+
+
+CHECKOUT = 'checkout'
+LEAST_OUTSTANDING = 'least-outstanding'
+
+# Errors after which a connection is not handed out again
+_CONNECTION_ERRORS = (socket.error, EOFError, ConnectionClosed)
+
+
+class PoolClosed (DBusException):
+    pass
+
+
+class _PooledClient (object):
+    __slots__ = ('client', 'outstanding', 'last_used', 'last_checked')
+
+    def __init__(self, client):
+        now = time.time()
+        self.client = client
+        self.outstanding = 0
+        self.last_used = now
+        self.last_checked = now
+
+
+class ClientPool (object):
+    """
+    A pool of connected clients for one bus address.
+
+    Connections are opened lazily: the first use warms the pool up to
+    C{min_size} and more are added on demand up to C{max_size}. A connection
+    that has been idle for C{health_check_interval} seconds is pinged before
+    it is handed out again and replaced if the bus does not answer.
+
+    @ivar metrics: C{dict} of counters, see L{stats}
+    """
+
+    def __init__(self, bus_adress='system', min_size=1, max_size=8,
+                 routing=CHECKOUT, health_check_interval=30.0,
+                 health_check_timeout=5.0, client_factory=None):
+        """
+        @param bus_adress: 'session', 'system' or a DBus address
+        @param routing: L{CHECKOUT} or L{LEAST_OUTSTANDING}, the strategy
+                        used by L{call_remote}
+        @param client_factory: Callable returning a connected client. Defaults
+                               to C{dbuspy.get_client(bus_adress).connect()}
+        """
+        if routing not in (CHECKOUT, LEAST_OUTSTANDING):
+            raise ValueError('Unknown routing strategy: %r' % (routing,))
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Invalid pool size limits')
+
+        self.bus_adress = bus_adress
+        self.min_size = min_size
+        self.max_size = max_size
+        self.routing = routing
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._client_factory = client_factory or self._connect
+
+        self._members = []
+        self._idle = collections.deque()
+        self._slots = Semaphore(max_size)
+        self._grow_lock = Semaphore()
+        self._warm = False
+        self._closed = False
+
+        self.metrics = {
+            'created': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'checkout_waits': 0,
+            'checkout_wait_time': 0.0,
+            'calls': 0,
+            'health_checks': 0,
+            'health_failures': 0,
+        }
+
+    def __len__(self):
+        return len(self._members)
+
+    def _connect(self):
+        return get_client(self.bus_adress).connect()
+
+    # -------------------------------------------------
+
+    def warm_up(self):
+        """
+        Opens connections until the pool holds C{min_size} of them
+        """
+        self._warm = True
+        while len(self._members) < self.min_size:
+            if self._add_member(limit=self.min_size, idle=True) is None:
+                break
+
+    def _add_member(self, limit=None, idle=False):
+        """
+        Opens a new connection. With C{limit}, returns None instead if the
+        pool reached that size while waiting for another one to open.
+        """
+        with self._grow_lock:
+            if self._closed:
+                raise PoolClosed()
+            if limit is not None and len(self._members) >= limit:
+                return None
+            member = _PooledClient(self._client_factory())
+            self._members.append(member)
+            if idle:
+                self._idle.append(member)
+            self.metrics['created'] += 1
+            return member
+
+    def _discard(self, member):
+        if member in self._members:
+            self._members.remove(member)
+            self.metrics['discarded'] += 1
+        try:
+            self._idle.remove(member)
+        except ValueError:
+            pass
+        try:
+            member.client.teardown()
+        except Exception:
+            pass
+
+    def _is_healthy(self, member):
+        """
+        Pings the bus daemon over the member connection if it has been
+        neither used nor checked within the health check interval
+        """
+        now = time.time()
+        if (now - max(member.last_used, member.last_checked) <
+                self.health_check_interval):
+            return True
+
+        self.metrics['health_checks'] += 1
+        try:
+            member.client.call_remote(
+                '/org/freedesktop/DBus',
+                'Ping',
+                interface='org.freedesktop.DBus.Peer',
+                destination='org.freedesktop.DBus',
+                timeout=self.health_check_timeout,
+            )
+        except Exception as e:
+            logger.warning('Pooled connection failed health check: %r', e)
+            self.metrics['health_failures'] += 1
+            return False
+
+        member.last_checked = now
+        return True
+
+    # -------------------------------------------------
+
+    def checkout(self, timeout=None):
+        """
+        Takes a client out of the pool for exclusive use, waiting up to
+        C{timeout} seconds for one to become available. Must be returned
+        with L{checkin}. Only available on L{CHECKOUT} pools, since the
+        connections of a L{LEAST_OUTSTANDING} pool are shared.
+
+        @raises TimeOut: if no connection became available in time
+        """
+        if self.routing != CHECKOUT:
+            raise ValueError('Connections of a %s pool cannot be checked out'
+                             % (self.routing,))
+        if self._closed:
+            raise PoolClosed()
+        if not self._warm:
+            self.warm_up()
+
+        if self._slots.locked():
+            self.metrics['checkout_waits'] += 1
+            start = time.time()
+            acquired = self._slots.acquire(timeout=timeout)
+            self.metrics['checkout_wait_time'] += time.time() - start
+        else:
+            acquired = self._slots.acquire(blocking=False)
+
+        if not acquired:
+            raise TimeOut('No pooled connection available')
+
+        try:
+            # Holding a slot guarantees that a connection is idle whenever
+            # the pool is at its size limit, so this loop terminates
+            member = None
+            while member is None:
+                member = (self._take_idle() or
+                          self._add_member(limit=self.max_size))
+        except BaseException:
+            self._slots.release()
+            raise
+
+        member.outstanding += 1
+        self.metrics['checkouts'] += 1
+        return member.client
+
+    def _take_idle(self):
+        while self._idle:
+            member = self._idle.pop()
+            if self._is_healthy(member):
+                return member
+            self._discard(member)
+        return None
+
+    def checkin(self, client, discard=False):
+        """
+        Returns a client obtained from L{checkout}. Clients whose connection
+        failed should be returned with C{discard=True}.
+        """
+        member = self._find(client)
+        if member is None:
+            return
+        member.outstanding -= 1
+        member.last_used = time.time()
+        if discard or self._closed:
+            self._discard(member)
+        else:
+            self._idle.append(member)
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager wrapping L{checkout} and L{checkin}, for L{CHECKOUT}
+        pools. The client is discarded if the block raises a connection
+        error.
+        """
+        client = self.checkout(timeout)
+        discard = False
+        try:
+            yield client
+        except _CONNECTION_ERRORS:
+            discard = True
+            raise
+        finally:
+            self.checkin(client, discard)
+
+    def _find(self, client):
+        for member in self._members:
+            if member.client is client:
+                return member
+        return None
+
+    # -------------------------------------------------
+
+    def _least_outstanding(self):
+        if self._closed:
+            raise PoolClosed()
+        if not self._warm:
+            self.warm_up()
+
+        while True:
+            best = None
+            for member in self._members:
+                if best is None or member.outstanding < best.outstanding:
+                    best = member
+
+            if best is None or (best.outstanding and
+                                len(self._members) < self.max_size):
+                member = self._add_member(limit=self.max_size)
+                if member is not None:
+                    return member
+                continue
+
+            if best.outstanding or self._is_healthy(best):
+                return best
+
+            self._discard(best)
+
+    def call_remote(self, *args, **kwargs):
+        """
+        Calls C{call_remote} on a pooled client, chosen according to the
+        pool's routing strategy. Accepts the arguments of
+        L{dbuspy.client.Client.call_remote}.
+        """
+        self.metrics['calls'] += 1
+
+        if self.routing == CHECKOUT:
+            with self.connection() as client:
+                return client.call_remote(*args, **kwargs)
+
+        member = self._least_outstanding()
+        member.outstanding += 1
+        try:
+            return member.client.call_remote(*args, **kwargs)
+        except _CONNECTION_ERRORS:
+            self._discard(member)
+            raise
+        finally:
+            member.outstanding -= 1
+            member.last_used = time.time()
+
+    # -------------------------------------------------
+
+    def stats(self):
+        """
+        Returns pool metrics: the counters in C{metrics} plus the current
+        number of connections, idle connections and calls in flight
+        """
+        d = dict(self.metrics)
+        d['size'] = len(self._members)
+        d['idle'] = sum(1 for m in self._members if not m.outstanding)
+        d['outstanding'] = sum(m.outstanding for m in self._members)
+        return d
+
+    def close(self):
+        """
+        Closes idle connections. Checked out clients are closed when they
+        are returned.
+        """
+        self._closed = True
+        for member in list(self._members):
+            if not member.outstanding:
+                self._discard(member)
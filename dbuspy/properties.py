@@ -0,0 +1,235 @@
+"""
+Client-side cache of remote object properties.
+
+A L{PropertyCache} fetches all properties of an (object, interface) with
+C{GetAll} on first access and subscribes to its C{PropertiesChanged} signal.
+Later reads are served from memory and the signal keeps the values current,
+so reading unchanged properties causes no bus traffic::
+
+    cache = PropertyCache(client)
+    state = cache.get('org.freedesktop.systemd1', unit_path,
+                      'org.freedesktop.systemd1.Unit', 'ActiveState')
+"""
+import collections
+import logging
+import time
+
+from gevent.event import AsyncResult
+
+logger = logging.getLogger(__name__)
+
+
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+
+class _Entry (object):
+    __slots__ = ('values', 'invalidated', 'subscription', 'last_used',
+                 'fetching', 'fetched', 'dropped')
+
+    def __init__(self):
+        self.values = {}
+        self.invalidated = set()
+        self.subscription = None
+        self.last_used = time.time()
+        self.fetching = True
+        # Set once GetAll returned, for readers arriving meanwhile
+        self.fetched = AsyncResult()
+        self.dropped = 0
+
+
+class PropertyCache (object):
+    """
+    Property values of remote objects, kept up to date by
+    C{PropertiesChanged} signals.
+
+    Concurrent readers of an entry being fetched wait for its C{GetAll}.
+    When C{PropertiesChanged} signals were lost to queue overflow the entry
+    is fetched again on next read.
+
+    Each cached (bus name, object path, interface) holds one match rule on
+    the bus, and bus daemons limit the number of match rules per connection
+    (512 by default on the system bus), so keep C{maxsize} below that limit.
+
+    @ivar maxsize: Maximum number of cached (object, interface) entries.
+                   The least recently used entry is evicted first
+    @ivar idle_timeout: Seconds after which an unused entry is evicted, or
+                        None
+    """
+
+    def __init__(self, client, maxsize=256, idle_timeout=300.0):
+        self.client = client
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        # In least recently used first order
+        self._entries = collections.OrderedDict()
+
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'fetches': 0,
+            'updates': 0,
+            'evictions': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _call_properties(self, busname, path, method, signature, args):
+        return self.client.call_remote(
+            path,
+            method,
+            interface=PROPERTIES_INTERFACE,
+            destination=busname,
+            signature=signature,
+            args=args,
+        )
+
+    # -------------------------------------------------
+
+    def get(self, busname, path, interface, name):
+        """
+        Returns the value of a property
+        """
+        entry = self._entry(busname, path, interface)
+        if name in entry.values and name not in entry.invalidated:
+            self.metrics['hits'] += 1
+            return entry.values[name]
+
+        self.metrics['misses'] += 1
+        value = self._call_properties(
+            busname, path, 'Get', 'ss', [interface, name])
+        entry.values[name] = value
+        entry.invalidated.discard(name)
+        return value
+
+    def get_all(self, busname, path, interface):
+        """
+        Returns a C{dict} of all properties of an interface
+        """
+        entry = self._entry(busname, path, interface)
+        if entry.invalidated:
+            self.metrics['misses'] += 1
+            for name in list(entry.invalidated):
+                entry.values[name] = self._call_properties(
+                    busname, path, 'Get', 'ss', [interface, name])
+                entry.invalidated.discard(name)
+        else:
+            self.metrics['hits'] += 1
+        return dict(entry.values)
+
+    def invalidate(self, busname, path, interface=None):
+        """
+        Evicts cached entries of an object, for one interface or all
+        """
+        for key in list(self._entries):
+            if key[:2] == (busname, path) and (
+                    interface is None or key[2] == interface):
+                self._evict(key)
+
+    def clear(self):
+        for key in list(self._entries):
+            self._evict(key)
+
+    def stats(self):
+        d = dict(self.metrics)
+        d['size'] = len(self._entries)
+        return d
+
+    # -------------------------------------------------
+
+    def _entry(self, busname, path, interface):
+        key = (busname, path, interface)
+        now = time.time()
+        self._expire(now)
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.last_used = now
+            self._entries[key] = entry
+            if entry.fetching:
+                # Raises if the fetch failed
+                entry.fetched.get()
+            elif entry.subscription.queue.dropped != entry.dropped:
+                logger.warning('Signal queue overflowed, fetching %s %s %s '
+                               'again', busname, path, interface)
+                entry.fetching = True
+                entry.fetched = AsyncResult()
+                entry.invalidated = set()
+                self._fetch(key, entry)
+            return entry
+
+        while len(self._entries) >= self.maxsize:
+            self._evict(next(iter(self._entries)))
+
+        entry = _Entry()
+        self._entries[key] = entry
+        try:
+            # Subscribe before fetching so that no change is missed
+            entry.subscription = self.client.add_signal_receiver(
+                lambda msig: self._on_properties_changed(key, msig),
+                interface=PROPERTIES_INTERFACE,
+                member='PropertiesChanged',
+                path=path,
+                sender=busname,
+                arg0=interface,
+            )
+        except Exception as e:
+            self._evict(key)
+            entry.fetched.set_exception(e)
+            raise
+        self._fetch(key, entry)
+        return entry
+
+    def _fetch(self, key, entry):
+        busname, path, interface = key
+        entry.dropped = entry.subscription.queue.dropped
+        try:
+            self.metrics['fetches'] += 1
+            values = self._call_properties(
+                busname, path, 'GetAll', 's', [interface])
+        except Exception as e:
+            self._evict(key)
+            entry.fetched.set_exception(e)
+            raise
+
+        # Changes received while GetAll was in flight may be older or newer
+        # than its result; those properties are fetched again on next read
+        entry.values = dict(values or {})
+        entry.fetching = False
+        entry.fetched.set(None)
+
+    def _expire(self, now):
+        if self.idle_timeout is None:
+            return
+        limit = now - self.idle_timeout
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.last_used >= limit:
+                break
+            self._evict(key)
+
+    def _evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.metrics['evictions'] += 1
+        if entry.subscription is not None:
+            try:
+                self.client.remove_signal_receiver(entry.subscription)
+            except Exception as e:
+                logger.debug('Failed to remove property subscription: %r', e)
+
+    def _on_properties_changed(self, key, msig):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        _, changed, invalidated = msig.body
+        self.metrics['updates'] += 1
+        if entry.fetching:
+            entry.invalidated.update(changed)
+            entry.invalidated.update(invalidated)
+            return
+        for name, value in changed.items():
+            entry.values[name] = value
+            entry.invalidated.discard(name)
+        entry.invalidated.update(invalidated)
@@ -1,10 +1,10 @@
 # import gevent.socket as socket
+import logging
 import os.path
-import struct
-from gevent.event import Event, AsyncResult
 
-from .authentication import ClientAuthenticator
-import six
+import gevent
+
+from .authentication import ClientAuthenticator, PipelinedClientAuthenticator
 
 _is_linux = False
 
@@ -13,173 +13,117 @@ if os.path.exists('/proc/version'):
         if f.read().startswith('Linux'):
             _is_linux = True
             
-from .error import DBusAuthenticationFailed, RemoteError
-from . import message
-
-
-MSG_HDR_LEN = 16  # including 4-byte padding for array of structure
+from .error import ConnectionClosed, TimeOut
+from .connection import BaseConnection
+from .metrics import IO_WAIT, clock
 
-class ClientBase(object):
-    _buffer = b''
-    _receivedFDs = []
-    _toBeSentFDs = []
+logger = logging.getLogger(__name__)
 
-    _nextMsgLen = 0
-    _endian = '<'
-    
-    _firstByte = True
-    _unix_creds = None  # (pid, uid, gid) from UnixSocket credential passing
-    authenticator = None  # Class to handle DBus authentication
-    MAX_MSG_LENGTH = 2**27
 
-    guid = None  # Filled in with the GUID of the server (for client protocol)
-    # or the username of the authenticated client (for server protocol)
+class ClientBase(BaseConnection):
+    """
+    gevent based DBus connection. Once authenticated, a reader greenlet
+    receives all messages and completes the L{AsyncResult} of each pending
+    method call.
 
+    @ivar default_timeout: Seconds to wait for a method reply when the caller
+                           does not give a timeout. None waits forever.
+    """
 
-    def __init__(self, transport):
-        self.rx_ev = Event()
-        self.ret_val = None
+    def __init__(self, transport, timeout=None):
+        BaseConnection.__init__(self)
         self._transport = transport
+        self._reader = None
+        self.default_timeout = timeout
+
+    def connect(self, target=None, fast=False):
+        """
+        Authenticates the connection.
 
-    def connect(self, target=None):
+        @param fast: Use the single round trip
+                     L{PipelinedClientAuthenticator}, which only supports
+                     EXTERNAL authentication over unix sockets
+        """
+        if fast:
+            PipelinedClientAuthenticator().authenticate(
+                self, self._pipelined_messages())
+            return self
         # self._transport.connect(target)
         # DBus specification requires that clients send a null byte upon
         # connection to the bus
         self._transport.send(b'\0')
         # do auth
-        # print "authenticating"
         ClientAuthenticator().authenticate(self)
         return self
-        
+
+    def _pipelined_messages(self):
+        """
+        Returns raw messages to send together with the authentication
+        commands in a fast connect
+        """
+        return b''
+
     def write(self, data):
-        # print msg.rawMessage
-        # self._transport.send(b"GET / HTTP/1.0\r\n'")
-        # print ">>> %r" % data
-        self._transport.send(data)
+        if self.metrics.enabled:
+            self.metrics.bytes_sent(len(data))
+        self._transport.sendall(data)
 
     def read(self):
-        # print msg.rawMessage
-        # self._transport.send(b"GET / HTTP/1.0\r\n'")
-        data =  self._transport.recv(1024)
-        # print "<<< %r" % data
-        return data
+        return self._transport.recv(4096)
 
-    def await_result(self):
-        try:
-            if self.rx_ev.is_set():
-                raise RuntimeError("already pending result")
+    def start_reading(self):
+        """
+        Spawns the greenlet that reads and dispatches incoming messages
+        """
+        if self._reader is None:
+            self._reader = gevent.spawn(self._read_loop)
 
-            while not self.rx_ev.is_set():
+    def _read_loop(self):
+        try:
+            while True:
                 data = self.read()
                 if not data:
-                    raise Exception("ConnectionClosed")
-                # print data
-                self.on_data_received(data)
-
-            return self.ret_val
+                    break
+                try:
+                    self.on_data_received(data)
+                except Exception:
+                    logger.exception('Error processing received message')
+        except Exception as e:
+            logger.debug('Reader stopped: %r', e)
         finally:
-            self.rx_ev.clear()
-                
-    def on_data_received(self, data):
-        self._buffer = self._buffer + data
-        buffer_len = len(self._buffer)
-
-        if self._nextMsgLen == 0 and buffer_len >= 16:
-            # There would be multiple clients using different endians.
-            # Reset endian every time.
-            if self._buffer[:1] != b'l':
-                self._endian = '>'
-            else:
-                self._endian = '<'
-
-            body_len = struct.unpack(
-                self._endian + 'I', self._buffer[4:8])[0]
-            harr_len = struct.unpack(
-                self._endian + 'I', self._buffer[12:16])[0]
-
-            hlen = MSG_HDR_LEN + harr_len
-
-            padlen = hlen % 8 and (8 - hlen % 8) or 0
-
-            self._nextMsgLen = (
-                MSG_HDR_LEN +
-                harr_len +
-                padlen +
-                body_len
-            )
-
-        if self._nextMsgLen != 0 and buffer_len >= self._nextMsgLen:
-            raw_msg = self._buffer[:self._nextMsgLen]
-            self._buffer = self._buffer[self._nextMsgLen:]
-
-            self._nextMsgLen = 0
-
-            self.process_raw_dbus_message(raw_msg)
-
-            if self._buffer:
-                # Recursively process any other complete messages
-                self.on_data_received(b'')
-        
-
-    def process_raw_dbus_message(self, rawMsg):
-        """
-        Called when the raw bytes for a complete DBus message are received
+            self._fail_pending(ConnectionClosed())
 
-        @param rawMsg: Byte-string containing the complete message
-        @type rawMsg: C{str}
+    def await_reply(self, serial, timeout=None, result=None):
         """
-        m = message.parse_message(rawMsg, self._receivedFDs)
-        mt = m._messageType
-
-        self._receivedFDs = []
-
-        if mt == 1:
-            self.on_method_call_received(m)
-        elif mt == 2:
-            self.on_method_return_received(m)
-        elif mt == 3:
-            self.on_error_received(m)
-        elif mt == 4:
-            self.on_signal_received(m)
-            
+        Waits for the reply to the method call with the given serial. On
+        timeout the call is forgotten, so a late reply is discarded instead
+        of being returned to another caller.
+
+        @param result: The L{AsyncResult} returned by C{call_remote_async}.
+                       Needed if the reply may already have been received,
+                       since completed calls leave the pending table.
+        @raises TimeOut: if no reply arrived within C{timeout} seconds
+        """
+        fut = result if result is not None else self._pending.get(serial)
+        if fut is None:
+            raise KeyError('No pending call with serial %d' % (serial,))
+        started = clock() if self.metrics.enabled else None
+        try:
+            return fut.get(timeout=timeout)
+        except gevent.Timeout:
+            if fut.ready():
+                # The reply won the race against the timer
+                return fut.get()
+            raise TimeOut('No reply to method call %d within %s seconds' % (
+                serial, timeout))
+        finally:
+            self._pending.pop(serial, None)
+            if started is not None:
+                self.metrics.time_spent(IO_WAIT, clock() - started)
+                self._call_finished(serial, True)
 
     def teardown(self):
         self._transport.close()
-
-    def on_method_call_received(self, mcall):
-        """
-        Called when a DBus METHOD_CALL message is received
-        """
-        raise NotImplementedError
-
-
-    def on_method_return_received(self, mret):
-        """
-        Called when a DBus METHOD_RETURN message is received
-        """
-        self.rx_ev.set()
-        self.ret_val = mret
-
-    def on_error_received(self, merr):
-        """
-        Called when a DBus ERROR message is received
-        """
-        e = RemoteError(merr.error_name)
-        e.message = ''
-        e.values = []
-        if merr.body:
-            if isinstance(merr.body[0], six.string_types):
-                e.message = merr.body[0]
-            e.values = merr.body
-        raise e
-
-    def on_signal_received(self, msig):
-        """
-        Called when a DBus METHOD_CALL message is received
-        """
-        # raise NotImplementedError
-        print "signal", msig
-
-
-    def on_connection_authenticated(self):
-        print "authenticated!!"
\ No newline at end of file
+        if (self._reader is not None and
+                self._reader is not gevent.getcurrent()):
+            self._reader.kill(block=False)
@@ -0,0 +1,218 @@
+"""
+Peer-to-peer DBus connections, without a bus daemon in between.
+
+A L{Server} listens on a unix socket address, runs the server side of the
+SASL EXTERNAL authentication and serves the objects exported on it to every
+connected peer::
+
+    server = Server('unix:path=/run/myapp/dbus.sock').start()
+    server.export_object(MyObject('/com/example/MyObject'))
+
+    # in the other process
+    client = dbuspy.get_peer_client('unix:path=/run/myapp/dbus.sock')
+    client.call_remote('/com/example/MyObject', 'Method', ...)
+
+Peer connections skip the C{Hello} call and have no unique bus name. Signals
+are sent to every connected peer; match rules are not sent since there is no
+bus daemon to evaluate them, and subscriptions are filtered locally.
+"""
+import binascii
+import logging
+import os
+import socket
+import stat
+
+import gevent
+from gevent.server import StreamServer
+import gevent.socket as gsocket
+
+from .address import parse_bus_address, unix_socket_path
+from .authentication import ServerAuthenticator
+from .client import Client
+from .error import DBusAuthenticationFailed
+from .objects import DBusObjectHandler
+
+logger = logging.getLogger(__name__)
+
+
+class PeerClient (Client):
+    """
+    A L{Client} connected directly to another process rather than to a bus
+    daemon
+    """
+
+    def on_connection_authenticated(self):
+        self.start_reading()
+
+    def _pipelined_messages(self):
+        return b''
+
+    def _add_match(self, rule):
+        pass
+
+    def _remove_match(self, rule):
+        pass
+
+
+class PeerConnection (PeerClient):
+    """
+    The server side of a connection accepted by a L{Server}. Method calls
+    are dispatched to the objects exported on the server.
+
+    @ivar guid: uid of the authenticated peer
+    """
+
+    def __init__(self, server, transport, timeout=None):
+        PeerClient.__init__(self, transport, timeout)
+        self.server = server
+        self.obj_handler = server.obj_handler
+
+    def __repr__(self):
+        return '<DBusPeerConnection(uid=%s)>' % (self.guid,)
+
+    def accept(self):
+        """
+        Authenticates the peer. Messages are read by L{serve}.
+        """
+        ServerAuthenticator(
+            self.server.guid, self.server.allowed_uids).authenticate(self)
+        return self
+
+    def on_connection_authenticated(self):
+        pass
+
+    def serve(self):
+        """
+        Reads and dispatches messages in the calling greenlet until the
+        peer disconnects
+        """
+        self._reader = gevent.getcurrent()
+        self._read_loop()
+
+
+class _ServerObjectHandler (DBusObjectHandler):
+    """
+    Object handler shared by all connections of a L{Server}. Signals are
+    sent to every connected peer.
+    """
+
+    def __init__(self, server):
+        DBusObjectHandler.__init__(self, None)
+        self.server = server
+
+    def send_signal(self, path, interface, member, signature, body):
+        for conn in list(self.server.connections):
+            try:
+                self._send_signal(
+                    conn, path, interface, member, signature, body)
+            except (socket.error, OSError) as e:
+                logger.debug('Failed to send signal to %r: %r', conn, e)
+
+
+class Server (object):
+    """
+    Listens for peer-to-peer DBus connections on a unix socket
+
+    @ivar guid: Hex encoded GUID of this server
+    @ivar connections: C{set} of connected L{PeerConnection}
+    """
+
+    def __init__(self, address, on_connection=None, allowed_uids=None,
+                 timeout=None):
+        """
+        @param address: A unix DBus address with a C{path} or C{abstract} key
+        @param on_connection: Called with each authenticated
+                              L{PeerConnection}
+        @param allowed_uids: uids allowed to connect. Defaults to the uid of
+                             this process
+        @param timeout: Default method call timeout of the connections
+        """
+        kind, params = parse_bus_address(address)
+        if kind != 'unix':
+            raise NotImplementedError(address)
+
+        self._params = params
+        self.path = unix_socket_path(params)
+        self.on_connection = on_connection
+        self.allowed_uids = allowed_uids
+        self.timeout = timeout
+        self.guid = binascii.hexlify(os.urandom(16))
+        self.connections = set()
+        self.obj_handler = _ServerObjectHandler(self)
+        self._server = None
+
+    @property
+    def address(self):
+        """
+        The address clients connect to, including the server GUID
+        """
+        if 'abstract' in self._params:
+            addr = 'unix:abstract=' + self._params['abstract']
+        else:
+            addr = 'unix:path=' + self.path
+        return addr + ',guid=' + self.guid.decode('ascii')
+
+    def export_object(self, obj):
+        self.obj_handler.export_object(obj)
+
+    def unexport_object(self, object_path):
+        self.obj_handler.unexport_object(object_path)
+
+    # -------------------------------------------------
+
+    def start(self):
+        """
+        Binds the socket and starts accepting connections
+        """
+        if not self.path.startswith('\0'):
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.unlink(self.path)
+            except OSError:
+                pass
+
+        sock = gsocket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(128)
+
+        self._server = StreamServer(sock, self._handle)
+        self._server.start()
+        return self
+
+    def serve_forever(self):
+        if self._server is None:
+            self.start()
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        Stops listening and closes all connections
+        """
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        for conn in list(self.connections):
+            conn.teardown()
+        if not self.path.startswith('\0'):
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _handle(self, sock, addr):
+        conn = PeerConnection(self, sock, self.timeout)
+        try:
+            conn.accept()
+        except (DBusAuthenticationFailed, socket.error) as e:
+            logger.info('Rejected peer connection: %s', e)
+            sock.close()
+            return
+
+        self.connections.add(conn)
+        try:
+            if self.on_connection is not None:
+                self.on_connection(conn)
+            conn.serve()
+        finally:
+            self.connections.discard(conn)
+            sock.close()
@@ -0,0 +1,233 @@
+"""
+Signal subscriptions and the bounded queues that buffer signals between the
+connection reader and the subscriber callbacks.
+
+The queues in this module do not block or wake anybody up on their own; the
+client implementations subclass L{SignalQueue} to add the waiting primitives
+of their concurrency model.
+"""
+import collections
+
+# Overflow policies applied when a signal arrives at a full queue
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+COALESCE = 'coalesce'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, COALESCE)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+
+def key_by_path(msig):
+    """
+    Default coalescing key: one pending signal per (path, interface, member).
+    With a C{PropertiesChanged} subscription this keeps only the latest
+    signal for each object path.
+    """
+    return (msig.path, msig.interface, msig.member)
+
+
+class SignalQueue (object):
+    """
+    Bounded FIFO of received signal messages.
+
+    When the queue is full, C{policy} decides what happens to a new signal:
+
+      - L{DROP_OLDEST}: the oldest queued signal is discarded
+      - L{DROP_NEWEST}: the new signal is discarded
+      - L{BLOCK}: the signal is queued anyway; clients stop reading from
+        the connection until the queue has room again. Messages already
+        read are still dispatched, so the queue may exceed C{maxsize} by
+        the signals of one read.
+      - L{COALESCE}: a signal whose key is already queued replaces the queued
+        one in place; a new key on a full queue discards the oldest signal
+
+    @ivar maxsize: Maximum number of queued signals
+    @ivar policy: One of L{OVERFLOW_POLICIES}
+    @ivar dropped: Number of signals discarded because the queue was full
+    @ivar coalesced: Number of signals merged into an already queued one
+    @ivar delivered: Number of signals taken off the queue
+    @ivar high_watermark: Largest queue depth seen so far
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST,
+                 coalesce_key=None):
+        """
+        @param maxsize: C{int} maximum queue depth
+        @param policy: Overflow policy, one of L{OVERFLOW_POLICIES}
+        @param coalesce_key: Callable mapping a signal message to a hashable
+                             key. Only used by the L{COALESCE} policy and
+                             defaults to L{key_by_path}
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown signal queue policy: %r' % (policy,))
+        if maxsize < 1:
+            raise ValueError('Signal queue size must be at least 1')
+
+        if policy == COALESCE:
+            self._key = coalesce_key or key_by_path
+        else:
+            self._key = None
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        # For coalescing queues _items holds keys and _latest the most
+        # recent message for each of them.
+        self._items = collections.deque()
+        self._latest = {}
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.delivered = 0
+        self.high_watermark = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def full(self):
+        return len(self._items) >= self.maxsize
+
+    def put(self, msig):
+        """
+        Queues a signal message, applying the overflow policy
+
+        @returns: False if the signal was discarded, True otherwise
+        """
+        if self._key is not None:
+            key = self._key(msig)
+            if key in self._latest:
+                self._latest[key] = msig
+                self.coalesced += 1
+                return True
+
+        if len(self._items) >= self.maxsize:
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            elif self.policy != BLOCK:
+                self._popleft()
+                self.dropped += 1
+
+        if self._key is not None:
+            self._latest[key] = msig
+            self._items.append(key)
+        else:
+            self._items.append(msig)
+
+        if len(self._items) > self.high_watermark:
+            self.high_watermark = len(self._items)
+
+        return True
+
+    def get(self):
+        """
+        Removes and returns the oldest queued signal. Raises C{IndexError}
+        if the queue is empty.
+        """
+        msig = self._popleft()
+        self.delivered += 1
+        return msig
+
+    def _popleft(self):
+        item = self._items.popleft()
+        if self._key is not None:
+            return self._latest.pop(item)
+        return item
+
+    def clear(self):
+        self._items.clear()
+        self._latest.clear()
+
+    def stats(self):
+        return {
+            'depth': len(self._items),
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'high_watermark': self.high_watermark,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'delivered': self.delivered,
+        }
+
+
+class SignalSubscription (object):
+    """
+    A registered interest in signals matching a D-Bus match rule. Matching
+    signals are queued on C{queue} and handed to C{callback} by the client.
+
+    @ivar callback: Callable invoked with each L{message.SignalMessage}
+    @ivar queue: L{SignalQueue} buffering signals awaiting delivery
+    """
+
+    def __init__(self, callback, queue, interface=None, member=None,
+                 path=None, path_namespace=None, sender=None, arg0=None):
+        if path is not None and path_namespace is not None:
+            raise ValueError('path and path_namespace are mutually exclusive')
+
+        self.callback = callback
+        self.queue = queue
+        self.interface = interface
+        self.member = member
+        self.path = path
+        self.path_namespace = path_namespace
+        self.sender = sender
+        self.arg0 = arg0
+
+        self.rule = self._build_rule()
+
+    def __repr__(self):
+        return '<SignalSubscription(%s)>' % (self.rule,)
+
+    def _build_rule(self):
+        parts = ["type='signal'"]
+        for key in ('sender', 'interface', 'member', 'path',
+                    'path_namespace', 'arg0'):
+            value = getattr(self, key)
+            if value is not None:
+                # Inside quotes a backslash is literal, so the specification
+                # spells a quote by closing the quotes around an escaped one
+                parts.append("%s='%s'" % (key, value.replace("'", "'\\''")))
+        return ','.join(parts)
+
+    def matches(self, msig, owners=None):
+        """
+        Returns True if the signal message satisfies this subscription.
+
+        The bus delivers every signal matching any rule of the connection, so
+        the rule is re-checked locally for each subscription. Signals are sent
+        from unique connection names, so a well-known C{sender} is resolved
+        through C{owners}. It is left to the bus if the name's owner is not
+        known.
+
+        @param owners: C{dict} mapping well-known names to unique names, see
+                       L{names.NameOwnerCache}
+        """
+        if self.member is not None and self.member != msig.member:
+            return False
+        if self.interface is not None and self.interface != msig.interface:
+            return False
+        if self.path is not None and self.path != msig.path:
+            return False
+        if self.path_namespace is not None:
+            ns = self.path_namespace
+            p = msig.path
+            if not (ns == '/' or p == ns or
+                    (p.startswith(ns) and p[len(ns)] == '/')):
+                return False
+        if self.sender is not None and self.sender != msig.sender:
+            if self.sender[:1] == ':':
+                return False
+            if owners is not None:
+                owner = owners.get(self.sender, False)
+                if owner is not False and owner != msig.sender:
+                    return False
+        if self.arg0 is not None:
+            if not msig.body or msig.body[0] != self.arg0:
+                return False
+        return True
@@ -1,4 +1,17 @@
-from gevent_dbus import system_bus
+import array
+import collections
+import fnmatch
+import logging
+import time
+
+import gevent
+from gevent.event import AsyncResult
+
+from dbuspy import system_bus, signals
+from dbuspy.error import (DBusException, IntrospectionFailed, RemoteError,
+                          TimeOut)
+
+logger = logging.getLogger(__name__)
 
 """
 
@@ -23,26 +36,361 @@ MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
 
 UNIT_INTERFACE = "org.freedesktop.systemd1.Unit"
 SERVICE_UNIT_INTERFACE = "org.freedesktop.systemd1.Service"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+UNIT_PATH_PREFIX = OBJECT_PATH + "/unit/"
+
+# Errors meaning that there is no object at a computed unit path
+_NO_UNIT_OBJECT_ERRORS = frozenset([
+    "org.freedesktop.DBus.Error.UnknownObject",
+    "org.freedesktop.DBus.Error.UnknownInterface",
+    "org.freedesktop.DBus.Error.UnknownMethod",
+    "org.freedesktop.systemd1.NoSuchUnit",
+])
+
+# Job results reported by JobRemoved
+JOB_DONE = "done"
+JOB_CANCELED = "canceled"
+JOB_TIMEOUT = "timeout"
+JOB_FAILED = "failed"
+JOB_DEPENDENCY = "dependency"
+JOB_SKIPPED = "skipped"
+
+# Number of results of finished jobs kept for waiters that register late
+FINISHED_JOBS_KEPT = 1024
+
+# Unit file operations of the batched API: method, signature, extra args
+# and whether the reply starts with a carries_install_info flag
+UNIT_FILE_ENABLE = "enable"
+UNIT_FILE_DISABLE = "disable"
+UNIT_FILE_MASK = "mask"
+UNIT_FILE_UNMASK = "unmask"
+
+_UNIT_FILE_OPS = collections.OrderedDict([
+    (UNIT_FILE_DISABLE, ('DisableUnitFiles', 'asb', [False], False)),
+    (UNIT_FILE_UNMASK, ('UnmaskUnitFiles', 'asb', [False], False)),
+    (UNIT_FILE_MASK, ('MaskUnitFiles', 'asbb', [False, True], False)),
+    (UNIT_FILE_ENABLE, ('EnableUnitFiles', 'asbb', [False, True], True)),
+])
+
+# Seconds during which batched unit file operations are collected, from the
+# first one
+UNIT_FILE_BATCH_WINDOW = 0.05
+
+# Resource counters of service units polled by L{ResourcePoller}
+RESOURCE_PROPERTIES = ('MemoryCurrent', 'CPUUsageNSec', 'TasksCurrent',
+                       'IOReadBytes', 'IOWriteBytes')
+
+# Value of the resource properties when accounting is not available
+UINT64_MAX = 2 ** 64 - 1
+
+# Interfaces whose requested share of properties above which one GetAll is
+# cheaper than a Get per property
+GET_ALL_FRACTION = 0.25
+
+# Maximum number of GetAll calls in flight in the bulk property fetches
+PIPELINE_DEPTH = 64
+
+
+# Entry of ListUnits and friends, signature (ssssssouso)
+UnitStatus = collections.namedtuple('UnitStatus', [
+    'name', 'description', 'load_state', 'active_state', 'sub_state',
+    'following', 'path', 'job_id', 'job_type', 'job_path',
+])
+
+# Entry of ListUnitFiles, signature (ss)
+UnitFile = collections.namedtuple('UnitFile', ['path', 'state'])
+
+# Reported by L{UnitWatcher}. The states are None for removed units.
+UnitStateChange = collections.namedtuple('UnitStateChange', [
+    'unit', 'active_state', 'sub_state', 'timestamp',
+])
+
+
+_ALNUM = frozenset('abcdefghijklmnopqrstuvwxyz'
+                   'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+_unit_path_cache = {}
+_unit_name_cache = {}
+_UNIT_CACHE_SIZE = 4096
+
+
+def unit_path(unit_name):
+    """
+    Returns the object path of a unit, eg.
+    C{/org/freedesktop/systemd1/unit/snapd_2eservice} for C{snapd.service}.
+
+    The path is computed the way systemd does (C{sd_bus_path_encode}): ASCII
+    letters, and digits other than the first character, are kept and every
+    other byte is replaced by C{_} and its two hex digits.
+    """
+    try:
+        return _unit_path_cache[unit_name]
+    except KeyError:
+        pass
+
+    if not unit_name:
+        label = "_"
+    else:
+        chars = []
+        for i, c in enumerate(bytearray(unit_name.encode('utf-8'))):
+            c = chr(c)
+            if c in _ALNUM and (i or not c.isdigit()):
+                chars.append(c)
+            else:
+                chars.append("_%02x" % ord(c))
+        label = "".join(chars)
+    path = UNIT_PATH_PREFIX + label
+
+    if len(_unit_path_cache) >= _UNIT_CACHE_SIZE:
+        _unit_path_cache.clear()
+    _unit_path_cache[unit_name] = path
+    return path
+
+
+def unit_name(path):
+    """
+    Returns the unit name of a unit object path, the reverse of
+    L{unit_path}
+
+    @raises ValueError: if C{path} is not a unit path
+    """
+    try:
+        return _unit_name_cache[path]
+    except KeyError:
+        pass
+
+    if not path.startswith(UNIT_PATH_PREFIX):
+        raise ValueError("Not a unit object path: %r" % (path,))
+    label = path[len(UNIT_PATH_PREFIX):]
+    if label == "_":
+        name = ""
+    else:
+        out = bytearray()
+        i = 0
+        while i < len(label):
+            if label[i] == "_":
+                try:
+                    out.append(int(label[i + 1:i + 3], 16))
+                except ValueError:
+                    raise ValueError("Bad escape in unit path: %r" % (path,))
+                i += 3
+            else:
+                out.append(ord(label[i]))
+                i += 1
+        name = out.decode('utf-8')
+
+    if len(_unit_name_cache) >= _UNIT_CACHE_SIZE:
+        _unit_name_cache.clear()
+    _unit_name_cache[path] = name
+    return name
+
+
+class UnitProperties(object):
+    """
+    Base class of the records returned by
+    L{SystemdManager.get_units_properties}. Subclasses are made by
+    L{unit_properties_type} and have one slot per property.
+
+    @ivar unit: Unit name
+    @cvar properties: Names of the property slots
+    """
+    __slots__ = ('unit',)
+    properties = ()
+
+    def __init__(self, unit, values):
+        self.unit = unit
+        for name in self.properties:
+            setattr(self, name, values.get(name))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.unit, ' '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.properties))
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.unit == other.unit and
+                self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.properties)
+
+
+_unit_properties_types = {}
+
+
+def unit_properties_type(properties):
+    """
+    Returns the L{UnitProperties} subclass with slots for C{properties}.
+    Classes are created once per list of properties.
+    """
+    properties = tuple(properties)
+    try:
+        return _unit_properties_types[properties]
+    except KeyError:
+        pass
+    cls = type('UnitProperties', (UnitProperties,), {
+        '__slots__': properties,
+        'properties': properties,
+    })
+    _unit_properties_types[properties] = cls
+    return cls
+
+
+class Superseded(DBusException):
+    """
+    Received by a queued unit file operation replaced by another operation
+    for the same unit
+    """
+    pass
+
+
+def _fail_waiters(waiters, error):
+    for result in waiters:
+        result.set_exception(error)
 
 
 class SystemdManager(object):
 
-    def __init__(self):
-        self._system_bus = system_bus().connect()
+    def __init__(self, bus=None):
+        """
+        @param bus: Connected client to use. Defaults to a new system bus
+                    connection.
+        """
+        if bus is None:
+            bus = system_bus().connect()
+        self._system_bus = bus
+        # Unit paths that differ from the computed one, as found by LoadUnit
+        self._loaded_paths = {}
+        self._job_subscription = None
+        # Job path to the AsyncResult of its waiters
+        self._job_waiters = {}
+        # Job path to result of recently finished jobs nobody waited for yet
+        self._finished_jobs = collections.OrderedDict()
+        # Unit name to (operation, [AsyncResult]) of the next batch
+        self._unit_file_batch = collections.OrderedDict()
+        self._unit_file_timer = None
+        # Unit type to {property: (interface, number of properties of the
+        # interface)}, from the introspection of one unit of the type
+        self._property_maps = {}
 
-    def start_unit(self, unit_name, mode="replace"):
-        return self._system_bus.call_remote(OBJECT_PATH, 'StartUnit',
-                                            signature="ss",
-                                            args=(unit_name, mode),
+    def _call_manager(self, method, signature=None, args=None):
+        return self._system_bus.call_remote(OBJECT_PATH, method,
+                                            signature=signature,
+                                            args=args,
                                             interface=MANAGER_INTERFACE,
                                             destination=BUS_NAME)
 
-    def stop_unit(self, unit_name, mode="replace"):
-        return self._system_bus.call_remote(OBJECT_PATH, 'StopUnit',
-                                            signature="ss",
-                                            args=(unit_name, mode),
-                                            interface=MANAGER_INTERFACE,
-                                            destination=BUS_NAME)
+    def _queue_job(self, method, unit_name, mode, wait, timeout):
+        if wait:
+            # Subscribe first, the job may finish before the reply arrives
+            self._watch_jobs()
+        job_path = self._call_manager(method, "ss", [unit_name, mode])
+        if not wait:
+            return job_path
+        return self.wait_job(job_path, timeout)
+
+    def start_unit(self, unit_name, mode="replace", wait=False, timeout=None):
+        """
+        Queues a start job for a unit
+
+        @param wait: Wait for the job to finish
+        @param timeout: Seconds to wait for the job, or None
+        @returns: The job path, or the job result (eg. L{JOB_DONE}) if
+                  C{wait} is set
+        @raises TimeOut: if the job did not finish within C{timeout}
+        """
+        return self._queue_job('StartUnit', unit_name, mode, wait, timeout)
+
+    def stop_unit(self, unit_name, mode="replace", wait=False, timeout=None):
+        """
+        Queues a stop job for a unit, see L{start_unit}
+        """
+        return self._queue_job('StopUnit', unit_name, mode, wait, timeout)
+
+    def restart_unit(self, unit_name, mode="replace", wait=False,
+                     timeout=None):
+        """
+        Queues a restart job for a unit, see L{start_unit}
+        """
+        return self._queue_job('RestartUnit', unit_name, mode, wait, timeout)
+
+    def reload_unit(self, unit_name, mode="replace", wait=False,
+                    timeout=None):
+        """
+        Queues a reload job for a unit, see L{start_unit}
+        """
+        return self._queue_job('ReloadUnit', unit_name, mode, wait, timeout)
+
+    # -------------------------------------------------
+    # Job completion
+
+    def _watch_jobs(self):
+        if self._job_subscription is not None:
+            return
+        # JobRemoved callbacks are cheap, block rather than lose completions
+        self._job_subscription = self._system_bus.add_signal_receiver(
+            self._on_job_removed,
+            interface=MANAGER_INTERFACE,
+            member='JobRemoved',
+            path=OBJECT_PATH,
+            sender=BUS_NAME,
+            overflow=signals.BLOCK,
+        )
+        try:
+            self.subscribe()
+        except Exception:
+            self._system_bus.remove_signal_receiver(self._job_subscription)
+            self._job_subscription = None
+            raise
+
+    def watch_job(self, job_path):
+        """
+        Returns an L{AsyncResult} that receives the result of a job (eg.
+        L{JOB_DONE}) when systemd reports it with C{JobRemoved}. Each call
+        returns a new result.
+
+        Watch jobs as soon as they are queued: the result of a job that
+        finished before it was watched is only kept for the last
+        L{FINISHED_JOBS_KEPT} jobs.
+        """
+        self._watch_jobs()
+        result = AsyncResult()
+        job_result = self._finished_jobs.get(job_path)
+        if job_result is not None:
+            result.set(job_result)
+        else:
+            self._job_waiters.setdefault(job_path, []).append(result)
+        return result
+
+    def wait_job(self, job_path, timeout=None):
+        """
+        Waits for a job to finish and returns its result
+
+        @raises TimeOut: if the job did not finish within C{timeout}
+        """
+        result = self.watch_job(job_path)
+        try:
+            return result.get(timeout=timeout)
+        except gevent.Timeout:
+            # Other waiters of the job keep theirs
+            waiters = self._job_waiters.get(job_path)
+            if waiters is not None and result in waiters:
+                waiters.remove(result)
+                if not waiters:
+                    del self._job_waiters[job_path]
+            raise TimeOut('Job %s did not finish in time' % (job_path,))
+
+    def _on_job_removed(self, msig):
+        _, job_path, _, job_result = msig.body
+        for result in self._job_waiters.pop(job_path, ()):
+            result.set(job_result)
+        self._finished_jobs[job_path] = job_result
+        while len(self._finished_jobs) > FINISHED_JOBS_KEPT:
+            self._finished_jobs.popitem(last=False)
 
     def enable_unit(self, unit_name):
         return self._system_bus.call_remote(OBJECT_PATH, 'EnableUnitFiles',
@@ -58,6 +406,130 @@ class SystemdManager(object):
                                             interface=MANAGER_INTERFACE,
                                             destination=BUS_NAME)
 
+    def reload(self):
+        """
+        Reloads the systemd configuration (C{daemon-reload})
+        """
+        return self._call_manager('Reload')
+
+    # -------------------------------------------------
+    # Batched unit file operations
+
+    def _queue_unit_file_op(self, operation, unit_name):
+        result = AsyncResult()
+        previous = self._unit_file_batch.pop(unit_name, None)
+        waiters = []
+        if previous is not None:
+            if previous[0] == operation:
+                waiters = previous[1]
+            else:
+                # The last operation requested for a unit wins
+                error = Superseded('%s of %s was superseded by %s' % (
+                    previous[0], unit_name, operation))
+                for waiter in previous[1]:
+                    waiter.set_exception(error)
+        waiters.append(result)
+        self._unit_file_batch[unit_name] = (operation, waiters)
+        if self._unit_file_timer is None:
+            self._unit_file_timer = gevent.spawn_later(
+                UNIT_FILE_BATCH_WINDOW, self.flush_unit_files)
+        return result
+
+    def queue_enable(self, unit_name):
+        """
+        Enables a unit file in the next batch. The batch is sent
+        L{UNIT_FILE_BATCH_WINDOW} seconds after its first operation was
+        queued, as one call per operation followed by a single C{Reload}.
+        If a batched call fails, its units are retried one call each so
+        that a bad unit name only fails its own requests.
+
+        A later request of another operation for the same unit replaces
+        this one, whose result then receives a L{Superseded} error.
+
+        @returns: L{AsyncResult} receiving the list of (type, file,
+                  destination) changes made by the call that included the
+                  unit, once the configuration has been reloaded
+        """
+        return self._queue_unit_file_op(UNIT_FILE_ENABLE, unit_name)
+
+    def queue_disable(self, unit_name):
+        """
+        Disables a unit file in the next batch, see L{queue_enable}
+        """
+        return self._queue_unit_file_op(UNIT_FILE_DISABLE, unit_name)
+
+    def queue_mask(self, unit_name):
+        """
+        Masks a unit in the next batch, see L{queue_enable}
+        """
+        return self._queue_unit_file_op(UNIT_FILE_MASK, unit_name)
+
+    def queue_unmask(self, unit_name):
+        """
+        Unmasks a unit in the next batch, see L{queue_enable}
+        """
+        return self._queue_unit_file_op(UNIT_FILE_UNMASK, unit_name)
+
+    def flush_unit_files(self):
+        """
+        Sends the queued unit file operations now, then reloads systemd if
+        any of them changed something
+        """
+        timer, self._unit_file_timer = self._unit_file_timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        batch, self._unit_file_batch = (self._unit_file_batch,
+                                        collections.OrderedDict())
+        if not batch:
+            return
+
+        by_operation = {}
+        for name, (operation, waiters) in batch.items():
+            by_operation.setdefault(operation, []).append((name, waiters))
+
+        done = []
+        changed = False
+        for operation, (method, signature, extra, with_flag) in \
+                _UNIT_FILE_OPS.items():
+            if operation not in by_operation:
+                continue
+            units = by_operation[operation]
+            names = [name for name, _ in units]
+            waiters = [r for _, unit_waiters in units for r in unit_waiters]
+            try:
+                calls = [(waiters, self._call_manager(
+                    method, signature, [names] + extra))]
+            except Exception as e:
+                if len(units) == 1:
+                    _fail_waiters(waiters, e)
+                    continue
+                logger.warning('%s failed for %d units, retrying them one '
+                               'by one: %s', method, len(units), e)
+                calls = []
+                for name, unit_waiters in units:
+                    try:
+                        calls.append((unit_waiters, self._call_manager(
+                            method, signature, [[name]] + extra)))
+                    except Exception as e:
+                        _fail_waiters(unit_waiters, e)
+
+            for waiters, reply in calls:
+                changes = reply[1] if with_flag else reply
+                changed = changed or bool(changes)
+                done.append((waiters, changes))
+
+        if changed:
+            try:
+                self.reload()
+            except Exception as e:
+                for waiters, _ in done:
+                    _fail_waiters(waiters, e)
+                return
+
+        for waiters, changes in done:
+            for result in waiters:
+                result.set(changes)
+
     def _get_unit(self, unit_name):
         return self._system_bus.call_remote(OBJECT_PATH, 'GetUnit',
                                             signature="s",
@@ -65,22 +537,599 @@ class SystemdManager(object):
                                             interface=MANAGER_INTERFACE,
                                             destination=BUS_NAME)
 
-    def get_unit_props(self, unit_name):
-        unit_path = self._get_unit(unit_name)
-        """
-        <method name="GetAll">
-        <arg name="interface" direction="in" type="s"/>
-        <arg name="properties" direction="out" type="a{sv}"/>
-        </method>
-        """
-        return self._system_bus.call_remote(unit_path, 'GetAll',
+    def _load_unit(self, unit_name):
+        return self._system_bus.call_remote(OBJECT_PATH, 'LoadUnit',
                                             signature="s",
-                                            args=('org.freedesktop.systemd1.Unit',),
-                                            interface="org.freedesktop.DBus.Properties",
+                                            args=(unit_name,),
+                                            interface=MANAGER_INTERFACE,
                                             destination=BUS_NAME)
 
-    def subscribe(self, callback=None):
-        return self._system_bus.call_remote(OBJECT_PATH, 'Subscribe',
-                                            interface=MANAGER_INTERFACE,
+    def get_unit_path(self, unit_name):
+        """
+        Returns the object path of a unit without asking systemd, see
+        L{unit_path}
+        """
+        return self._loaded_paths.get(unit_name) or unit_path(unit_name)
+
+    def _call_unit(self, unit_name, method, signature=None, args=None,
+                   interface=None):
+        """
+        Calls a method on the object of a unit at its computed path. Only if
+        there is no object there is the unit loaded with C{LoadUnit} and the
+        call retried at the path systemd returns.
+        """
+        path = self.get_unit_path(unit_name)
+        try:
+            return self._system_bus.call_remote(path, method,
+                                                signature=signature,
+                                                args=args,
+                                                interface=interface,
+                                                destination=BUS_NAME)
+        except RemoteError as e:
+            if e.errName not in _NO_UNIT_OBJECT_ERRORS:
+                raise
+            error = e
+        loaded = self._load_unit(unit_name)
+        if loaded == path:
+            raise error
+        self._loaded_paths[unit_name] = loaded
+        return self._system_bus.call_remote(loaded, method,
+                                            signature=signature,
+                                            args=args,
+                                            interface=interface,
                                             destination=BUS_NAME)
-    
\ No newline at end of file
+
+    def get_unit_props(self, unit_name, interface=UNIT_INTERFACE):
+        return self._call_unit(unit_name, 'GetAll', signature="s",
+                               args=(interface,),
+                               interface=PROPERTIES_INTERFACE)
+
+    def subscribe(self):
+        """
+        Asks systemd to emit unit and job signals to this connection
+        """
+        return self._call_manager('Subscribe')
+
+    def watch_units(self, callback, units=None, patterns=None,
+                    coalesce=None):
+        """
+        Creates and starts a L{UnitWatcher}
+        """
+        return UnitWatcher(self, callback, units, patterns, coalesce).start()
+
+    def resource_poller(self, units=None, patterns=('*.service',),
+                        properties=RESOURCE_PROPERTIES):
+        """
+        Creates a L{ResourcePoller}
+        """
+        return ResourcePoller(self, units, patterns, properties)
+
+    # -------------------------------------------------
+    # Bulk inventory
+
+    def list_units(self):
+        """
+        Returns a L{UnitStatus} for every unit loaded by systemd
+        """
+        return [UnitStatus._make(u) for u in self._call_manager('ListUnits')]
+
+    def list_units_by_patterns(self, states=(), patterns=()):
+        """
+        Returns a L{UnitStatus} for the loaded units in one of C{states}
+        (eg. 'active', 'failed') whose name matches one of the glob
+        C{patterns}. Empty lists match everything.
+        """
+        return [UnitStatus._make(u) for u in self._call_manager(
+            'ListUnitsByPatterns', 'asas', [list(states), list(patterns)])]
+
+    def list_units_by_names(self, names):
+        """
+        Returns a L{UnitStatus} for each of the named units, including units
+        that are not loaded
+        """
+        return [UnitStatus._make(u) for u in self._call_manager(
+            'ListUnitsByNames', 'as', [list(names)])]
+
+    def list_unit_files(self, states=None, patterns=None):
+        """
+        Returns a L{UnitFile} for every installed unit file, or only for
+        those in one of C{states} (eg. 'enabled') matching one of
+        C{patterns}
+        """
+        if states is None and patterns is None:
+            files = self._call_manager('ListUnitFiles')
+        else:
+            files = self._call_manager(
+                'ListUnitFilesByPatterns', 'asas',
+                [list(states or ()), list(patterns or ())])
+        return [UnitFile._make(f) for f in files]
+
+    def get_units_props(self, unit_paths, interface=UNIT_INTERFACE):
+        """
+        Fetches the properties of many units. The C{GetAll} calls are
+        pipelined, up to L{PIPELINE_DEPTH} at a time, so the cost is close
+        to a single round trip per batch rather than per unit.
+
+        @param unit_paths: Object paths of the units, eg. the C{path} of
+                           L{UnitStatus} records
+        @returns: C{dict} of unit path to property C{dict}. Units that
+                  failed, eg. because they were unloaded in the meantime,
+                  or did not answer in time are left out.
+        """
+        return self._pipeline_properties(
+            (path, path, 'GetAll', 's', [interface]) for path in unit_paths)
+
+    def _pipeline_properties(self, calls):
+        """
+        Sends C{org.freedesktop.DBus.Properties} calls with up to
+        L{PIPELINE_DEPTH} of them in flight
+
+        @param calls: Iterable of (key, object path, method, signature,
+                      args)
+        @returns: C{dict} of key to reply, without the failed and timed out
+                  calls
+        """
+        bus = self._system_bus
+        result = {}
+        in_flight = collections.deque()
+
+        def collect():
+            key, serial, reply = in_flight.popleft()
+            try:
+                result[key] = bus.await_reply(serial, bus.default_timeout,
+                                              reply)
+            except (RemoteError, TimeOut):
+                pass
+
+        try:
+            for key, path, method, signature, args in calls:
+                if len(in_flight) >= PIPELINE_DEPTH:
+                    collect()
+                serial, reply = bus.call_remote_async(
+                    path, method,
+                    signature=signature,
+                    args=args,
+                    interface=PROPERTIES_INTERFACE,
+                    destination=BUS_NAME)
+                in_flight.append((key, serial, reply))
+
+            while in_flight:
+                collect()
+        finally:
+            # Give up on the calls still in flight, eg. when the connection
+            # was closed
+            for _, serial, _ in in_flight:
+                bus.forget_call(serial)
+        return result
+
+    def _property_map(self, unit_name):
+        unit_type = unit_name.rpartition('.')[2]
+        try:
+            return self._property_maps[unit_type]
+        except KeyError:
+            pass
+        try:
+            interfaces = self._system_bus.obj_handler.introspect_remote(
+                BUS_NAME, self.get_unit_path(unit_name))
+        except IntrospectionFailed as e:
+            logger.debug('No property map for %s: %s', unit_name, e)
+            return {}
+        props = {}
+        for iface in interfaces:
+            if not iface.name.startswith('org.freedesktop.systemd1.'):
+                continue
+            for name in iface.properties:
+                props.setdefault(name, (iface.name, len(iface.properties)))
+        # A unit that went away shows no systemd interface; another unit of
+        # the type is introspected next time
+        if props:
+            self._property_maps[unit_type] = props
+        return props
+
+    def get_units_properties(self, unit_names, properties):
+        """
+        Fetches selected properties of units of any type. Each property is
+        looked up in the interfaces of the unit's type (Unit, Service,
+        Socket, Timer, ...) as found by introspecting one unit per type.
+
+        Per unit and interface, the properties are fetched with one C{Get}
+        each, or with a single C{GetAll} when more than L{GET_ALL_FRACTION}
+        of the interface's properties are requested. All calls are
+        pipelined.
+
+        @param properties: Property names, eg. C{['ActiveState', 'MainPID']}
+        @returns: List of L{UnitProperties} records in the order of
+                  C{unit_names}. Properties that the unit does not have or
+                  that could not be fetched are None, as are all
+                  properties of a unit that could not be introspected.
+        """
+        properties = tuple(properties)
+        calls = []
+        for name in unit_names:
+            by_interface = {}
+            prop_map = self._property_map(name)
+            for prop in properties:
+                if prop in prop_map:
+                    interface, size = prop_map[prop]
+                    by_interface.setdefault(interface, ([], size))[0].append(
+                        prop)
+            path = self.get_unit_path(name)
+            for interface, (props, size) in by_interface.items():
+                if len(props) > size * GET_ALL_FRACTION:
+                    calls.append(((name, interface, None), path, 'GetAll',
+                                  's', [interface]))
+                else:
+                    calls.extend(((name, interface, prop), path, 'Get', 'ss',
+                                  [interface, prop]) for prop in props)
+
+        values = dict((name, {}) for name in unit_names)
+        for (name, _, prop), reply in self._pipeline_properties(calls).items():
+            if prop is None:
+                values[name].update(reply)
+            else:
+                values[name][prop] = reply
+
+        cls = unit_properties_type(properties)
+        return [cls(name, values[name]) for name in unit_names]
+
+    def get_unit_properties(self, unit_name, properties):
+        """
+        Fetches selected properties of a unit, see L{get_units_properties}
+
+        @rtype: L{UnitProperties}
+        """
+        return self.get_units_properties([unit_name], properties)[0]
+
+    def get_units_props_by_names(self, names, interface=UNIT_INTERFACE):
+        """
+        Like L{get_units_props} for unit names. The unit paths are computed
+        locally; units without an object there are retried one by one
+        through C{LoadUnit}.
+
+        @returns: C{dict} of unit name to property C{dict}
+        """
+        paths = dict((name, self.get_unit_path(name)) for name in names)
+        props = self.get_units_props(list(paths.values()), interface)
+        result = {}
+        for name, path in paths.items():
+            if path in props:
+                result[name] = props[path]
+                continue
+            try:
+                result[name] = self.get_unit_props(name, interface)
+            except RemoteError:
+                pass
+        return result
+
+
+class UnitWatcher(object):
+    """
+    Streams the state transitions of units without polling.
+
+    The watcher follows C{PropertiesChanged} of the units' C{Unit} interface
+    and C{UnitNew}/C{UnitRemoved}, and calls C{callback} with a
+    L{UnitStateChange} whenever the C{ActiveState} or C{SubState} of a
+    watched unit changes.
+
+    With a C{coalesce} window, each unit is reported at most once per
+    window: changes within the window are held back and only the latest
+    state is reported at its end, and only if it differs from the last one
+    reported. A flapping unit thus causes a bounded update rate while its
+    final state is always delivered.
+
+    @ivar states: C{dict} of unit name to the last known (ActiveState,
+                  SubState) of the watched units. Do not modify.
+    """
+
+    def __init__(self, manager, callback, units=None, patterns=None,
+                 coalesce=None):
+        """
+        @param manager: L{SystemdManager} whose connection is used
+        @param callback: Called with a L{UnitStateChange}
+        @param units: Unit names to watch
+        @param patterns: Glob patterns of unit names to watch. All units are
+                         watched if neither C{units} nor C{patterns} is
+                         given.
+        @param coalesce: Coalescing window in seconds, or None to report
+                         every change
+        """
+        self.manager = manager
+        self.callback = callback
+        self.units = frozenset(units or ())
+        self.patterns = tuple(patterns or ())
+        self.coalesce = coalesce
+        self.states = {}
+        self._watched = {}  # Memoized result of _is_watched
+        self._last_reported = {}  # Unit name to (time, state)
+        self._held = {}  # Unit name to (state, timestamp) not reported yet
+        self._timers = {}
+        self._subscriptions = ()
+
+    def _is_watched(self, name):
+        try:
+            return self._watched[name]
+        except KeyError:
+            pass
+        watched = ((not self.units and not self.patterns) or
+                   name in self.units or
+                   any(fnmatch.fnmatchcase(name, p) for p in self.patterns))
+        if len(self._watched) >= _UNIT_CACHE_SIZE:
+            self._watched.clear()
+        self._watched[name] = watched
+        return watched
+
+    def start(self):
+        """
+        Subscribes to the unit signals and records the current states
+        """
+        bus = self.manager._system_bus
+        self._subscriptions = (
+            bus.add_signal_receiver(
+                self._on_properties_changed,
+                interface=PROPERTIES_INTERFACE,
+                member='PropertiesChanged',
+                path_namespace=OBJECT_PATH + "/unit",
+                sender=BUS_NAME,
+                arg0=UNIT_INTERFACE,
+                overflow=signals.COALESCE,
+            ),
+            bus.add_signal_receiver(
+                self._on_unit_new_removed,
+                interface=MANAGER_INTERFACE,
+                path=OBJECT_PATH,
+                sender=BUS_NAME,
+            ),
+        )
+        self.manager.subscribe()
+
+        if self.units and not self.patterns:
+            current = self.manager.list_units_by_names(sorted(self.units))
+        else:
+            current = self.manager.list_units()
+        for u in current:
+            if self._is_watched(u.name) and u.load_state != 'not-found':
+                self.states.setdefault(u.name, (u.active_state, u.sub_state))
+        return self
+
+    def close(self):
+        bus = self.manager._system_bus
+        subs, self._subscriptions = self._subscriptions, ()
+        for sub in subs:
+            bus.remove_signal_receiver(sub)
+        for timer in self._timers.values():
+            timer.kill(block=False)
+        self._timers.clear()
+        self._held.clear()
+
+    # -------------------------------------------------
+
+    def _on_properties_changed(self, msig):
+        try:
+            name = unit_name(msig.path)
+        except ValueError:
+            return
+        if not self._is_watched(name):
+            return
+        changed = msig.body[1]
+        if 'ActiveState' not in changed and 'SubState' not in changed:
+            return
+        old = self.states.get(name, (None, None))
+        state = (changed.get('ActiveState', old[0]),
+                 changed.get('SubState', old[1]))
+        if state != old:
+            self._update(name, state)
+
+    def _on_unit_new_removed(self, msig):
+        if msig.member == 'UnitNew':
+            name = msig.body[0]
+            if self._is_watched(name) and name not in self.states:
+                # The state follows in PropertiesChanged
+                self.states[name] = (None, None)
+        elif msig.member == 'UnitRemoved':
+            name = msig.body[0]
+            if name in self.states:
+                self._update(name, None)
+
+    def _update(self, name, state):
+        now = time.time()
+        if state is None:
+            self.states.pop(name, None)
+        else:
+            self.states[name] = state
+
+        if not self.coalesce:
+            self._report(name, state, now)
+            return
+
+        last = self._last_reported.get(name)
+        if name not in self._timers and (
+                last is None or now - last[0] >= self.coalesce):
+            self._report(name, state, now)
+            return
+
+        self._held[name] = (state, now)
+        if name not in self._timers:
+            self._timers[name] = gevent.spawn_later(
+                last[0] + self.coalesce - now, self._flush, name)
+
+    def _flush(self, name):
+        del self._timers[name]
+        state, timestamp = self._held.pop(name)
+        last = self._last_reported.get(name)
+        if last is None or last[1] != state:
+            self._report(name, state, timestamp)
+
+    def _report(self, name, state, timestamp):
+        if state is None:
+            self._last_reported.pop(name, None)
+            change = UnitStateChange(name, None, None, timestamp)
+        else:
+            self._last_reported[name] = (time.time(), state)
+            change = UnitStateChange(name, state[0], state[1], timestamp)
+        try:
+            self.callback(change)
+        except Exception:
+            logger.exception('Error in unit watcher callback')
+
+
+class ResourcePoller(object):
+    """
+    Polls resource counters, eg. C{MemoryCurrent} or C{CPUUsageNSec}, of
+    many units.
+
+    Each L{poll} fetches only the requested properties, with pipelined
+    C{Get} calls, so its cost grows with the number of properties rather
+    than with full property dumps. Values are stored in a table with one
+    C{array('Q')} column per property and one row per unit; the previous
+    tick is kept to compute deltas and rates.
+
+    Unavailable values (C{UINT64_MAX}, eg. with accounting disabled or for
+    stopped units) are reported as None.
+
+    @ivar units: Names of the polled units, in row order
+    @ivar timestamp: Time of the last poll, or None
+    @ivar previous_timestamp: Time of the poll before, or None
+    """
+
+    # Seconds after which the units matching C{patterns} are listed again
+    rescan_interval = 60.0
+
+    def __init__(self, manager, units=None, patterns=('*.service',),
+                 properties=RESOURCE_PROPERTIES,
+                 interface=SERVICE_UNIT_INTERFACE):
+        """
+        @param manager: L{SystemdManager} whose connection is used
+        @param units: Names of the units to poll. If None, the active units
+                      matching C{patterns} are polled.
+        @param properties: Names of C{t} (uint64) properties of C{interface}
+        """
+        self.manager = manager
+        self.patterns = list(patterns or ())
+        self.properties = tuple(properties)
+        self.interface = interface
+        self._fixed_units = units is not None
+        self.units = list(units or ())
+        self._rows = dict((name, i) for i, name in enumerate(self.units))
+        self._current = self._empty_table(len(self.units))
+        self._previous = self._empty_table(len(self.units))
+        self._scanned = None
+        self.timestamp = None
+        self.previous_timestamp = None
+        self._greenlet = None
+
+    def _empty_table(self, nrows):
+        return dict((prop, array.array('Q', [UINT64_MAX]) * nrows)
+                    for prop in self.properties)
+
+    def _rescan(self, now):
+        names = [u.name for u in self.manager.list_units_by_patterns(
+            ['active', 'reloading', 'activating', 'deactivating'],
+            self.patterns)]
+        self._scanned = now
+        if names == self.units:
+            return
+        # Keep the previous tick of units that are still polled
+        previous = self._empty_table(len(names))
+        for row, name in enumerate(names):
+            old = self._rows.get(name)
+            if old is not None:
+                for prop in self.properties:
+                    previous[prop][row] = self._current[prop][old]
+        self.units = names
+        self._rows = dict((name, i) for i, name in enumerate(names))
+        self._current = previous
+        self._previous = self._empty_table(len(names))
+
+    # -------------------------------------------------
+
+    def poll(self):
+        """
+        Fetches the current values. The values fetched before become the
+        previous tick.
+        """
+        now = time.time()
+        if not self._fixed_units and (
+                self._scanned is None or
+                now - self._scanned >= self.rescan_interval):
+            self._rescan(now)
+
+        interface = self.interface
+        get_unit_path = self.manager.get_unit_path
+        replies = self.manager._pipeline_properties(
+            ((row, prop), get_unit_path(name), 'Get', 'ss', [interface, prop])
+            for row, name in enumerate(self.units)
+            for prop in self.properties)
+
+        table = self._empty_table(len(self.units))
+        for (row, prop), value in replies.items():
+            table[prop][row] = value
+        self._previous, self._current = self._current, table
+        self.previous_timestamp, self.timestamp = self.timestamp, now
+        return self
+
+    def run(self, interval, callback=None):
+        """
+        Polls every C{interval} seconds in a greenlet, calling
+        C{callback(poller)} after each tick
+        """
+        def loop():
+            while True:
+                started = time.time()
+                try:
+                    self.poll()
+                    if callback is not None:
+                        callback(self)
+                except Exception:
+                    logger.exception('Resource poll failed')
+                gevent.sleep(max(0, interval - (time.time() - started)))
+        self._greenlet = gevent.spawn(loop)
+        return self._greenlet
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    # -------------------------------------------------
+    # Reading the table
+
+    def get(self, unit, prop):
+        """
+        Returns the last value of a property of a unit, or None
+        """
+        value = self._current[prop][self._rows[unit]]
+        return None if value == UINT64_MAX else value
+
+    def values(self, prop):
+        """
+        Returns a C{dict} of unit name to the last value of C{prop}
+        """
+        column = self._current[prop]
+        return dict((name, column[row]) for row, name in enumerate(self.units)
+                    if column[row] != UINT64_MAX)
+
+    def deltas(self, prop):
+        """
+        Returns a C{dict} of unit name to the change of C{prop} since the
+        previous tick. Units without both values, or whose counter went
+        backwards (eg. because the unit was restarted), are left out.
+        """
+        current, previous = self._current[prop], self._previous[prop]
+        d = {}
+        for row, name in enumerate(self.units):
+            new, old = current[row], previous[row]
+            if new != UINT64_MAX and old != UINT64_MAX and new >= old:
+                d[name] = new - old
+        return d
+
+    def rates(self, prop):
+        """
+        Returns L{deltas} divided by the seconds between the last two ticks
+        """
+        if self.previous_timestamp is None:
+            return {}
+        elapsed = self.timestamp - self.previous_timestamp
+        if elapsed <= 0:
+            return {}
+        return dict((name, delta / elapsed)
+                    for name, delta in self.deltas(prop).items())
@@ -0,0 +1,214 @@
+"""
+DBus client that can be shared by OS threads.
+
+A L{ThreadedClient} owns a blocking socket and a dedicated I/O thread which
+reads and dispatches all incoming messages. Any thread may issue method
+calls: each call registers a C{concurrent.futures.Future} under its serial
+number and the I/O thread completes it when the reply arrives. Writes are
+serialized by a lock, so one bus connection serves a whole worker pool.
+"""
+import concurrent.futures
+import logging
+import socket
+import threading
+
+from .authentication import ClientAuthenticator, PipelinedClientAuthenticator
+from .connection import BaseConnection, hello_message
+from .error import ConnectionClosed, TimeOut
+from .message import MethodCallMessage
+from .metrics import IO_WAIT, clock
+from .objects import DBusObjectHandler
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadedClient (BaseConnection):
+    """
+    Thread-safe DBus client connected to a message bus
+
+    @ivar default_timeout: Seconds to wait for a method reply when the caller
+                           does not give a timeout. None waits forever.
+    """
+    busname = None
+    _hello = None  # (serial, Future) of a pipelined Hello
+
+    def __init__(self, transport, timeout=None):
+        BaseConnection.__init__(self)
+        self._transport = transport
+        self.default_timeout = timeout
+        self._write_lock = threading.Lock()
+        self._io_thread = None
+        self._obj_handler = DBusObjectHandler(self)
+
+    def __repr__(self):
+        return "<ThreadedDBusClient(%s)>" % self.busname
+
+    def connect(self, fast=False):
+        """
+        Authenticates the connection and calls C{Hello}
+
+        @param fast: Pipeline the authentication and C{Hello} in a single
+                     round trip, see L{PipelinedClientAuthenticator}
+        """
+        if fast:
+            mcall_msg = hello_message(self.next_serial())
+            fut = concurrent.futures.Future()
+            self._pending[mcall_msg.serial] = fut
+            self._hello = (mcall_msg.serial, fut)
+            PipelinedClientAuthenticator().authenticate(
+                self, mcall_msg.raw_message)
+            return self
+        # DBus specification requires that clients send a null byte upon
+        # connection to the bus
+        self.write(b'\0')
+        ClientAuthenticator().authenticate(self)
+        return self
+
+    def on_connection_authenticated(self):
+        self._io_thread = threading.Thread(
+            target=self._io_loop,
+            name='dbuspy-io',
+        )
+        self._io_thread.daemon = True
+        self._io_thread.start()
+
+        if self._hello is not None:
+            serial, fut = self._hello
+            self._hello = None
+            try:
+                self.busname = fut.result(self.default_timeout)
+            except concurrent.futures.TimeoutError:
+                self._pending.pop(serial, None)
+                raise TimeOut('No reply to Hello')
+            return
+
+        self.busname = self.call_remote(
+            '/Hello',
+            'Hello',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+        )
+
+    def write(self, data):
+        if self.metrics.enabled:
+            self.metrics.bytes_sent(len(data))
+        with self._write_lock:
+            self._transport.sendall(data)
+
+    def read(self):
+        return self._transport.recv(4096)
+
+    def _io_loop(self):
+        try:
+            while True:
+                data = self.read()
+                if not data:
+                    break
+                try:
+                    self.on_data_received(data)
+                except Exception:
+                    logger.exception('Error processing received message')
+        except Exception as e:
+            logger.debug('I/O thread stopped: %r', e)
+        finally:
+            self._fail_pending(ConnectionClosed())
+
+    def on_method_call_received(self, mcall):
+        """
+        Answers the C{org.freedesktop.DBus.Peer} methods every connection
+        implements and rejects any other call. Objects cannot be exported on
+        a L{ThreadedClient}: their methods would run on the I/O thread.
+        """
+        self._obj_handler.answer_peer_call(self, mcall,
+                                           'on a threaded client')
+
+    def teardown(self):
+        try:
+            self._transport.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._transport.close()
+        if (self._io_thread is not None and
+                self._io_thread is not threading.current_thread()):
+            self._io_thread.join()
+
+    def call_remote_async(self, object_path, method,
+                          interface=None,
+                          destination=None,
+                          signature=None,
+                          args=None,
+                          autoStart=True):
+        """
+        Sends a method call and returns a C{concurrent.futures.Future} that
+        is completed with the converted reply by the I/O thread
+        """
+        started = clock() if self.metrics.enabled else None
+        mcall_msg = MethodCallMessage(
+            object_path,
+            method,
+            interface=interface,
+            destination=destination,
+            signature=signature,
+            body=args,
+            autoStart=autoStart,
+            oobFDs=self._toBeSentFDs,
+            serial=self.next_serial(),
+        )
+        fut = concurrent.futures.Future()
+        fut.serial = mcall_msg.serial
+        self._pending[mcall_msg.serial] = fut
+        if started is not None:
+            self._call_sent(mcall_msg, started)
+        try:
+            self.send_message(mcall_msg)
+        except Exception:
+            self._pending.pop(mcall_msg.serial, None)
+            self._call_starts.pop(mcall_msg.serial, None)
+            raise
+        return fut
+
+    def call_remote(self, object_path, method,
+                    interface=None,
+                    destination=None,
+                    signature=None,
+                    args=None,
+                    expectReply=True,
+                    autoStart=True,
+                    timeout=None):
+        if not expectReply:
+            mcall_msg = MethodCallMessage(
+                object_path,
+                method,
+                interface=interface,
+                destination=destination,
+                signature=signature,
+                body=args,
+                expectReply=False,
+                autoStart=autoStart,
+                oobFDs=self._toBeSentFDs,
+                serial=self.next_serial(),
+            )
+            self.send_message(mcall_msg)
+            return None
+
+        fut = self.call_remote_async(
+            object_path,
+            method,
+            interface=interface,
+            destination=destination,
+            signature=signature,
+            args=args,
+            autoStart=autoStart,
+        )
+        if timeout is None:
+            timeout = self.default_timeout
+        started = clock() if self.metrics.enabled else None
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeOut('Method call timed out')
+        finally:
+            self._pending.pop(fut.serial, None)
+            if started is not None:
+                self.metrics.time_spent(IO_WAIT, clock() - started)
+                self._call_finished(fut.serial, True)
@@ -0,0 +1,92 @@
+"""
+Message tracing hooks.
+
+A hook registered with C{add_trace_hook} on a connection is called with a
+L{TraceEvent} for every message sent or received, eg. to turn method calls
+into spans of a distributed tracing system::
+
+    def on_event(event):
+        if event.direction == SEND and event.message._message_type == 1:
+            start_span(event.serial, event.message.member, event.timestamp)
+        elif event.direction == RECEIVE and event.reply_serial:
+            finish_span(event.reply_serial, event.timestamp)
+
+    client.add_trace_hook(on_event, sample_rate=0.01)
+
+Sampling is decided once per method call and applies to its reply as well,
+so sampled calls always come with their reply.
+"""
+import collections
+import random
+
+from .metrics import clock
+
+SEND = 'send'
+RECEIVE = 'receive'
+
+_METHOD_CALL = 1
+_METHOD_RETURN = 2
+_ERROR = 3
+_SIGNAL = 4
+
+# Sampled calls remembered per hook while waiting for their reply
+MAX_TRACKED_CALLS = 4096
+
+
+# timestamp is a monotonic L{metrics.clock} time, size the length in bytes
+# of the marshalled message
+TraceEvent = collections.namedtuple('TraceEvent', [
+    'direction', 'timestamp', 'serial', 'reply_serial', 'size', 'message',
+])
+
+
+class TraceHook (object):
+    """
+    A registered trace callback and its sampling state
+
+    @ivar sample_rate: Share of method calls and signals traced, between 0
+                       and 1
+    @ivar signals: Whether signals are traced at all
+    """
+
+    def __init__(self, callback, sample_rate=1.0, signals=True):
+        self.callback = callback
+        self.sample_rate = sample_rate
+        self.signals = signals
+        # Serials of sampled calls awaiting a reply, per direction of the
+        # call
+        self._calls = {
+            SEND: collections.OrderedDict(),
+            RECEIVE: collections.OrderedDict(),
+        }
+
+    def __repr__(self):
+        return '<TraceHook %r rate=%s>' % (self.callback, self.sample_rate)
+
+    def _sampled(self):
+        rate = self.sample_rate
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+    def on_message(self, direction, msg, size):
+        mtype = msg._message_type
+        if mtype == _METHOD_CALL:
+            if not self._sampled():
+                return
+            if msg.expect_reply:
+                calls = self._calls[direction]
+                calls[msg.serial] = True
+                if len(calls) > MAX_TRACKED_CALLS:
+                    calls.popitem(last=False)
+            reply_serial = None
+        elif mtype == _SIGNAL:
+            if not self.signals or not self._sampled():
+                return
+            reply_serial = None
+        else:
+            # A reply travels in the opposite direction of its call
+            reply_serial = msg.reply_serial
+            calls = self._calls[RECEIVE if direction == SEND else SEND]
+            if calls.pop(reply_serial, None) is None:
+                return
+        self.callback(TraceEvent(direction, clock(), msg.serial,
+                                 reply_serial, size, msg))
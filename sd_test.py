@@ -1,25 +1,18 @@
 from gevent.monkey import patch_all;patch_all()
-from systemd_dbus import SystemdManager
+from dbuspy.systemd import SystemdManager
 
-m = SystemdManager()
+from gevent import sleep
 
-# print m.get_unit_props('snapd.service')
-# print m.subscribe('snapd.service')
+m = SystemdManager()
 
-from gevent import sleep,spawn
+# print(m.get_unit_props('snapd.service'))
 
 
-print m.subscribe('snapd.service')
+def on_change(change):
+    print("%s: %s (%s)" % (change.unit, change.active_state,
+                           change.sub_state))
 
-def await_client():
-    for i in range(1,100001):
-        print "loop start", i
-        print m._system_bus.await_result()
-        # m._get_unit('snapd.service')
-        print "loop next",i
-        sleep(1)
-        
 
-spawn(await_client)
+m.watch_units(on_change, units=['snapd.service'], coalesce=1.0)
 
-sleep(100)
\ No newline at end of file
+sleep(100)
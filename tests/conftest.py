@@ -0,0 +1,23 @@
+# Runs a MockBus per test, see dbuspy.mockbus
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# The mock_bus, mock_bus_client and fake_systemd fixtures
+pytest_plugins = ['dbuspy.mockbus']
+
+
+@pytest.fixture
+def threaded_mock_bus():
+    """
+    A MockBus served from its own thread, for the threaded and asyncio
+    clients
+    """
+    from dbuspy.mockbus import MockBus
+    bus = MockBus().start_thread()
+    yield bus
+    bus.stop()
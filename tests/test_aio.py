@@ -0,0 +1,119 @@
+import asyncio
+import os
+
+import pytest
+
+import dbuspy
+from dbuspy import aio, signals
+from dbuspy.error import DBusException, RemoteError
+from dbuspy.mockbus import MockBus
+from dbuspy.message import SignalMessage
+
+
+def test_call_remote(threaded_mock_bus):
+    async def main():
+        client = await aio.get_client(threaded_mock_bus.address, timeout=5)
+        try:
+            assert client.busname.startswith(':1.')
+            names = await client.call_remote(
+                '/org/freedesktop/DBus', 'ListNames',
+                interface='org.freedesktop.DBus',
+                destination='org.freedesktop.DBus')
+            assert client.busname in names
+        finally:
+            client.teardown()
+
+    asyncio.run(main())
+
+
+def test_block_queue_bound(threaded_mock_bus):
+    sender = dbuspy.get_threaded_client(threaded_mock_bus.address, timeout=5)
+
+    async def main():
+        client = await aio.get_client(threaded_mock_bus.address, timeout=5)
+        release = asyncio.Event()
+        received = []
+
+        async def on_tick(msig):
+            await release.wait()
+            received.append(msig.body[0])
+
+        sub = await client.add_signal_receiver(
+            on_tick, interface='com.example.Test', maxsize=2,
+            overflow=signals.BLOCK)
+        def send():
+            for i in range(500):
+                sender.send_message(SignalMessage(
+                    '/test', 'Tick', 'com.example.Test', signature='u',
+                    body=[i], serial=sender.next_serial()))
+
+        # The sender blocks once the backpressure reaches it, so it must not
+        # run on the event loop
+        sending = asyncio.get_running_loop().run_in_executor(None, send)
+        await asyncio.sleep(0.3)
+
+        # Reading stopped after the read that filled the queue
+        assert sub.queue.high_watermark < 100
+        release.set()
+        await asyncio.wait_for(_until(lambda: len(received) == 500), 5)
+        await sending
+        assert received == list(range(500))
+        assert sub.queue.dropped == 0
+        client.teardown()
+
+    try:
+        asyncio.run(main())
+    finally:
+        sender.teardown()
+
+
+async def _until(predicate):
+    while not predicate():
+        await asyncio.sleep(0.01)
+
+
+def test_incoming_calls_are_answered(threaded_mock_bus):
+    async def main():
+        caller = await aio.get_client(threaded_mock_bus.address, timeout=5)
+        callee = await aio.get_client(threaded_mock_bus.address, timeout=5)
+        try:
+            assert await caller.call_remote(
+                '/any/path', 'Ping', interface='org.freedesktop.DBus.Peer',
+                destination=callee.busname) is None
+            with pytest.raises(RemoteError) as e:
+                await caller.call_remote(
+                    '/any/path', 'Frobnicate', interface='com.example.Test',
+                    destination=callee.busname)
+            assert e.value.errName == \
+                'org.freedesktop.DBus.Error.UnknownMethod'
+        finally:
+            caller.teardown()
+            callee.teardown()
+
+    asyncio.run(main())
+
+
+def test_transport_closed_when_connect_fails(tmp_path):
+    bus = MockBus(str(tmp_path / 'bus'),
+                  allowed_uids=[os.getuid() + 1]).start_thread()
+    transports = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        create_unix_connection = loop.create_unix_connection
+
+        async def recording(*args, **kwargs):
+            transport, protocol = await create_unix_connection(
+                *args, **kwargs)
+            transports.append(transport)
+            return transport, protocol
+
+        loop.create_unix_connection = recording
+        with pytest.raises(DBusException):
+            await aio.get_client(bus.address, timeout=5)
+
+    try:
+        asyncio.run(main())
+    finally:
+        bus.stop()
+    assert transports and transports[0].is_closing()
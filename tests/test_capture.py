@@ -0,0 +1,46 @@
+import io
+
+import gevent
+import pytest
+
+from dbuspy import capture
+from dbuspy.connection import INBOUND, OUTBOUND
+
+DBUS = 'org.freedesktop.DBus'
+
+
+def test_capture_read_and_replay(mock_bus_client, tmp_path):
+    client = mock_bus_client
+    path = str(tmp_path / 'bus.pcapng')
+    writer = client.start_capture(path)
+    for _ in range(3):
+        client.call_remote('/org/freedesktop/DBus', 'ListNames',
+                           interface=DBUS, destination=DBUS)
+    client.request_name('com.example.Captured')
+    gevent.sleep(0.1)
+    client.stop_capture()
+    assert client._capture is None
+
+    packets = list(capture.read_capture(path))
+    assert len(packets) == writer.packets
+    directions = [direction for _, direction, _ in packets]
+    sent = directions.count(OUTBOUND)
+    received = directions.count(INBOUND)
+    assert sent == 4 and received >= 5
+    assert sent + received == len(packets)
+    timestamps = [timestamp for timestamp, _, _ in packets]
+    assert timestamps == sorted(timestamps)
+
+    conn = capture.ReplayConnection()
+    messages, nbytes, _ = capture.replay(conn, path)
+    assert messages == received
+    assert nbytes == sum(len(raw) for _, direction, raw in packets
+                         if direction == INBOUND)
+    assert conn.counts['method_return'] == 4
+    assert conn.counts['signal'] >= 1
+    assert sum(conn.counts.values()) == received
+
+
+def test_read_capture_rejects_other_files():
+    with pytest.raises(ValueError):
+        list(capture.read_capture(io.BytesIO(b'\0' * 32)))
@@ -0,0 +1,120 @@
+import gevent
+import pytest
+from gevent.event import AsyncResult
+
+import dbuspy
+from dbuspy.error import TimeOut
+from dbuspy.interface import DBusInterface, Method
+from dbuspy.message import MethodReturnMessage
+from dbuspy.objects import DBusObject
+
+
+def test_failing_message_does_not_strand_buffer(mock_bus_client):
+    client = mock_bus_client
+    result = AsyncResult()
+    client._pending[10000] = result
+
+    bad = bytearray(MethodReturnMessage(
+        9999, body=['x'], signature='s', serial=1).raw_message)
+    bad[1] = 9  # unknown message type
+    reply = MethodReturnMessage(10000, body=['ok'], signature='s', serial=2)
+
+    # Both arrive in one read; the reply behind the broken message is
+    # dispatched without waiting for more data
+    client.on_data_received(bytes(bad) + reply.raw_message)
+
+    assert result.get(timeout=1) == 'ok'
+    assert client._buffer == b''
+
+
+def test_split_and_batched_messages(mock_bus_client):
+    client = mock_bus_client
+    results = []
+    data = b''
+    for serial in range(10000, 10010):
+        result = AsyncResult()
+        client._pending[serial] = result
+        results.append(result)
+        data += MethodReturnMessage(serial, body=[serial], signature='u',
+                                    serial=1).raw_message
+
+    # Feed the replies in chunks cutting through messages and headers
+    for i in range(0, len(data), 7):
+        client.on_data_received(data[i:i + 7])
+
+    assert [r.get(timeout=1) for r in results] == list(range(10000, 10010))
+
+
+class Sleeper (DBusObject):
+    dbus_interfaces = [
+        DBusInterface('com.example.Sleeper',
+                      Method('Sleep', arguments='sd', returns='s')),
+    ]
+
+    def dbus_Sleep(self, tag, seconds):
+        gevent.sleep(seconds)
+        return tag
+
+
+def test_timed_out_call(mock_bus, mock_bus_client):
+    server = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+    server.export_object(Sleeper('/sleeper'))
+    client = mock_bus_client
+
+    def sleep(tag, seconds, timeout):
+        return client.call_remote(
+            '/sleeper', 'Sleep', interface='com.example.Sleeper',
+            destination=server.busname, signature='sd',
+            args=[tag, seconds], timeout=timeout)
+
+    try:
+        with pytest.raises(TimeOut):
+            sleep('a', 0.2, 0.05)
+        assert not client._pending
+        # The late reply to the first call arrives while the second one
+        # waits, and is not taken for its reply
+        assert sleep('b', 0.3, 5) == 'b'
+        assert client.late_replies == 1
+    finally:
+        server.teardown()
+
+
+def test_forget_call(mock_bus_client):
+    client = mock_bus_client
+    serial, result = client.call_remote_async(
+        '/org/freedesktop/DBus', 'GetId', interface='org.freedesktop.DBus',
+        destination='org.freedesktop.DBus')
+    client.forget_call(serial)
+    assert not client._pending
+    gevent.sleep(0.1)
+    assert client.late_replies == 1
+    assert not result.ready()
+    # Forgetting a completed call does nothing
+    client.forget_call(serial)
+
+
+def test_fast_connect(mock_bus):
+    client = dbuspy.get_client(mock_bus.address, timeout=5).connect(fast=True)
+    try:
+        assert client.busname.startswith(':')
+        assert client.call_remote(
+            '/org/freedesktop/DBus', 'GetNameOwner',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s', args=[client.busname]) == client.busname
+    finally:
+        client.teardown()
+
+
+def test_threaded_fast_connect(threaded_mock_bus):
+    client = dbuspy.get_threaded_client(threaded_mock_bus.address,
+                                        timeout=5, fast=True)
+    try:
+        assert client.busname.startswith(':')
+        assert client.call_remote(
+            '/org/freedesktop/DBus', 'GetNameOwner',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s', args=[client.busname]) == client.busname
+    finally:
+        client.teardown()
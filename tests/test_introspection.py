@@ -0,0 +1,34 @@
+import atexit
+import gc
+
+from dbuspy.introspection import DiskCache
+
+
+def _track_exit_hooks(monkeypatch):
+    hooks = []
+    monkeypatch.setattr(atexit, 'register', hooks.append)
+    monkeypatch.setattr(atexit, 'unregister', hooks.remove)
+    return hooks
+
+
+def test_disk_cache_close_removes_exit_hook(tmp_path, monkeypatch):
+    hooks = _track_exit_hooks(monkeypatch)
+    cache = DiskCache(str(tmp_path))
+    assert hooks == [cache._atexit]
+    cache._entries['com.example'] = {'identity': [], 'objects': {},
+                                     'interfaces': {}}
+    cache._dirty.add('com.example')
+    cache.close()
+    assert hooks == []
+    assert (tmp_path / 'com.example.json').exists()
+
+
+def test_disk_cache_exit_hook_is_weak(tmp_path, monkeypatch):
+    hooks = _track_exit_hooks(monkeypatch)
+    cache = DiskCache(str(tmp_path))
+    cache._dirty.add('com.example')
+    del cache
+    gc.collect()
+    # The hook does not keep the cache alive and ignores it once collected
+    assert hooks[0].args[0]() is None
+    hooks[0]()
@@ -0,0 +1,52 @@
+import pytest
+
+from dbuspy.error import RemoteError
+from dbuspy.metrics import (
+    Histogram, InMemoryMetrics, MARSHAL, PENDING_CALLS, UNMARSHAL)
+
+DBUS = 'org.freedesktop.DBus'
+
+
+def test_quantile_is_capped_by_max():
+    histogram = Histogram(bounds=(0.001, 0.01, 0.1))
+    for _ in range(10):
+        histogram.observe(0.002)
+    # The bucket bound is 0.01 but nothing above 0.002 was seen
+    assert histogram.quantile(0.99) == 0.002
+    histogram.observe(0.5)
+    assert histogram.quantile(1.0) == 0.5
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_call_counters(mock_bus_client):
+    client = mock_bus_client
+    client.metrics = metrics = InMemoryMetrics()
+
+    for _ in range(3):
+        client.call_remote('/org/freedesktop/DBus', 'ListNames',
+                           interface=DBUS, destination=DBUS)
+    with pytest.raises(RemoteError):
+        client.call_remote('/org/freedesktop/DBus', 'GetNameOwner',
+                           interface=DBUS, destination=DBUS,
+                           signature='s', args=['com.example.Nobody'])
+
+    list_names = metrics.calls[(DBUS, 'ListNames')]
+    assert (list_names.count, list_names.errors) == (3, 0)
+    assert list_names.latency.count == 3
+    get_owner = metrics.calls[(DBUS, 'GetNameOwner')]
+    assert (get_owner.count, get_owner.errors) == (1, 1)
+
+    assert metrics.sent > 0 and metrics.received > 0
+    assert metrics.times[MARSHAL] > 0 and metrics.times[UNMARSHAL] > 0
+    assert metrics.gauges[PENDING_CALLS][1] >= 1
+
+    slowest = metrics.slowest_calls(1)
+    assert len(slowest) == 1
+    assert slowest[0][0] in metrics.calls
+    assert all(slowest[0][1].latency.sum >= stats.latency.sum
+               for stats in metrics.calls.values())
+
+    snapshot = metrics.snapshot()
+    assert snapshot['calls'][DBUS + '.ListNames']['count'] == 3
+    metrics.reset()
+    assert metrics.calls == {} and metrics.sent == 0
@@ -0,0 +1,80 @@
+"""
+The three clients against a L{FakeSystemd} on the L{MockBus}. The threaded
+and asyncio clients run in a native thread so that the bus and the fake
+keep being served by this thread's hub.
+"""
+import asyncio
+
+import gevent
+import pytest
+
+import dbuspy
+from dbuspy import aio
+from dbuspy.error import RemoteError
+from dbuspy.mockbus import SYSTEMD_BUS_NAME, SYSTEMD_PATH
+from dbuspy.systemd import unit_path
+
+MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+
+
+@pytest.fixture
+def units(fake_systemd):
+    fake_systemd.add_unit('a.service', active_state='active',
+                          sub_state='running')
+    fake_systemd.add_unit('b.socket')
+    return ['a.service', 'b.socket']
+
+
+def _in_thread(func, *args):
+    return gevent.get_hub().threadpool.apply(func, args)
+
+
+def _list_units(client):
+    return sorted(u[0] for u in client.call_remote(
+        SYSTEMD_PATH, 'ListUnits', interface=MANAGER_INTERFACE,
+        destination=SYSTEMD_BUS_NAME))
+
+
+def test_gevent_client(mock_bus_client, units):
+    assert _list_units(mock_bus_client) == units
+    assert mock_bus_client.call_remote(
+        SYSTEMD_PATH, 'GetUnit', interface=MANAGER_INTERFACE,
+        destination=SYSTEMD_BUS_NAME, signature='s',
+        args=['a.service']) == unit_path('a.service')
+    with pytest.raises(RemoteError) as e:
+        mock_bus_client.call_remote(
+            SYSTEMD_PATH, 'GetUnit', interface=MANAGER_INTERFACE,
+            destination=SYSTEMD_BUS_NAME, signature='s', args=['x.service'])
+    assert e.value.errName == 'org.freedesktop.systemd1.NoSuchUnit'
+
+
+def test_gevent_client_proxy(mock_bus_client, units):
+    unit = mock_bus_client.get_object(SYSTEMD_BUS_NAME,
+                                      unit_path('a.service'))
+    assert unit.get_property('ActiveState') == 'active'
+
+
+def test_threaded_client(mock_bus, units):
+    def run():
+        client = dbuspy.get_threaded_client(mock_bus.address, timeout=5)
+        try:
+            return _list_units(client)
+        finally:
+            client.teardown()
+
+    assert _in_thread(run) == units
+
+
+def test_aio_client(mock_bus, fake_systemd, units):
+    async def main():
+        client = await aio.get_client(mock_bus.address, timeout=5)
+        try:
+            reply = await client.call_remote(
+                SYSTEMD_PATH, 'ListUnits', interface=MANAGER_INTERFACE,
+                destination=SYSTEMD_BUS_NAME)
+            return sorted(u[0] for u in reply)
+        finally:
+            client.teardown()
+
+    assert _in_thread(asyncio.run, main()) == units
+    assert ('ListUnits', ()) in fake_systemd.calls
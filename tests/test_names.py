@@ -0,0 +1,32 @@
+import gevent
+
+import dbuspy
+from dbuspy.mockbus import SYSTEMD_BUS_NAME
+
+
+def test_owner_changes(mock_bus, mock_bus_client, fake_systemd):
+    cache = mock_bus_client.enable_name_cache()
+    owner = fake_systemd.client.busname
+    assert cache.get_owner(SYSTEMD_BUS_NAME) == owner
+    assert cache.names_of(owner) == set([SYSTEMD_BUS_NAME])
+    assert cache.get_owner('com.example.Nobody') is None
+
+    other = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+    other.request_name('com.example.Nobody')
+    gevent.sleep(0.1)
+    assert cache.cached_owner('com.example.Nobody') == other.busname
+    other.teardown()
+    gevent.sleep(0.1)
+    assert cache.cached_owner('com.example.Nobody') is None
+
+
+def test_lost_signals_clear_cache(mock_bus_client, fake_systemd):
+    cache = mock_bus_client.enable_name_cache()
+    cache.get_owner(SYSTEMD_BUS_NAME)
+
+    # A change whose signal was lost to queue overflow
+    cache._set(SYSTEMD_BUS_NAME, ':1.999')
+    cache._subscription.queue.dropped += 1
+    assert cache.cached_owner(SYSTEMD_BUS_NAME) is False
+    assert cache.get_owner(SYSTEMD_BUS_NAME) == fake_systemd.client.busname
+    assert cache.names_of(':1.999') == frozenset()
@@ -0,0 +1,140 @@
+import gevent
+import pytest
+
+import dbuspy
+from dbuspy.interface import DBusInterface, Method, Property, Signal
+from dbuspy.objectmanager import (ObjectManagerMirror, ADDED, CHANGED,
+                                  REMOVED, OBJECT_MANAGER_INTERFACE)
+from dbuspy.objects import DBusObject
+
+THING_INTERFACE = 'com.example.Thing'
+
+
+class Thing (DBusObject):
+    dbus_interfaces = [
+        DBusInterface(THING_INTERFACE,
+                      Property('Name', 's'),
+                      Property('Count', 'u')),
+    ]
+
+    def __init__(self, name):
+        DBusObject.__init__(self, '/things/' + name)
+        self.Name = name
+        self.Count = 0
+
+    def set_count(self, count):
+        self.Count = count
+        self.emit_properties_changed(THING_INTERFACE, {'Count': count})
+
+
+class Manager (DBusObject):
+    dbus_interfaces = [
+        DBusInterface(OBJECT_MANAGER_INTERFACE,
+                      Method('GetManagedObjects', returns='a{oa{sa{sv}}}'),
+                      Signal('InterfacesAdded', 'oa{sa{sv}}'),
+                      Signal('InterfacesRemoved', 'oas')),
+    ]
+
+    def __init__(self, client):
+        DBusObject.__init__(self, '/things')
+        self.client = client
+        self.things = {}
+        client.export_object(self)
+
+    def _interfaces(self, thing):
+        return {THING_INTERFACE:
+                thing.get_all_dbus_properties(THING_INTERFACE)}
+
+    def add(self, name, announce=True):
+        thing = self.things[name] = Thing(name)
+        self.client.export_object(thing)
+        if announce:
+            self.emit_signal(OBJECT_MANAGER_INTERFACE, 'InterfacesAdded',
+                             thing.object_path, self._interfaces(thing))
+        return thing
+
+    def remove(self, name, announce=True):
+        thing = self.things.pop(name)
+        self.client.unexport_object(thing.object_path)
+        if announce:
+            self.emit_signal(OBJECT_MANAGER_INTERFACE, 'InterfacesRemoved',
+                             thing.object_path, [THING_INTERFACE])
+
+    def dbus_GetManagedObjects(self):
+        return dict((t.object_path, self._interfaces(t))
+                    for t in self.things.values())
+
+
+@pytest.fixture
+def manager(mock_bus):
+    server = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+    manager = Manager(server)
+    manager.add('a')
+    yield manager
+    server.teardown()
+
+
+@pytest.fixture
+def mirror(manager, mock_bus_client):
+    mirror = ObjectManagerMirror(mock_bus_client, manager.client.busname,
+                                 '/things').start()
+    events = []
+    mirror.add_callback(lambda *event: events.append(event))
+    mirror.events = events
+    yield mirror
+    mirror.close()
+
+
+def test_initial_tree(mirror):
+    assert mirror.paths() == ['/things/a']
+    assert mirror.get('/things/a', THING_INTERFACE) == {
+        'Name': 'a', 'Count': 0}
+
+
+def test_interfaces_added_and_removed(manager, mirror):
+    manager.add('b')
+    gevent.sleep(0.1)
+    assert sorted(mirror.paths(THING_INTERFACE)) == [
+        '/things/a', '/things/b']
+    assert mirror.events == [
+        (ADDED, '/things/b', THING_INTERFACE, {'Name': 'b', 'Count': 0})]
+
+    manager.remove('a')
+    gevent.sleep(0.1)
+    assert mirror.paths() == ['/things/b']
+    assert mirror.events[-1] == (REMOVED, '/things/a', THING_INTERFACE, None)
+
+
+def test_properties_changed(manager, mirror):
+    manager.things['a'].set_count(3)
+    gevent.sleep(0.1)
+    assert mirror.get_property('/things/a', THING_INTERFACE, 'Count') == 3
+    assert mirror.events == [
+        (CHANGED, '/things/a', THING_INTERFACE, {'Count': 3})]
+
+
+def test_overflow_refreshes_and_reports_differences(manager, mirror):
+    # Changes whose signals were lost to queue overflow
+    manager.add('b', announce=False)
+    manager.things['a'].Count = 5
+    mirror._subscriptions[0].queue.dropped += 1
+    manager.add('c')
+    gevent.sleep(0.1)
+
+    assert sorted(mirror.paths()) == ['/things/a', '/things/b', '/things/c']
+    assert sorted(mirror.events) == sorted([
+        (ADDED, '/things/b', THING_INTERFACE, {'Name': 'b', 'Count': 0}),
+        (ADDED, '/things/c', THING_INTERFACE, {'Name': 'c', 'Count': 0}),
+        (CHANGED, '/things/a', THING_INTERFACE, {'Count': 5}),
+    ])
+
+    del mirror.events[:]
+    manager.remove('b', announce=False)
+    mirror._subscriptions[0].queue.dropped += 1
+    manager.things['c'].set_count(1)
+    gevent.sleep(0.1)
+    assert sorted(mirror.paths()) == ['/things/a', '/things/c']
+    assert sorted(mirror.events) == sorted([
+        (REMOVED, '/things/b', THING_INTERFACE, None),
+        (CHANGED, '/things/c', THING_INTERFACE, {'Count': 1}),
+    ])
@@ -0,0 +1,145 @@
+import gevent
+import pytest
+from gevent.event import Event
+
+import dbuspy
+from dbuspy import marshal
+from dbuspy.error import RemoteError
+from dbuspy.interface import DBusInterface, Method
+from dbuspy.introspection import get_cached_interface
+from dbuspy.objects import DBusObject
+
+
+class Worker (DBusObject):
+    dbus_interfaces = [
+        DBusInterface('com.example.Worker',
+                      Method('Work', arguments='u', returns='u'),
+                      Method('Echo', arguments='a{sv}(ias)',
+                             returns='a{sv}(ias)')),
+    ]
+
+    def __init__(self, path):
+        DBusObject.__init__(self, path)
+        self.release = Event()
+        self.order = []
+
+    def dbus_Work(self, i):
+        self.release.wait()
+        self.order.append(i)
+        return i
+
+    def dbus_Echo(self, d, s):
+        return d, s
+
+
+@pytest.fixture
+def worker(mock_bus, mock_bus_client):
+    server = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+    obj = Worker('/worker')
+    server.export_object(obj)
+    yield server, obj
+    server.teardown()
+
+
+def _call(client, server, method, signature, args):
+    return client.call_remote_async(
+        '/worker', method, interface='com.example.Worker',
+        destination=server.busname, signature=signature, args=args)
+
+
+def test_codecs_compiled_at_export(worker):
+    for sig in ('u', 'a{sv}(ias)'):
+        assert sig in marshal._codec_cache
+
+
+def test_echo(worker, mock_bus_client):
+    server, obj = worker
+    obj.release.set()
+    d = {'a': marshal.wrap_variant('s', 'x'),
+         'b': marshal.wrap_variant('at', [1, 2])}
+    reply = mock_bus_client.call_remote(
+        '/worker', 'Echo', interface='com.example.Worker',
+        destination=server.busname, signature='a{sv}(ias)',
+        args=[d, [7, ['p', 'q']]])
+    assert reply == [{'a': 'x', 'b': [1, 2]}, [7, ['p', 'q']]]
+
+
+def test_bounded_call_handling(worker, mock_bus_client):
+    server, obj = worker
+    server.max_concurrent_calls = 1
+    server.max_queued_calls = 2
+
+    calls = [_call(mock_bus_client, server, 'Work', 'u', [i])
+             for i in range(5)]
+    gevent.sleep(0.2)
+
+    # One call runs, two wait in the backlog, the others are rejected
+    for serial, result in calls[3:]:
+        with pytest.raises(RemoteError) as e:
+            mock_bus_client.await_reply(serial, 5, result)
+        assert e.value.errName == \
+            'org.freedesktop.DBus.Error.LimitsExceeded'
+
+    obj.release.set()
+    assert [mock_bus_client.await_reply(serial, 5, result)
+            for serial, result in calls[:3]] == [0, 1, 2]
+    assert obj.order == [0, 1, 2]
+    assert server._call_workers == 0
+
+
+def test_owner_watch_overflow_forgets_owner(worker, mock_bus_client,
+                                            tmp_path):
+    server, obj = worker
+    server.request_name('com.example.Worker')
+    handler = mock_bus_client.obj_handler
+    mock_bus_client.enable_introspection_cache(str(tmp_path))
+
+    interfaces = handler.introspect_remote('com.example.Worker', '/worker')
+    assert 'com.example.Worker' in [i.name for i in interfaces]
+    assert 'com.example.Worker' in handler._owner_identities
+
+    # Lost NameOwnerChanged signals make the recorded owner unreliable
+    handler._owner_identities['com.example.Worker'] = ('x', ':1.999', None)
+    sub = handler._owner_watches['com.example.Worker'][0]
+    sub.queue.dropped += 1
+    identity = handler._owner_identity('com.example.Worker')
+    assert identity[1] == server.busname
+    assert handler._owner_watches['com.example.Worker'][1] == \
+        sub.queue.dropped
+
+
+class UpgradedWorker (Worker):
+    dbus_interfaces = [
+        DBusInterface('com.example.Worker',
+                      Method('Work', arguments='u', returns='u'),
+                      Method('Rest')),
+    ]
+
+    def dbus_Rest(self):
+        pass
+
+
+def test_restarted_service_is_introspected_again(mock_bus, mock_bus_client):
+    handler = mock_bus_client.obj_handler
+    servers = []
+    try:
+        for cls in (Worker, UpgradedWorker):
+            if servers:
+                servers[-1].teardown()
+                gevent.sleep(0.1)
+            server = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+            servers.append(server)
+            server.export_object(cls('/worker'))
+            server.request_name('com.example.Worker')
+            gevent.sleep(0.1)
+
+            interfaces = handler.introspect_remote('com.example.Worker',
+                                                   '/worker')
+            worker, = [i for i in interfaces
+                       if i.name == 'com.example.Worker']
+            assert sorted(worker.methods) == sorted(
+                m.name for m in cls.dbus_interfaces[0].methods.values())
+            assert get_cached_interface('com.example.Worker') is worker
+    finally:
+        for server in servers:
+            server.teardown()
@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+import dbuspy
+
+
+def test_star_import():
+    namespace = {}
+    exec('from dbuspy import *', namespace)
+    for name in dbuspy.__all__:
+        assert name in namespace
+    assert namespace['Client'].__name__ == 'Client'
+
+
+def test_import_does_not_load_gevent():
+    code = ('import sys, dbuspy, dbuspy.marshal, dbuspy.message, '
+            'dbuspy.error; print("gevent" in sys.modules)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert out.strip() == b'False'
@@ -0,0 +1,83 @@
+import gevent
+import pytest
+
+import dbuspy
+from dbuspy.error import ConnectionClosed, TimeOut
+from dbuspy.pool import ClientPool, LEAST_OUTSTANDING
+
+
+def _pool(mock_bus, **kwargs):
+    return ClientPool(client_factory=lambda: dbuspy.get_client(
+        mock_bus.address, timeout=5).connect(), **kwargs)
+
+
+def _get_id(client_or_pool):
+    return client_or_pool.call_remote(
+        '/org/freedesktop/DBus', 'GetId', interface='org.freedesktop.DBus',
+        destination='org.freedesktop.DBus')
+
+
+def test_checkout_at_max_size(mock_bus):
+    pool = _pool(mock_bus, min_size=1, max_size=2)
+    first = pool.checkout()
+    second = pool.checkout()
+    assert first is not second
+    assert len(pool) == 2
+
+    with pytest.raises(TimeOut):
+        pool.checkout(timeout=0.05)
+    assert pool.stats()['checkout_waits'] == 1
+
+    gevent.spawn_later(0.05, pool.checkin, first)
+    assert pool.checkout(timeout=1) is first
+    pool.checkin(first)
+    pool.checkin(second)
+    assert pool.stats()['outstanding'] == 0
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_connection_discards_failed_client(mock_bus):
+    pool = _pool(mock_bus, max_size=1)
+    with pytest.raises(ConnectionClosed):
+        with pool.connection() as client:
+            raise ConnectionClosed()
+    assert len(pool) == 0
+    with pool.connection(timeout=1) as other:
+        assert other is not client
+        assert _get_id(other)
+    assert pool.stats()['discarded'] == 1
+
+
+def test_health_check(mock_bus):
+    pool = _pool(mock_bus, health_check_interval=0)
+    with pool.connection() as client:
+        pass
+    client.teardown()
+    # The dead connection fails its ping and is replaced
+    with pool.connection(timeout=1) as other:
+        assert other is not client
+    stats = pool.stats()
+    assert stats['health_failures'] == 1
+    assert stats['created'] == 2
+
+
+def test_least_outstanding_spreads_calls(mock_bus):
+    pool = _pool(mock_bus, min_size=1, max_size=3, routing=LEAST_OUTSTANDING)
+    calls = [gevent.spawn(_get_id, pool) for _ in range(9)]
+    gevent.joinall(calls, raise_error=True)
+    assert len(set(call.value for call in calls)) == 1
+    stats = pool.stats()
+    assert stats['size'] == 3
+    assert stats['calls'] == 9
+    assert stats['outstanding'] == 0
+
+
+def test_least_outstanding_refuses_checkout(mock_bus):
+    pool = _pool(mock_bus, max_size=1, routing=LEAST_OUTSTANDING)
+    _get_id(pool)
+    with pytest.raises(ValueError):
+        pool.checkout(timeout=1)
+    with pytest.raises(ValueError):
+        with pool.connection(timeout=1):
+            pass
@@ -0,0 +1,51 @@
+import gevent
+
+from dbuspy.mockbus import SYSTEMD_BUS_NAME
+from dbuspy.properties import PropertyCache
+from dbuspy.systemd import unit_path
+
+UNIT_INTERFACE = 'org.freedesktop.systemd1.Unit'
+
+
+def _cache(mock_bus_client, fake_systemd):
+    fake_systemd.add_unit('a.service', active_state='active',
+                          sub_state='running')
+    return PropertyCache(mock_bus_client), unit_path('a.service')
+
+
+def test_get_and_update(mock_bus_client, fake_systemd):
+    cache, path = _cache(mock_bus_client, fake_systemd)
+    assert cache.get(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE,
+                     'ActiveState') == 'active'
+    assert cache.get(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE,
+                     'SubState') == 'running'
+
+    fake_systemd.units['a.service'].set_state('inactive', 'dead')
+    gevent.sleep(0.1)
+    assert cache.get(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE,
+                     'ActiveState') == 'inactive'
+    assert cache.stats()['fetches'] == 1
+    assert cache.stats()['hits'] == 3
+
+
+def test_concurrent_readers_wait_for_fetch(mock_bus_client, fake_systemd):
+    cache, path = _cache(mock_bus_client, fake_systemd)
+    readers = [gevent.spawn(cache.get_all, SYSTEMD_BUS_NAME, path,
+                            UNIT_INTERFACE) for _ in range(3)]
+    gevent.joinall(readers, raise_error=True)
+    for reader in readers:
+        assert reader.value['ActiveState'] == 'active'
+    assert cache.stats()['fetches'] == 1
+
+
+def test_lost_signals_refetch(mock_bus_client, fake_systemd):
+    cache, path = _cache(mock_bus_client, fake_systemd)
+    cache.get_all(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE)
+    entry = cache._entries[(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE)]
+
+    # A change whose signal was lost to queue overflow
+    fake_systemd.units['a.service'].ActiveState = 'failed'
+    entry.subscription.queue.dropped += 1
+    assert cache.get(SYSTEMD_BUS_NAME, path, UNIT_INTERFACE,
+                     'ActiveState') == 'failed'
+    assert cache.stats()['fetches'] == 2
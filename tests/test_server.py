@@ -0,0 +1,90 @@
+import os
+
+import gevent
+import pytest
+
+import dbuspy
+from dbuspy.error import DBusException, RemoteError
+from dbuspy.interface import DBusInterface, Method, Signal
+from dbuspy.objects import DBusObject
+from dbuspy.server import Server
+
+
+class Greeter (DBusObject):
+    dbus_interfaces = [
+        DBusInterface('com.example.Greeter',
+                      Method('Greet', arguments='s', returns='s'),
+                      Signal('Greeted', 's')),
+    ]
+
+    def dbus_Greet(self, name):
+        self.emit_signal('com.example.Greeter', 'Greeted', name)
+        return 'Hello ' + name
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server('unix:path=%s' % (tmp_path / 'sock',)).start()
+    server.export_object(Greeter('/greeter'))
+    yield server
+    server.stop()
+
+
+def _greet(client, name):
+    return client.call_remote('/greeter', 'Greet',
+                              interface='com.example.Greeter',
+                              signature='s', args=[name])
+
+
+def test_call_and_signal_broadcast(server):
+    clients = [dbuspy.get_peer_client(server.address, timeout=5)
+               for _ in range(2)]
+    try:
+        received = [[] for _ in clients]
+        for client, signals in zip(clients, received):
+            client.add_signal_receiver(
+                lambda msig, signals=signals: signals.append(msig.body[0]),
+                interface='com.example.Greeter', member='Greeted')
+        assert _greet(clients[0], 'peer') == 'Hello peer'
+        gevent.sleep(0.1)
+        assert len(server.connections) == 2
+        assert received == [['peer'], ['peer']]
+
+        with pytest.raises(RemoteError) as e:
+            clients[1].call_remote('/greeter', 'Frown',
+                                   interface='com.example.Greeter')
+        assert e.value.errName == 'org.freedesktop.DBus.Error.UnknownMethod'
+    finally:
+        for client in clients:
+            client.teardown()
+    gevent.sleep(0.1)
+    assert not server.connections
+
+
+def test_on_connection(tmp_path):
+    accepted = []
+    server = Server('unix:path=%s' % (tmp_path / 'sock',),
+                    on_connection=accepted.append).start()
+    try:
+        client = dbuspy.get_peer_client(server.address, timeout=5)
+        client.export_object(Greeter('/greeter'))
+        gevent.sleep(0.1)
+        assert accepted and accepted[0].guid == os.getuid()
+        # The server side can call the peer too
+        assert _greet(accepted[0], 'server') == 'Hello server'
+        client.teardown()
+    finally:
+        server.stop()
+
+
+def test_rejected_uid(tmp_path):
+    server = Server('unix:path=%s' % (tmp_path / 'sock',),
+                    allowed_uids=[os.getuid() + 1]).start()
+    try:
+        with pytest.raises((DBusException, EOFError, OSError)):
+            client = dbuspy.get_peer_client(server.address, timeout=1)
+            _greet(client, 'intruder')
+        gevent.sleep(0.1)
+        assert not server.connections
+    finally:
+        server.stop()
@@ -0,0 +1,87 @@
+import gevent
+from gevent.event import AsyncResult, Event
+
+import dbuspy
+from dbuspy import mockbus, signals
+from dbuspy.message import MethodReturnMessage, SignalMessage
+
+
+def _tick(client, i):
+    return SignalMessage('/test', 'Tick', 'com.example.Test', signature='u',
+                         body=[i], serial=client.next_serial())
+
+
+def test_block_dispatches_received_replies(mock_bus_client):
+    client = mock_bus_client
+    release = Event()
+    received = []
+
+    def on_tick(msig):
+        release.wait()
+        received.append(msig.body[0])
+
+    sub = client.add_signal_receiver(on_tick, interface='com.example.Test',
+                                     maxsize=1, overflow=signals.BLOCK)
+
+    # A reply received in the same read as signals overflowing a full BLOCK
+    # queue is dispatched right away
+    result = AsyncResult()
+    client._pending[10000] = result
+    data = b''.join(_tick(client, i).raw_message for i in range(5))
+    data += MethodReturnMessage(10000, body=['ok'], signature='s',
+                                serial=1).raw_message
+    with gevent.Timeout(2):
+        client.on_data_received(data)
+
+    assert result.get(timeout=1) == 'ok'
+    assert sub.queue.dropped == 0
+
+    release.set()
+    gevent.sleep(0.1)
+    assert received == [0, 1, 2, 3, 4]
+
+
+def test_block_backpressure(mock_bus, mock_bus_client):
+    client = mock_bus_client
+    received = []
+
+    def on_tick(msig):
+        gevent.sleep(0.001)
+        received.append(msig.body[0])
+
+    sub = client.add_signal_receiver(on_tick, interface='com.example.Test',
+                                     maxsize=2, overflow=signals.BLOCK)
+
+    sender = dbuspy.get_client(mock_bus.address, timeout=5).connect()
+    try:
+        for i in range(200):
+            sender.send_message(_tick(sender, i))
+        # Calls complete while the subscription applies backpressure
+        assert client.call_remote(
+            '/org/freedesktop/DBus', 'GetId',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus', timeout=5)
+        with gevent.Timeout(5):
+            while len(received) < 200:
+                gevent.sleep(0.01)
+    finally:
+        sender.teardown()
+
+    assert received == list(range(200))
+    assert sub.queue.dropped == 0
+
+
+def test_rule_escapes_quotes(mock_bus_client):
+    client = mock_bus_client
+    received = AsyncResult()
+    sub = client.add_signal_receiver(
+        lambda msig: received.set(msig.body[0]),
+        interface='com.example.Test', member='Said', arg0="it's \\ fine")
+    assert sub.rule.endswith("arg0='it'\\''s \\ fine'")
+    assert mockbus.parse_match_rule(sub.rule)['arg0'] == "it's \\ fine"
+
+    # The bus routes the signal with the quote to the subscription
+    client.send_message(SignalMessage(
+        '/test', 'Said', 'com.example.Test', signature='s',
+        body=["it's \\ fine"], serial=client.next_serial()))
+    assert received.get(timeout=2) == "it's \\ fine"
@@ -0,0 +1,355 @@
+import gevent
+import pytest
+
+from dbuspy import systemd
+from dbuspy.error import (ConnectionClosed, IntrospectionFailed, RemoteError,
+                          TimeOut)
+from dbuspy.systemd import (SystemdManager, Superseded, JOB_DONE, unit_name,
+                            unit_path)
+
+
+@pytest.fixture
+def manager(mock_bus_client, fake_systemd):
+    fake_systemd.add_unit('a.service')
+    return SystemdManager(mock_bus_client)
+
+
+def test_start_unit_wait(manager, fake_systemd):
+    assert manager.start_unit('a.service', wait=True, timeout=5) == JOB_DONE
+    assert fake_systemd.units['a.service'].ActiveState == 'active'
+
+
+def test_wait_job_timeout(manager, fake_systemd):
+    fake_systemd.job_delay = 0.2
+    job_path = manager.start_unit('a.service')
+    with pytest.raises(TimeOut):
+        manager.wait_job(job_path, timeout=0.01)
+    assert job_path not in manager._job_waiters
+
+    # A result arriving after the timeout can still be waited for
+    gevent.sleep(0.3)
+    assert manager.wait_job(job_path, timeout=5) == JOB_DONE
+
+
+
+def test_wait_job_timeout_keeps_other_waiters(manager, fake_systemd):
+    fake_systemd.job_delay = 0.2
+    job_path = manager.start_unit('a.service')
+    patient = gevent.spawn(manager.wait_job, job_path, None)
+    gevent.sleep(0)
+    with pytest.raises(TimeOut):
+        manager.wait_job(job_path, timeout=0.01)
+    assert patient.get(timeout=1) == JOB_DONE
+    assert not manager._job_waiters
+
+def test_units_properties_skips_units_without_map(manager, fake_systemd,
+                                                  monkeypatch):
+    fake_systemd.add_unit('b.service', active_state='active')
+    handler = manager._system_bus.obj_handler
+    introspect = handler.introspect_remote
+
+    def introspect_remote(busname, path):
+        if path == manager.get_unit_path('broken.service'):
+            raise IntrospectionFailed('broken')
+        return introspect(busname, path)
+
+    monkeypatch.setattr(handler, 'introspect_remote', introspect_remote)
+    names = ['missing.service', 'broken.service', 'a.service', 'b.service']
+    records = manager.get_units_properties(names, ['ActiveState', 'MainPID'])
+    assert [r.ActiveState for r in records] == [
+        None, None, 'inactive', 'active']
+    assert records[3].MainPID == 0
+    assert manager._property_maps['service']
+
+
+def _unit_paths(manager, fake_systemd, count):
+    names = ['u%d.service' % (i,) for i in range(count)]
+    for name in names:
+        fake_systemd.add_unit(name)
+    return [manager.get_unit_path(name) for name in names]
+
+
+def test_units_props_skips_timed_out_calls(manager, fake_systemd,
+                                           monkeypatch):
+    paths = _unit_paths(manager, fake_systemd, 4)
+    bus = manager._system_bus
+    await_reply = bus.await_reply
+    slow = []
+
+    def flaky_await_reply(serial, timeout=None, result=None):
+        if not slow:
+            slow.append(serial)
+            bus.forget_call(serial)
+            raise TimeOut('slow')
+        return await_reply(serial, timeout, result)
+
+    monkeypatch.setattr(bus, 'await_reply', flaky_await_reply)
+    props = manager.get_units_props(paths)
+    assert sorted(props) == sorted(paths[1:])
+    assert not bus._pending
+
+
+def test_units_props_releases_calls_on_error(manager, fake_systemd,
+                                             monkeypatch):
+    monkeypatch.setattr(systemd, 'PIPELINE_DEPTH', 2)
+    paths = _unit_paths(manager, fake_systemd, 4)
+    bus = manager._system_bus
+
+    def closed_await_reply(serial, timeout=None, result=None):
+        bus.forget_call(serial)
+        raise ConnectionClosed()
+
+    monkeypatch.setattr(bus, 'await_reply', closed_await_reply)
+    with pytest.raises(ConnectionClosed):
+        manager.get_units_props(paths)
+    assert not bus._pending
+
+
+def test_unit_file_batch(manager, fake_systemd):
+    fake_systemd.add_unit('b.service')
+    for name in ('c.service', 'd.service', 'e.service'):
+        fake_systemd.add_unit(name, unit_file_state='disabled')
+    enabled = [manager.queue_enable('c.service'),
+               manager.queue_enable('d.service')]
+    disabled = manager.queue_disable('a.service')
+    masked = manager.queue_mask('b.service')
+    # The last operation requested for a unit wins
+    superseded = manager.queue_enable('e.service')
+    manager.queue_disable('e.service')
+    manager.flush_unit_files()
+    with pytest.raises(Superseded):
+        superseded.get(timeout=1)
+
+    ops = [call for call in fake_systemd.calls if call[0] in (
+        'EnableUnitFiles', 'DisableUnitFiles', 'MaskUnitFiles',
+        'UnmaskUnitFiles', 'Reload')]
+    assert ops == [
+        ('DisableUnitFiles', (['a.service', 'e.service'], False)),
+        ('MaskUnitFiles', (['b.service'], False, True)),
+        ('EnableUnitFiles', (['c.service', 'd.service'], False, True)),
+        ('Reload', ()),
+    ]
+    assert len(enabled[0].get(timeout=1)) == 2
+    assert enabled[1].get(timeout=1) == enabled[0].get()
+    assert disabled.get(timeout=1) == [
+        ['unlink', '/etc/systemd/system/a.service', '']]
+    assert masked.get(timeout=1) == [
+        ['symlink', '/etc/systemd/system/b.service', '/dev/null']]
+    units = fake_systemd.units
+    assert [units[n].UnitFileState for n in sorted(units)] == [
+        'disabled', 'masked', 'enabled', 'enabled', 'disabled']
+
+
+def test_unit_file_batch_window(manager, fake_systemd):
+    result = manager.queue_disable('a.service')
+    assert result.get(timeout=2)
+    assert fake_systemd.calls[-1] == ('Reload', ())
+
+
+def test_unit_file_batch_without_changes(manager, fake_systemd):
+    # a.service is already enabled, so no reload is needed
+    assert manager.queue_enable('a.service').get(timeout=2) == []
+    assert ('Reload', ()) not in fake_systemd.calls
+
+
+def test_unit_file_batch_retries_units_one_by_one(manager, fake_systemd):
+    fake_systemd.add_unit('b.service', unit_file_state='disabled')
+    good = manager.queue_enable('b.service')
+    bad = manager.queue_enable('nonexistent.service')
+    manager.flush_unit_files()
+    with pytest.raises(RemoteError) as e:
+        bad.get(timeout=1)
+    assert e.value.errName == 'org.freedesktop.systemd1.NoSuchUnit'
+    assert good.get(timeout=1) == [
+        ['symlink', '/etc/systemd/system/b.service',
+         '/usr/lib/systemd/system/b.service']]
+    assert fake_systemd.units['b.service'].UnitFileState == 'enabled'
+    assert fake_systemd.calls[-1] == ('Reload', ())
+
+
+def test_list_units(manager, fake_systemd):
+    fake_systemd.add_unit('b.socket', active_state='active',
+                          sub_state='listening', unit_file_state='disabled')
+    units = dict((u.name, u) for u in manager.list_units())
+    assert sorted(units) == ['a.service', 'b.socket']
+    b = units['b.socket']
+    assert (b.load_state, b.active_state, b.sub_state) == (
+        'loaded', 'active', 'listening')
+    assert b.path == manager.get_unit_path('b.socket')
+    assert b.job_id == 0
+
+    assert [u.name for u in manager.list_units_by_patterns(
+        ['active'], ['*.socket', '*.service'])] == ['b.socket']
+    assert [u.name for u in manager.list_units_by_patterns(
+        patterns=['a.*'])] == ['a.service']
+
+    units = manager.list_units_by_names(['b.socket', 'missing.service'])
+    assert [(u.name, u.load_state) for u in units] == [
+        ('b.socket', 'loaded'), ('missing.service', 'not-found')]
+
+
+def test_list_unit_files(manager, fake_systemd):
+    fake_systemd.add_unit('b.socket', unit_file_state='disabled')
+    files = sorted(manager.list_unit_files())
+    assert files == [
+        ('/usr/lib/systemd/system/a.service', 'enabled'),
+        ('/usr/lib/systemd/system/b.socket', 'disabled')]
+    assert files[0].path.endswith('a.service')
+    assert files[0].state == 'enabled'
+    assert manager.list_unit_files(states=['disabled']) == [files[1]]
+    assert manager.list_unit_files(patterns=['*.service']) == [files[0]]
+    assert ('ListUnitFilesByPatterns', (['disabled'], [])) in \
+        fake_systemd.calls
+
+
+def test_units_props(manager, fake_systemd):
+    fake_systemd.add_unit('b.socket', active_state='active')
+    paths = [manager.get_unit_path(n) for n in ('a.service', 'b.socket')]
+    props = manager.get_units_props(paths + [
+        manager.get_unit_path('missing.service')])
+    assert sorted(props) == sorted(paths)
+    assert props[paths[1]]['ActiveState'] == 'active'
+
+    by_names = manager.get_units_props_by_names(['a.service', 'b.socket'])
+    assert by_names['a.service']['Id'] == 'a.service'
+    assert by_names['b.socket']['ActiveState'] == 'active'
+
+
+@pytest.mark.parametrize('name, label', [
+    ('snapd.service', 'snapd_2eservice'),
+    ('foo-bar@x.y.service', 'foo_2dbar_40x_2ey_2eservice'),
+    ('0day.service', '_30day_2eservice'),
+    ('d0.service', 'd0_2eservice'),
+    (u'hé.service', 'h_c3_a9_2eservice'),
+    ('', '_'),
+])
+def test_unit_path_round_trip(name, label):
+    path = unit_path(name)
+    assert path == '/org/freedesktop/systemd1/unit/' + label
+    assert unit_name(path) == name
+
+
+def test_unit_name_rejects_other_paths():
+    with pytest.raises(ValueError):
+        unit_name('/org/freedesktop/systemd1/job/1')
+    with pytest.raises(ValueError):
+        unit_name('/org/freedesktop/systemd1/unit/a_zz')
+
+
+def test_call_unit_at_computed_path(manager, fake_systemd):
+    fake_systemd.add_unit(u'foo-bar@xé.service')
+    props = manager.get_unit_props(u'foo-bar@xé.service')
+    assert props['Id'] == u'foo-bar@xé.service'
+    assert not [c for c in fake_systemd.calls if c[0] == 'LoadUnit']
+
+
+def test_call_unit_load_unit_fallback(manager, fake_systemd):
+    # An alias has no object at its own path
+    fake_systemd.units['alias.service'] = fake_systemd.units['a.service']
+    for _ in range(2):
+        assert manager.get_unit_props('alias.service')['Id'] == 'a.service'
+    assert [c for c in fake_systemd.calls if c[0] == 'LoadUnit'] == [
+        ('LoadUnit', ('alias.service',))]
+    assert manager.get_unit_path('alias.service') == unit_path('a.service')
+
+    with pytest.raises(RemoteError):
+        manager.get_unit_props('missing.service')
+
+
+def _states(changes):
+    return [(c.unit, c.active_state, c.sub_state) for c in changes]
+
+
+def test_unit_watcher(manager, fake_systemd):
+    fake_systemd.add_unit('b.socket')
+    changes = []
+    watcher = manager.watch_units(changes.append, patterns=['*.service'])
+    try:
+        assert watcher.states == {'a.service': ('inactive', 'dead')}
+        fake_systemd.units['a.service'].set_state('active', 'running')
+        fake_systemd.units['b.socket'].set_state('active', 'listening')
+        fake_systemd.add_unit('c.service').set_state('active', 'exited')
+        gevent.sleep(0.1)
+        fake_systemd.remove_unit('c.service')
+        gevent.sleep(0.1)
+    finally:
+        watcher.close()
+    assert _states(changes) == [
+        ('a.service', 'active', 'running'),
+        ('c.service', 'active', 'exited'),
+        ('c.service', None, None),
+    ]
+    assert watcher.states == {'a.service': ('active', 'running')}
+
+
+def test_unit_watcher_coalesces(manager, fake_systemd):
+    unit = fake_systemd.units['a.service']
+    changes = []
+    watcher = manager.watch_units(changes.append, units=['a.service'],
+                                  coalesce=0.2)
+    try:
+        unit.set_state('activating', 'start')
+        gevent.sleep(0.05)
+        # Reported at once, the later changes are held back
+        assert _states(changes) == [('a.service', 'activating', 'start')]
+        unit.set_state('active', 'running')
+        unit.set_state('deactivating', 'stop')
+        unit.set_state('failed', 'failed')
+        gevent.sleep(0.05)
+        assert len(changes) == 1
+        # Only the final state is reported when the window ends
+        gevent.sleep(0.2)
+        assert _states(changes) == [
+            ('a.service', 'activating', 'start'),
+            ('a.service', 'failed', 'failed')]
+
+        # A unit flapping back to the reported state is not reported again
+        unit.set_state('active', 'running')
+        unit.set_state('failed', 'failed')
+        gevent.sleep(0.3)
+        assert len(changes) == 2
+    finally:
+        watcher.close()
+
+
+def test_resource_poller(manager, fake_systemd):
+    a = fake_systemd.units['a.service']
+    b = fake_systemd.add_unit('b.service')
+    poller = manager.resource_poller(units=['a.service', 'b.service'])
+    a.CPUUsageNSec, a.MemoryCurrent = 1000, 4096
+    poller.poll()
+    assert poller.get('a.service', 'CPUUsageNSec') == 1000
+    # Accounting disabled
+    assert poller.get('b.service', 'CPUUsageNSec') is None
+    assert poller.values('MemoryCurrent') == {'a.service': 4096}
+    assert poller.deltas('CPUUsageNSec') == {}
+    assert poller.rates('CPUUsageNSec') == {}
+
+    a.CPUUsageNSec, a.MemoryCurrent = 3000, 2048
+    b.CPUUsageNSec = 10
+    gevent.sleep(0.05)
+    poller.poll()
+    assert poller.deltas('CPUUsageNSec') == {'a.service': 2000}
+    elapsed = poller.timestamp - poller.previous_timestamp
+    assert poller.rates('CPUUsageNSec') == {'a.service': 2000 / elapsed}
+    # A counter going backwards is left out
+    assert poller.deltas('MemoryCurrent') == {}
+
+
+def test_resource_poller_rescans_patterns(manager, fake_systemd):
+    fake_systemd.units['a.service'].set_state('active', 'running')
+    fake_systemd.add_unit('b.service')
+    fake_systemd.add_unit('c.socket', active_state='active')
+    fake_systemd.units['a.service'].CPUUsageNSec = 2
+    poller = manager.resource_poller(patterns=['*.service'])
+    poller.poll()
+    assert poller.units == ['a.service']
+
+    fake_systemd.units['a.service'].CPUUsageNSec = 5
+    fake_systemd.units['b.service'].set_state('active', 'running')
+    poller.rescan_interval = 0
+    poller.poll()
+    assert sorted(poller.units) == ['a.service', 'b.service']
+    assert poller.values('CPUUsageNSec') == {'a.service': 5}
+    # The previous tick of a unit still polled survives the rescan
+    assert poller.deltas('CPUUsageNSec') == {'a.service': 3}
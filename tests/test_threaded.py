@@ -0,0 +1,46 @@
+import concurrent.futures
+
+import pytest
+
+import dbuspy
+from dbuspy.error import RemoteError
+
+
+@pytest.fixture
+def threaded_clients(threaded_mock_bus):
+    clients = [dbuspy.get_threaded_client(threaded_mock_bus.address,
+                                          timeout=5, fast=fast)
+               for fast in (False, True)]
+    yield clients
+    for client in clients:
+        client.teardown()
+
+
+def test_shared_between_threads(threaded_clients):
+    client = threaded_clients[0]
+
+    def call(i):
+        return client.call_remote(
+            '/org/freedesktop/DBus', 'NameHasOwner',
+            interface='org.freedesktop.DBus',
+            destination='org.freedesktop.DBus',
+            signature='s', args=[client.busname])
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(call, range(200)))
+
+
+def test_incoming_calls_are_answered(threaded_clients):
+    caller, callee = threaded_clients
+    assert caller.call_remote('/any/path', 'Ping',
+                              interface='org.freedesktop.DBus.Peer',
+                              destination=callee.busname) is None
+    with pytest.raises(RemoteError) as e:
+        caller.call_remote('/any/path', 'Frobnicate',
+                           interface='com.example.Test',
+                           destination=callee.busname)
+    assert e.value.errName == 'org.freedesktop.DBus.Error.UnknownMethod'
+    # The callee keeps working
+    assert callee.call_remote(
+        '/org/freedesktop/DBus', 'GetId', interface='org.freedesktop.DBus',
+        destination='org.freedesktop.DBus')
@@ -0,0 +1,67 @@
+import itertools
+
+import gevent
+
+from dbuspy import tracing
+from dbuspy.tracing import RECEIVE, SEND
+
+DBUS = 'org.freedesktop.DBus'
+
+
+def _list_names(client):
+    return client.call_remote('/org/freedesktop/DBus', 'ListNames',
+                              interface=DBUS, destination=DBUS)
+
+
+def test_call_and_reply_events(mock_bus_client):
+    client = mock_bus_client
+    events = []
+    hook = client.add_trace_hook(events.append)
+
+    _list_names(client)
+    call, reply = events
+    assert (call.direction, reply.direction) == (SEND, RECEIVE)
+    assert call.message.member == 'ListNames'
+    assert call.reply_serial is None
+    assert reply.reply_serial == call.serial
+    assert reply.timestamp >= call.timestamp
+    assert call.size == len(call.message.raw_message)
+
+    client.remove_trace_hook(hook)
+    _list_names(client)
+    assert len(events) == 2
+
+
+def test_sampling_keeps_calls_with_their_reply(mock_bus_client, monkeypatch):
+    client = mock_bus_client
+    # Sample every other call
+    draws = itertools.cycle([0.0, 0.9])
+    monkeypatch.setattr(tracing.random, 'random', lambda: next(draws))
+    events = []
+    client.add_trace_hook(events.append, sample_rate=0.5)
+
+    for _ in range(6):
+        _list_names(client)
+
+    calls = [e for e in events if e.direction == SEND]
+    replies = [e for e in events if e.direction == RECEIVE]
+    assert len(calls) == 3
+    assert [e.reply_serial for e in replies] == [e.serial for e in calls]
+
+
+def test_signals_can_be_excluded(mock_bus_client):
+    client = mock_bus_client
+    all_events = []
+    no_signals = []
+    client.add_trace_hook(all_events.append)
+    client.add_trace_hook(no_signals.append, signals=False)
+
+    client.request_name('com.example.Traced')
+    gevent.sleep(0.1)
+
+    def members(events):
+        return [e.message.member for e in events
+                if e.message._message_type == 4]
+    assert 'NameAcquired' in members(all_events)
+    assert members(no_signals) == []
+    assert len(no_signals) == len(all_events) - len(members(all_events))